@@ -0,0 +1,648 @@
+'''
+This code is for micro-benchmarking the hot paths of the train/inference pipelines.
+
+Usage:
+    python benchmark.py image_loading [--image_path PATH] [--size 3840x2160]
+    python benchmark.py train_step [--model_name NAME] [--batch_size 4] [--steps 20]
+    python benchmark.py draw_boxes [--sizes 640x480 3840x2160] [--num_boxes 1 10 100]
+    python benchmark.py postprocess [--num_boxes 100 1000 10000] [--batch_size 8]
+    python benchmark.py evaluator [--num_images 1000] [--num_boxes 100]
+    python benchmark.py detector [--models M1 M2] [--batch_sizes 1 4] [--image_sizes 512] [--threads 0:0 4:1]
+    python benchmark.py dataset [--num_images 256] [--source_size 1920x1080] [--num_workers 8]
+    python benchmark.py startup [--commands "inference.py image --no_display --image {image}" ...] [--top 10]
+    python benchmark.py server [--port 8080] [--concurrency 1 4 16] [--requests 200]
+'''
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# the box/class head variables fine-tuned by train.py
+_PREFIXES_TO_TRAIN = ['WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalBoxHead',
+                      'WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalClassHead']
+
+
+def _measure(fn, repeats):
+    """Run fn `repeats` times and return the median seconds."""
+    fn()  # warmup, so lazy imports and decoder setup are not timed
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings))
+
+
+def _print_table(header, rows):
+    """Print rows of a result table with aligned columns."""
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)), flush=True)
+
+
+def _legacy_load_image_into_numpy_array(path):
+    """The original per-pixel PIL loader, kept here as the benchmark baseline."""
+    from six import BytesIO
+    from PIL import Image
+    import tensorflow as tf
+
+    img_data = tf.io.gfile.GFile(path, 'rb').read()
+    image = Image.open(BytesIO(img_data))
+    (im_width, im_height) = image.size
+    return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+
+
+# the loaders compared by the image_loading benchmark
+_IMAGE_LOADERS = ['legacy getdata()', 'image_util (PIL)', 'image_util (tf.io)']
+
+
+def image_loading_run(args):
+    """Benchmark one image loader in this fresh process (spawned by benchmark_image_loading)."""
+    from util import image_util
+
+    loaders = {'legacy getdata()': _legacy_load_image_into_numpy_array,
+               'image_util (PIL)': image_util.load_image_into_numpy_array,
+               'image_util (tf.io)': lambda path: image_util.decode_image(path).numpy()}
+    load = loaders[args.loader]
+    # ru_maxrss is in KiB on Linux and, unlike tracemalloc, covers the native decoder buffers
+    baseline_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = _measure(lambda: load(args.image_path), args.repeats)
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(args.output, 'w') as f:
+        json.dump({'seconds': seconds, 'peak_rss_mib': peak_kib / 1024,
+                   'decode_rss_mib': (peak_kib - baseline_kib) / 1024}, f)
+
+
+def benchmark_image_loading(args):
+    """Compare the legacy image loader against util.image_util for time and peak memory."""
+    from PIL import Image
+
+    image_path = args.image_path
+    output_dir = tempfile.mkdtemp()
+    if args.size:
+        # synthesize a noise JPEG of the requested size, e.g. a 4K frame
+        width, height = [int(v) for v in args.size.lower().split('x')]
+        image_path = os.path.join(output_dir, 'synthetic.jpg')
+        noise = np.random.RandomState(0).randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+        Image.fromarray(noise).save(image_path, quality=90)
+
+    with Image.open(image_path) as image:
+        print('Image %s of %dx%d, %d repeats' % ((image_path,) + image.size + (args.repeats,)))
+    print('Peak RSS of a fresh process per loader; decode RSS is its growth over the process after imports.')
+    rows = []
+    for index, loader in enumerate(_IMAGE_LOADERS):
+        output = os.path.join(output_dir, '%d.json' % index)
+        command = [sys.executable, os.path.abspath(__file__), 'image_loading_run', '--loader', loader,
+                   '--image_path', image_path, '--repeats', str(args.repeats), '--output', output]
+        # a fresh process per loader, so ru_maxrss is not the high-water mark of the previous one
+        if subprocess.run(command).returncode != 0:
+            rows.append([loader, 'failed', '-', '-'])
+            continue
+        with open(output) as f:
+            result = json.load(f)
+        rows.append([loader, '%.1f' % (result['seconds'] * 1000), '%.1f' % result['peak_rss_mib'],
+                     '%.1f' % result['decode_rss_mib']])
+    _print_table(['loader', 'median ms', 'peak RSS MiB', 'decode RSS MiB'], rows)
+
+
+def _legacy_train_step_function(model, optimizer, vars_to_fine_tune, batch_size):
+    """The original list-based training step, kept here as the benchmark baseline."""
+    import tensorflow as tf
+
+    @tf.function
+    def train_step_fn(image_tensors, groundtruth_boxes_list, groundtruth_classes_list):
+        shapes = tf.constant(batch_size * [[640, 640, 3]], dtype=tf.int32)
+        model.provide_groundtruth(
+            groundtruth_boxes_list=groundtruth_boxes_list,
+            groundtruth_classes_list=groundtruth_classes_list)
+        with tf.GradientTape() as tape:
+            preprocessed_images = tf.concat(
+                [model.preprocess(image_tensor)[0] for image_tensor in image_tensors], axis=0)
+            prediction_dict = model.predict(preprocessed_images, shapes)
+            losses_dict = model.loss(prediction_dict, shapes)
+            total_loss = losses_dict['Loss/localization_loss'] + losses_dict['Loss/classification_loss']
+        gradients = tape.gradient(total_loss, vars_to_fine_tune)
+        optimizer.apply_gradients(zip(gradients, vars_to_fine_tune))
+        return total_loss
+
+    return train_step_fn
+
+
+def _time_steps(step, args_list, warmup):
+    """Run step over args_list and return steps/sec, excluding `warmup` steps."""
+    for step_args in args_list[:warmup]:
+        step(*step_args).numpy()
+    start_time = time.perf_counter()
+    for step_args in args_list[warmup:]:
+        loss = step(*step_args)
+    loss.numpy()  # wait for the last dispatched step
+    return (len(args_list) - warmup) / (time.perf_counter() - start_time)
+
+
+def benchmark_train_step(args):
+    """Compare steps/sec of the legacy list-based step, the batched train step and the cached-feature step."""
+    import tensorflow as tf
+    import train
+    from util import data_util
+    from util import feature_cache_util
+
+    model_dir = os.path.join('./object_detection/test_data/', args.model_name)
+    detection_model, _ = train.build_fine_tune_model(
+        os.path.join(model_dir, 'pipeline.config'),
+        os.path.join(model_dir, 'checkpoint', 'ckpt-0'),
+        num_classes=1)
+    to_fine_tune = train.get_fine_tune_variables(detection_model, _PREFIXES_TO_TRAIN)
+
+    # synthetic batches with one box per image, the same data for both steps
+    max_boxes = 100
+    batches = [tuple(tf.constant(t) for t in data_util.make_synthetic_batch(
+                   args.batch_size, num_classes=1, max_boxes=max_boxes, seed=seed))
+               for seed in range(args.steps + args.warmup)]
+
+    legacy_step = _legacy_train_step_function(
+        detection_model, tf.keras.optimizers.SGD(learning_rate=0.01, momentum=0.9),
+        to_fine_tune, args.batch_size)
+    legacy_args = [(tf.split(images, args.batch_size), tf.unstack(boxes[:, :1]), tf.unstack(classes[:, :1]))
+                   for images, boxes, classes, _ in batches]
+    batched_step = train.get_model_train_step_function(
+        detection_model, tf.keras.optimizers.SGD(learning_rate=0.01, momentum=0.9),
+        to_fine_tune, batch_size=args.batch_size, num_classes=1, max_boxes=max_boxes)
+
+    # the heads alone, on the feature maps of the same images (see util/feature_cache_util.py)
+    feature_args = [(tuple(feature_cache_util.compute_feature_maps(detection_model, images)), boxes, classes, num_boxes)
+                    for images, boxes, classes, num_boxes in batches]
+    cached_step = train.get_cached_features_train_step_function(
+        detection_model, tf.keras.optimizers.SGD(learning_rate=0.01, momentum=0.9),
+        to_fine_tune, batch_size=args.batch_size, num_classes=1,
+        feature_shapes=[feature_map.shape[1:] for feature_map in feature_args[0][0]], max_boxes=max_boxes)
+
+    rows = [['legacy (per-image preprocess)', '%.3f' % _time_steps(legacy_step, legacy_args, args.warmup)],
+            ['batched (input_signature)', '%.3f' % _time_steps(batched_step, batches, args.warmup)],
+            ['cached features (heads only)', '%.3f' % _time_steps(cached_step, feature_args, args.warmup)]]
+    print('Model %s, batch size %d, %d timed steps' % (args.model_name, args.batch_size, args.steps))
+    _print_table(['train step', 'steps/sec'], rows)
+
+
+def _legacy_draw_boxes(image, boxes, class_names, scores, max_boxes=10, min_score=0.1):
+    """The original inference_tfhub.draw_boxes (one image conversion and copy per box), kept as the baseline."""
+    from PIL import Image, ImageColor, ImageDraw
+    from util import render_util
+
+    colors = list(ImageColor.colormap.values())
+    font = render_util.get_font.__wrapped__()  # resolved on every call, as before
+    for i in range(min(boxes.shape[0], max_boxes)):
+        if scores[i] >= min_score:
+            ymin, xmin, ymax, xmax = tuple(boxes[i])
+            display_str = '{}: {}%'.format(class_names[i], int(100 * scores[i]))
+            color = colors[hash(class_names[i]) % len(colors)]
+            image_pil = Image.fromarray(np.uint8(image)).convert('RGB')
+            draw = ImageDraw.Draw(image_pil)
+            im_width, im_height = image_pil.size
+            left, right, top, bottom = xmin * im_width, xmax * im_width, ymin * im_height, ymax * im_height
+            draw.line([(left, top), (left, bottom), (right, bottom), (right, top), (left, top)], width=4, fill=color)
+            text_width, text_height = render_util.text_size(font, display_str)
+            margin = np.ceil(0.05 * text_height)
+            total_height = (1 + 2 * 0.05) * text_height
+            text_bottom = top if top > total_height else top + total_height
+            draw.rectangle([(left, text_bottom - text_height - 2 * margin), (left + text_width, text_bottom)],
+                           fill=color)
+            draw.text((left + margin, text_bottom - text_height - margin), display_str, fill='black', font=font)
+            np.copyto(image, np.array(image_pil))
+    return image
+
+
+def benchmark_draw_boxes(args):
+    """Compare the legacy per-box draw_boxes against util.render_util.BoxRenderer."""
+    from util import render_util
+
+    random_state = np.random.RandomState(0)
+    renderer = render_util.BoxRenderer()
+    rows = []
+    for size in args.sizes:
+        width, height = [int(v) for v in size.lower().split('x')]
+        image = random_state.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+        for num_boxes in args.num_boxes:
+            # two sorted (y, x) corners per box: [[ymin, xmin], [ymax, xmax]]
+            boxes = np.sort(random_state.uniform(size=(num_boxes, 2, 2)), axis=1).reshape(num_boxes, 4)
+            class_names = ['class_%d' % c for c in random_state.randint(0, 90, size=num_boxes)]
+            scores = random_state.uniform(0.5, 1.0, size=num_boxes)
+            legacy_seconds = _measure(
+                lambda: _legacy_draw_boxes(image, boxes, class_names, scores, max_boxes=num_boxes), args.repeats)
+            renderer_seconds = _measure(
+                lambda: renderer.draw(image, boxes, class_names, scores, max_boxes=num_boxes), args.repeats)
+            rows.append(['%dx%d' % (width, height), num_boxes, '%.2f' % (1000 * legacy_seconds),
+                         '%.2f' % (1000 * renderer_seconds), '%.1fx' % (legacy_seconds / renderer_seconds)])
+    print('Median of %d repeats; rendering skipped entirely (inference_tfhub.py detect --no_render) costs 0 ms.'
+          % args.repeats)
+    _print_table(['image', 'boxes', 'legacy ms', 'renderer ms', 'speedup'], rows)
+
+
+def _synthetic_detections(batch_size, num_boxes, num_classes, random_state):
+    """Candidate boxes jittered around a few objects per image, so that NMS has overlaps to remove."""
+    num_objects = max(num_boxes // 20, 1)
+    centers = random_state.uniform(0.1, 0.9, size=(batch_size, num_objects, 2))
+    sizes = random_state.uniform(0.05, 0.3, size=(batch_size, num_objects, 2))
+    owner = random_state.randint(0, num_objects, size=(batch_size, num_boxes))
+    center = np.take_along_axis(centers, owner[..., np.newaxis], axis=1)
+    size = np.take_along_axis(sizes, owner[..., np.newaxis], axis=1)
+    center = center + random_state.normal(scale=0.02, size=center.shape)
+    boxes = np.clip(np.concatenate([center - size / 2, center + size / 2], axis=-1), 0, 1)
+    return {'detection_boxes': boxes.astype(np.float32),
+            'detection_scores': random_state.uniform(size=(batch_size, num_boxes)).astype(np.float32),
+            'detection_classes': random_state.randint(0, num_classes, size=(batch_size, num_boxes))}
+
+
+def benchmark_postprocess(args):
+    """Time util.postprocess_util over a batch at several candidate box counts."""
+    from util import postprocess_util
+
+    random_state = np.random.RandomState(0)
+    configs = [('threshold + top-k', dict(method='none')),
+               ('nms per-class', dict(method='nms')),
+               ('nms agnostic', dict(method='nms', class_agnostic=True)),
+               ('soft-nms', dict(method='soft_nms'))]
+    rows = []
+    for num_boxes in args.num_boxes:
+        detections = _synthetic_detections(args.batch_size, num_boxes, args.num_classes, random_state)
+        for name, config in configs:
+            def run():
+                return postprocess_util.postprocess_detections(
+                    detections, min_score=args.min_score, max_detections=args.max_detections,
+                    pre_nms_top_k=args.pre_nms_top_k or None, **config)
+            seconds = _measure(run, args.repeats)
+            rows.append([num_boxes, name, '%.2f' % (1000 * seconds), '%.3f' % (1000 * seconds / args.batch_size),
+                         '%.1f' % run()['num_detections'].mean()])
+    print('Batch of %d images, min_score=%g, pre_nms_top_k=%s, median of %d repeats' %
+          (args.batch_size, args.min_score, args.pre_nms_top_k or 'all', args.repeats))
+    _print_table(['boxes/image', 'method', 'ms/batch', 'ms/image', 'kept/image'], rows)
+
+
+def benchmark_evaluator(args):
+    """Time util.eval_util.StreamingCocoEvaluator per 1k images on synthetic detections and groundtruth."""
+    from util import eval_util
+
+    random_state = np.random.RandomState(0)
+    evaluator = eval_util.StreamingCocoEvaluator(args.num_classes)
+    batch_size = 8
+    add_seconds = 0.0
+    for _ in range(0, args.num_images, batch_size):
+        detections = _synthetic_detections(batch_size, args.num_boxes, args.num_classes, random_state)
+        # groundtruth: a jittered subset of the detections
+        num_groundtruth = max(args.num_boxes // 10, 1)
+        groundtruth_boxes = detections['detection_boxes'][:, :num_groundtruth] + \
+            random_state.normal(scale=0.01, size=(batch_size, num_groundtruth, 4)).astype(np.float32)
+        groundtruth_classes = detections['detection_classes'][:, :num_groundtruth] + 1
+        start_time = time.perf_counter()
+        evaluator.add_batch(detections, groundtruth_boxes, groundtruth_classes, label_id_offset=1)
+        add_seconds += time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    metrics = evaluator.evaluate()
+    evaluate_seconds = time.perf_counter() - start_time
+    accumulator_bytes = evaluator._true_positives.nbytes + evaluator._false_positives.nbytes
+    print('%d images x %d detections, %d classes: mAP=%.4f' %
+          (evaluator.num_images, args.num_boxes, args.num_classes, metrics['mAP']))
+    _print_table(['stage', 'seconds', 's per 1k images'],
+                 [['add_batch', '%.3f' % add_seconds, '%.3f' % (1000 * add_seconds / evaluator.num_images)],
+                  ['evaluate', '%.3f' % evaluate_seconds, '-']])
+    print('Accumulators: %.1f MiB, independent of the number of images' % (accumulator_bytes / 2**20))
+
+
+def detector_run(args):
+    """Benchmark one detector configuration in this fresh process (spawned by benchmark_detector)."""
+    if args.cpus:
+        from shard_inference import parse_cpu_list
+        os.sched_setaffinity(0, parse_cpu_list(args.cpus))
+    import tensorflow as tf
+    # thread pools can only be sized before TensorFlow runs its first op
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+    import serve
+
+    result = {'status': 'ok'}
+    start_time = time.perf_counter()
+    batch_fn, max_batch_size = serve.load_detector(args.model, args.image_size)
+    result['load_seconds'] = time.perf_counter() - start_time
+    if max_batch_size is not None and args.batch_size > max_batch_size:
+        result['status'] = 'skipped: the model takes batches of at most %d' % max_batch_size
+    else:
+        # synthetic noise images, generated locally with a fixed seed
+        images = np.random.RandomState(0).randint(
+            0, 256, size=(args.batch_size, args.image_size, args.image_size, 3)).astype(np.float32)
+        # batch_fn returns numpy arrays, so every call waits for the device
+        for _ in range(args.warmup):
+            batch_fn(images)
+        latencies = []
+        for _ in range(args.iterations):
+            start_time = time.perf_counter()
+            batch_fn(images)
+            latencies.append(time.perf_counter() - start_time)
+        milliseconds = 1000 * np.array(latencies)
+        p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+        result.update({'mean_ms': float(milliseconds.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90),
+                       'p99_ms': float(p99), 'images_per_sec': args.batch_size * len(latencies) / sum(latencies)})
+    # ru_maxrss is in KiB on Linux
+    result['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(args.output, 'w') as f:
+        json.dump(result, f)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def benchmark_detector(args):
+    """Sweep models, batch sizes, resolutions and thread settings, one fresh process per configuration."""
+    commit = _git_commit()
+    output_dir = tempfile.mkdtemp()
+    results = []
+    for index, (model, batch_size, image_size, threads) in enumerate(
+            itertools.product(args.models, args.batch_sizes, args.image_sizes, args.threads)):
+        intra_op_threads, inter_op_threads = [int(v) for v in threads.split(':')]
+        config = {'commit': commit, 'host': platform.node(), 'model': model, 'batch_size': batch_size,
+                  'image_size': image_size, 'intra_op_threads': intra_op_threads,
+                  'inter_op_threads': inter_op_threads, 'cpus': args.cpus or '',
+                  'warmup': args.warmup, 'iterations': args.iterations}
+        output = os.path.join(output_dir, '%d.json' % index)
+        command = [sys.executable, os.path.abspath(__file__), 'detector_run', '--model', model,
+                   '--batch_size', str(batch_size), '--image_size', str(image_size),
+                   '--intra_op_threads', str(intra_op_threads), '--inter_op_threads', str(inter_op_threads),
+                   '--warmup', str(args.warmup), '--iterations', str(args.iterations), '--output', output]
+        if args.cpus:
+            command += ['--cpus', args.cpus]
+        print('Running %s' % ', '.join('%s=%s' % item for item in config.items() if item[0] not in ('commit', 'host')),
+              flush=True)
+        # a fresh process per configuration: thread pools are fixed at TF start and memory is not shared
+        if subprocess.run(command).returncode == 0:
+            with open(output) as f:
+                config.update(json.load(f))
+        else:
+            config['status'] = 'failed'
+        results.append(config)
+
+    columns = ['model', 'batch_size', 'image_size', 'intra_op_threads', 'inter_op_threads', 'p50_ms', 'p99_ms',
+               'images_per_sec', 'peak_rss_mib', 'status']
+    _print_table(columns, [['%.2f' % result[key] if isinstance(result.get(key), float) else result.get(key, '-')
+                            for key in columns] for result in results])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.csv:
+        fieldnames = list(dict.fromkeys(key for result in results for key in result))
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def _input_rate(dataset, num_batches, batch_size):
+    """Return the images/sec of iterating num_batches of a dataset, after one warmup batch."""
+    iterator = iter(dataset)
+    next(iterator)
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    return num_batches * batch_size / (time.perf_counter() - start_time)
+
+
+def benchmark_dataset(args):
+    """Time the TFRecord builder and compare the training input rate against decoding the source JPEGs."""
+    from PIL import Image
+    from util import data_util
+    from util import tfrecord_util
+
+    width, height = [int(v) for v in args.source_size.split('x')]
+    rng = np.random.RandomState(0)
+    temp_dir = tempfile.mkdtemp()
+    image_paths, boxes_list, classes_list = [], [], []
+    # smooth noise, so the JPEGs have a realistic size
+    base = Image.fromarray(rng.randint(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8))
+    base = base.resize((width, height), Image.BILINEAR)
+    for i in range(args.num_images):
+        image_path = os.path.join(temp_dir, 'image%05d.jpg' % i)
+        base.rotate(i % 360).save(image_path, quality=90)
+        corners = np.sort(rng.uniform(0.1, 0.9, size=(3, 2, 2)), axis=1)
+        image_paths.append(image_path)
+        boxes_list.append(corners.reshape(3, 4).astype(np.float32))
+        classes_list.append(rng.randint(1, 3, size=3).astype(np.int32))
+
+    build_rows, input_rows = [], []
+    input_rows.append(['source JPEGs (data_util.build_train_dataset)', '%.1f' % _input_rate(
+        data_util.build_train_dataset(image_paths, boxes_list, classes_list, args.batch_size, num_classes=2,
+                                      image_size=args.image_size),
+        args.num_batches, args.batch_size)])
+    for payload in tfrecord_util.PAYLOADS:
+        output_dir = os.path.join(temp_dir, 'tfrecord_' + payload)
+        info = tfrecord_util.write_tfrecord_shards(
+            image_paths, boxes_list, classes_list, output_dir, num_shards=args.num_shards,
+            image_size=args.image_size, payload=payload, num_workers=args.num_workers)
+        build_rows.append([payload, '%.2f' % info['build_seconds'],
+                           '%.1f' % (info['num_examples'] / info['build_seconds']),
+                           '%.1f' % (info['num_bytes'] / 2**20)])
+        input_rows.append(['TFRecord %s payload' % payload, '%.1f' % _input_rate(
+            tfrecord_util.build_tfrecord_train_dataset(output_dir, args.batch_size, num_classes=2),
+            args.num_batches, args.batch_size)])
+
+    print('%d synthetic %dx%d JPEGs resized to %d, %d shards, %s workers' %
+          (args.num_images, width, height, args.image_size, args.num_shards, args.num_workers or os.cpu_count()))
+    _print_table(['payload', 'build s', 'images/sec', 'MiB'], build_rows)
+    print('Training input rate over %d batches of %d:' % (args.num_batches, args.batch_size))
+    _print_table(['input pipeline', 'images/sec'], input_rows)
+
+
+def _parse_importtime(stderr):
+    """Parse `python -X importtime` output into [(module, self us, cumulative us, depth)]."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def benchmark_startup(args):
+    """Time the startup of the entry points, and list their heaviest top-level imports.
+
+    `{image}` in a command is replaced by a tiny synthetic JPEG, so that real
+    subcommand runs (model loading and one detection) are timed next to --help.
+    """
+    from PIL import Image
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    image_path = os.path.join(tempfile.mkdtemp(), 'tiny.jpg')
+    Image.fromarray(np.random.RandomState(0).randint(0, 256, size=(64, 64, 3), dtype=np.uint8)).save(image_path)
+    rows = []
+    for command in args.commands:
+        script_args = command.replace('{image}', image_path).split()
+        timings = []
+        for _ in range(args.repeats):
+            start_time = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime'] + script_args, cwd=repo_dir,
+                                     capture_output=True, text=True)
+            timings.append(time.perf_counter() - start_time)
+        imports = _parse_importtime(process.stderr)
+        top_level = sorted([item for item in imports if item[3] == 0], key=lambda item: -item[2])
+        status = 'ok' if process.returncode == 0 else 'exit %d' % process.returncode
+        rows.append([command, '%.3f' % min(timings), '%.3f' % (sum(item[2] for item in top_level) / 1e6),
+                     len(imports), status])
+        print('%s: heaviest top-level imports (cumulative ms)' % command, flush=True)
+        for name, _, cumulative_us, _ in top_level[:args.top]:
+            print('    %-40s %9.1f' % (name, cumulative_us / 1000.0), flush=True)
+        if process.returncode != 0:
+            print('    ' + (process.stderr.strip().splitlines() or [''])[-1], flush=True)
+    _print_table(['command', 'best wall s', 'import s', 'modules', 'status'], rows)
+
+
+def benchmark_server(args):
+    """Load-test a running serve.py over localhost at several concurrency levels."""
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    with open(args.image_path, 'rb') as f:
+        image_bytes = f.read()
+    url = 'http://%s:%d/detect' % (args.host, args.port)
+
+    def _request(_):
+        start_time = time.perf_counter()
+        request = urllib.request.Request(url, data=image_bytes, method='POST',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start_time
+
+    rows = []
+    for concurrency in args.concurrency:
+        # closed loop: each of the `concurrency` clients sends its next request
+        # as soon as the previous one is answered
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(_request, range(concurrency)))  # warmup
+            start_time = time.perf_counter()
+            latencies = np.array(list(executor.map(_request, range(args.requests))))
+            elapsed = time.perf_counter() - start_time
+        rows.append([concurrency, '%.1f' % (1000 * np.percentile(latencies, 50)),
+                     '%.1f' % (1000 * np.percentile(latencies, 99)), '%.2f' % (args.requests / elapsed)])
+    print('%d requests of %s to %s per concurrency level' % (args.requests, args.image_path, url))
+    _print_table(['concurrency', 'p50 ms', 'p99 ms', 'requests/sec'], rows)
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the train/inference hot paths.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    image_parser = subparsers.add_parser('image_loading', help='image decode into numpy arrays')
+    image_parser.add_argument('--image_path', default='./test_image/Naxos_Taverna.jpg')
+    image_parser.add_argument('--size', default=None,
+                              help='synthesize a WIDTHxHEIGHT JPEG instead of using --image_path')
+    image_parser.add_argument('--repeats', type=int, default=5)
+    image_parser.set_defaults(func=benchmark_image_loading)
+
+    image_run_parser = subparsers.add_parser('image_loading_run')  # internal, spawned by `image_loading`
+    image_run_parser.add_argument('--loader', choices=_IMAGE_LOADERS)
+    image_run_parser.add_argument('--image_path')
+    image_run_parser.add_argument('--repeats', type=int)
+    image_run_parser.add_argument('--output')
+    image_run_parser.set_defaults(func=image_loading_run)
+
+    train_parser = subparsers.add_parser('train_step', help='training step throughput')
+    train_parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    train_parser.add_argument('--batch_size', type=int, default=4)
+    train_parser.add_argument('--steps', type=int, default=20)
+    train_parser.add_argument('--warmup', type=int, default=2)
+    train_parser.set_defaults(func=benchmark_train_step)
+
+    draw_parser = subparsers.add_parser('draw_boxes', help='labeled box rendering')
+    draw_parser.add_argument('--sizes', nargs='+', default=['640x480', '1920x1080', '3840x2160'])
+    draw_parser.add_argument('--num_boxes', type=int, nargs='+', default=[1, 10, 100])
+    draw_parser.add_argument('--repeats', type=int, default=5)
+    draw_parser.set_defaults(func=benchmark_draw_boxes)
+
+    postprocess_parser = subparsers.add_parser('postprocess', help='score threshold, NMS and top-k')
+    postprocess_parser.add_argument('--num_boxes', type=int, nargs='+', default=[100, 1000, 10000])
+    postprocess_parser.add_argument('--batch_size', type=int, default=8)
+    postprocess_parser.add_argument('--num_classes', type=int, default=90)
+    postprocess_parser.add_argument('--min_score', type=float, default=0.05)
+    postprocess_parser.add_argument('--max_detections', type=int, default=100)
+    postprocess_parser.add_argument('--pre_nms_top_k', type=int, default=1000, help='0 keeps all candidates')
+    postprocess_parser.add_argument('--repeats', type=int, default=5)
+    postprocess_parser.set_defaults(func=benchmark_postprocess)
+
+    evaluator_parser = subparsers.add_parser('evaluator', help='streaming mAP evaluator wall time')
+    evaluator_parser.add_argument('--num_images', type=int, default=1000)
+    evaluator_parser.add_argument('--num_boxes', type=int, default=100, help='detections per image')
+    evaluator_parser.add_argument('--num_classes', type=int, default=90)
+    evaluator_parser.set_defaults(func=benchmark_evaluator)
+
+    detector_parser = subparsers.add_parser('detector', help='detector latency/throughput sweep')
+    detector_parser.add_argument('--models', nargs='+', default=['efficientdet_d0_coco17_tpu-32'],
+                                 help="checkpoint model names, exported SavedModel/.tflite paths or "
+                                      "'hub:<handle>', e.g. hub:./model/efficientdet_d6_1")
+    detector_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4])
+    detector_parser.add_argument('--image_sizes', type=int, nargs='+', default=[512])
+    detector_parser.add_argument('--threads', nargs='+', default=['0:0'],
+                                 help='INTRA:INTER op thread settings, 0 meaning the TensorFlow default')
+    detector_parser.add_argument('--cpus', default=None, help='pin the runs to these CPUs, e.g. 0-3')
+    detector_parser.add_argument('--warmup', type=int, default=3)
+    detector_parser.add_argument('--iterations', type=int, default=20)
+    detector_parser.add_argument('--csv', default=None, help='optional .csv file for the results')
+    detector_parser.add_argument('--json', default=None, help='optional .json file for the results')
+    detector_parser.set_defaults(func=benchmark_detector)
+
+    detector_run_parser = subparsers.add_parser('detector_run')  # internal, spawned by `detector`
+    detector_run_parser.add_argument('--model')
+    detector_run_parser.add_argument('--batch_size', type=int)
+    detector_run_parser.add_argument('--image_size', type=int)
+    detector_run_parser.add_argument('--intra_op_threads', type=int)
+    detector_run_parser.add_argument('--inter_op_threads', type=int)
+    detector_run_parser.add_argument('--cpus', default=None)
+    detector_run_parser.add_argument('--warmup', type=int)
+    detector_run_parser.add_argument('--iterations', type=int)
+    detector_run_parser.add_argument('--output')
+    detector_run_parser.set_defaults(func=detector_run)
+
+    dataset_parser = subparsers.add_parser('dataset', help='TFRecord builder and training input rate')
+    dataset_parser.add_argument('--num_images', type=int, default=256)
+    dataset_parser.add_argument('--source_size', default='1920x1080', help='WIDTHxHEIGHT of the source JPEGs')
+    dataset_parser.add_argument('--image_size', type=int, default=640)
+    dataset_parser.add_argument('--num_shards', type=int, default=16)
+    dataset_parser.add_argument('--num_workers', type=int, default=None, help='builder processes')
+    dataset_parser.add_argument('--batch_size', type=int, default=8)
+    dataset_parser.add_argument('--num_batches', type=int, default=50)
+    dataset_parser.set_defaults(func=benchmark_dataset)
+
+    startup_parser = subparsers.add_parser('startup', help='entry point startup time (python -X importtime)')
+    startup_parser.add_argument('--commands', nargs='+',
+                                default=['inference.py batch --help', 'inference.py image --help',
+                                         'inference.py image --no_display --image {image}',
+                                         'inference_tfhub.py detect --help',
+                                         'inference_tfhub.py detect --no_render --image {image}',
+                                         'stream.py --help', 'serve.py --help', 'evaluate.py --help'],
+                                help='script and arguments to start, in quotes; {image} is a tiny test JPEG')
+    startup_parser.add_argument('--repeats', type=int, default=3, help='the best wall time is reported')
+    startup_parser.add_argument('--top', type=int, default=10, help='the number of imports listed per command')
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    server_parser = subparsers.add_parser('server', help='latency/throughput of a running serve.py')
+    server_parser.add_argument('--host', default='127.0.0.1')
+    server_parser.add_argument('--port', type=int, default=8080)
+    server_parser.add_argument('--image_path', default='./test_image/Naxos_Taverna.jpg')
+    server_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    server_parser.add_argument('--requests', type=int, default=200)
+    server_parser.set_defaults(func=benchmark_server)
+
+    args = parser.parse_args()
+    args.func(args)
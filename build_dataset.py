@@ -0,0 +1,59 @@
+'''
+This code is for converting images and their annotations (COCO JSON, Pascal VOC or a .jsonl manifest)
+into sharded TFRecords of pre-resized images for train.py (see util/tfrecord_util.py).
+'''
+import argparse
+import os
+
+from util import data_util
+from util import label_util
+from util import tfrecord_util
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a sharded TFRecord training dataset.')
+    parser.add_argument('--annotations', required=True,
+                        help='COCO instances .json, Pascal VOC directory (Annotations/, JPEGImages/) '
+                             'or .jsonl manifest (see util/data_util.py)')
+    parser.add_argument('--image_dir', default=None, help='the root of the COCO file_name paths')
+    parser.add_argument('--voc_image_set', default=None, help="e.g. 'train' for ImageSets/Main/train.txt")
+    parser.add_argument('--label_map', default=None,
+                        help='class names (.pbtxt or .txt) stored with the dataset; for VOC, the classes kept '
+                             '(ids 1, 2, ... in label map id order)')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--num_shards', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=640)
+    parser.add_argument('--payload', default='jpeg', choices=tfrecord_util.PAYLOADS,
+                        help='jpeg: re-encoded, small; raw: uint8 pixels, no decode when training')
+    parser.add_argument('--jpeg_quality', type=int, default=95)
+    parser.add_argument('--num_workers', type=int, default=None, help='processes, defaults to the CPU count')
+    args = parser.parse_args()
+
+    class_names = None
+    if args.label_map:
+        labels = label_util.load_labels(args.label_map)
+        class_names = [labels[class_id] for class_id in sorted(labels)]
+    if os.path.isdir(args.annotations):
+        image_paths, boxes_list, classes_list, class_names = data_util.load_voc_annotations(
+            args.annotations, class_names, args.voc_image_set)
+    elif args.annotations.endswith('.json'):
+        image_paths, boxes_list, classes_list, class_names = data_util.load_coco_annotations(
+            args.annotations, args.image_dir or os.path.dirname(args.annotations))
+    else:
+        image_paths, boxes_list, classes_list = data_util.load_manifest(args.annotations)
+    print('Writing %d images with %d boxes......' % (len(image_paths), sum(len(c) for c in classes_list)),
+          flush=True)
+
+    info = tfrecord_util.write_tfrecord_shards(
+        image_paths, boxes_list, classes_list, args.output_dir,
+        num_shards=args.num_shards,
+        split=args.split,
+        image_size=args.image_size,
+        payload=args.payload,
+        jpeg_quality=args.jpeg_quality,
+        num_workers=args.num_workers,
+        class_names=class_names)
+    print('%d images in %d shards (%.1f MiB) in %.2f s: %.1f images/sec' %
+          (info['num_examples'], info['num_shards'], info['num_bytes'] / 2**20, info['build_seconds'],
+           info['num_examples'] / info['build_seconds']))
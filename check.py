@@ -0,0 +1,223 @@
+'''
+This code is for numerical sanity checks of the optional train/inference modes.
+
+Usage:
+    python check.py mixed_precision [--model_name NAME] [--num_batches 10] [--rtol 0.05]
+    python check.py export [--model_name NAME] [--saved_model DIR] [--tflite FILE]
+    python check.py eval
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# the box/class head variables fine-tuned by train.py
+_PREFIXES_TO_TRAIN = ['WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalBoxHead',
+                      'WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalClassHead']
+
+
+def _print_table(header, rows):
+    """Print rows of a result table with aligned columns."""
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)), flush=True)
+
+
+def _fine_tune_box_losses(args, batches, eval_batch, policy_name, jit_compile):
+    """Fine-tune on `batches` and return the box-head loss on `eval_batch` after each step."""
+    import tensorflow as tf
+    import train
+
+    tf.keras.backend.clear_session()
+    tf.keras.mixed_precision.set_global_policy(policy_name)
+    # the class head is initialized from scratch, seed it identically for every run
+    tf.keras.utils.set_random_seed(args.seed)
+
+    model_dir = os.path.join('./object_detection/test_data/', args.model_name)
+    detection_model, _ = train.build_fine_tune_model(
+        os.path.join(model_dir, 'pipeline.config'),
+        os.path.join(model_dir, 'checkpoint', 'ckpt-0'),
+        num_classes=1)
+    to_fine_tune = train.get_fine_tune_variables(detection_model, _PREFIXES_TO_TRAIN)
+    optimizer = tf.keras.optimizers.SGD(learning_rate=args.learning_rate, momentum=0.9)
+    if policy_name != 'float32':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    train_step_fn = train.get_model_train_step_function(
+        detection_model, optimizer, to_fine_tune,
+        batch_size=args.batch_size, num_classes=1, jit_compile=jit_compile)
+
+    @tf.function
+    def box_loss_fn(images, boxes, classes_one_hot, num_boxes):
+        train.provide_padded_groundtruth(detection_model, boxes, classes_one_hot, num_boxes)
+        return train.compute_losses(detection_model, images)['Loss/localization_loss']
+
+    box_losses = []
+    for batch in batches:
+        train_step_fn(*batch)
+        box_losses.append(float(box_loss_fn(*eval_batch)))
+    tf.keras.mixed_precision.set_global_policy('float32')
+    return np.array(box_losses)
+
+
+def check_mixed_precision(args):
+    """Check that mixed precision + XLA fine-tuning tracks the float32 box-head loss."""
+    from util import data_util
+
+    batches = [data_util.make_synthetic_batch(args.batch_size, num_classes=1, seed=seed)
+               for seed in range(args.num_batches)]
+    eval_batch = data_util.make_synthetic_batch(args.batch_size, num_classes=1, seed=args.num_batches)
+
+    baseline = _fine_tune_box_losses(args, batches, eval_batch, 'float32', jit_compile=False)
+    mixed = _fine_tune_box_losses(args, batches, eval_batch, args.policy, jit_compile=True)
+    relative_error = np.abs(mixed - baseline) / np.maximum(np.abs(baseline), 1e-6)
+
+    rows = [[idx, '%.5f' % b, '%.5f' % m, '%.4f' % e]
+            for idx, (b, m, e) in enumerate(zip(baseline, mixed, relative_error))]
+    _print_table(['batch', 'float32', args.policy + '+xla', 'rel. error'], rows)
+    if np.all(relative_error <= args.rtol):
+        print('OK: box-head loss within rtol=%g of the float32 baseline.' % args.rtol)
+    else:
+        print('FAILED: box-head loss deviates by up to %.4f (rtol=%g).' % (relative_error.max(), args.rtol))
+        sys.exit(1)
+
+
+def cold_start(args):
+    """Run one detection from a fresh process and save the detections (spawned by check_export)."""
+    import tensorflow as tf
+    from util import export_util
+    from util import image_util
+
+    image_np = image_util.load_image_into_numpy_array(args.image_path)
+    padded, _ = image_util.resize_and_pad(image_np, args.image_size, args.image_size)
+    if args.mode == 'checkpoint':
+        import inference
+        detection_model, _ = inference.build_detection_model(args.model_name)
+        detect_fn = inference.get_model_detection_function(detection_model)
+    else:
+        detect_fn = export_util.load_exported_detection_function(args.artifact)
+    detections, _, _ = detect_fn(tf.constant(padded[np.newaxis], dtype=tf.float32))
+    np.savez(args.output, **{key: detections[key].numpy() for key in export_util.DETECTION_KEYS})
+
+
+def check_export(args):
+    """Compare cold-start time and detections of the checkpoint path and the exported artifacts."""
+    runs = [('checkpoint', None)]
+    if args.saved_model:
+        runs.append(('saved_model', args.saved_model))
+    if args.tflite:
+        runs.append(('tflite', args.tflite))
+
+    output_dir = tempfile.mkdtemp()
+    results = {}
+    rows = []
+    for mode, artifact in runs:
+        output = os.path.join(output_dir, mode + '.npz')
+        command = [sys.executable, os.path.abspath(__file__), 'cold_start', '--mode', mode,
+                   '--model_name', args.model_name, '--image_path', args.image_path,
+                   '--image_size', str(args.image_size), '--output', output]
+        if artifact:
+            command += ['--artifact', artifact]
+        # the wall time of the whole process: interpreter start, imports, model load, first detection
+        start_time = time.perf_counter()
+        subprocess.run(command, check=True)
+        cold_start_seconds = time.perf_counter() - start_time
+        results[mode] = dict(np.load(output))
+
+        reference = results['checkpoint']
+        keep = reference['detection_scores'][0] >= args.min_score
+        detections = {key: value[0][keep] for key, value in results[mode].items() if key != 'num_detections'}
+        reference = {key: value[0][keep] for key, value in reference.items() if key != 'num_detections'}
+        rows.append([mode, '%.2f' % cold_start_seconds, int(keep.sum()),
+                     '%.4f' % np.abs(detections['detection_boxes'] - reference['detection_boxes']).max(initial=0),
+                     '%.4f' % np.abs(detections['detection_scores'] - reference['detection_scores']).max(initial=0),
+                     '%.2f' % np.mean(detections['detection_classes'] == reference['detection_classes'])
+                     if keep.any() else '-'])
+    print('Detections compared against the checkpoint path for its %d boxes with score >= %g' %
+          (rows[0][2], args.min_score))
+    _print_table(['model', 'cold start s', 'boxes', 'max box diff', 'max score diff', 'class agreement'], rows)
+
+
+def check_eval(args):
+    """Check util.eval_util against mAP values computed by hand on a two-image fixture.
+
+    Image 0 has two class-1 boxes A and B. The detections are, by score: A
+    exactly (.9), a box with IoU 0.64 with B (.8), a box overlapping nothing
+    (.7). Image 1 has one class-2 box C, detected exactly as class 2 (.6) and
+    also as class 1 (.5).
+
+    Class 2 has AP 1 at every IoU threshold. Class 1 (2 groundtruth boxes,
+    detections TP/TP-or-FP/FP/FP) has AP 1 at IoU .50/.55/.60, where the
+    second detection matches. Above .64 only the first one does, so recall
+    stops at .5 and AP = 51/101 (recall points 0, .01, ..., .5). Hence:
+        class 1 AP = (3 + 7 * 51/101) / 10 = 660/1010
+        mAP = (660/1010 + 1) / 2, mAP@.50 = 1, mAP@.75 = (51/101 + 1) / 2
+    """
+    from util import eval_util
+
+    evaluator = eval_util.StreamingCocoEvaluator(num_classes=2)
+    box_a, box_b, box_c = [0.0, 0.0, 0.5, 0.5], [0.5, 0.5, 1.0, 1.0], [0.1, 0.1, 0.4, 0.4]
+    # [.5, .5, 1, .82] covers 0.5 x 0.32 = 0.16 of B (area 0.25): IoU 0.64
+    detections = {
+        'detection_boxes': np.array([[box_a, [0.5, 0.5, 1.0, 0.82], [0.0, 0.6, 0.3, 0.9], [0, 0, 0, 0]],
+                                     [box_c, box_c, [0, 0, 0, 0], [0, 0, 0, 0]]]),
+        'detection_scores': np.array([[0.9, 0.8, 0.7, 0.0], [0.6, 0.5, 0.0, 0.0]]),
+        'detection_classes': np.array([[0, 0, 0, 0], [1, 0, 0, 0]]),  # 0-based, as the models output
+        'num_detections': np.array([3, 2]),
+    }
+    evaluator.add_batch(detections, [np.array([box_a, box_b]), np.array([box_c])],
+                        [np.array([1, 1]), np.array([2])], label_id_offset=1)
+    metrics = evaluator.evaluate()
+
+    class_1_ap = (3 + 7 * 51 / 101) / 10
+    expected = {'mAP': (class_1_ap + 1) / 2, 'mAP@0.50': 1.0, 'mAP@0.75': (51 / 101 + 1) / 2}
+    rows = [[key, '%.6f' % expected[key], '%.6f' % metrics[key]] for key in expected]
+    _print_table(['metric', 'hand-computed', 'eval_util'], rows)
+    if all(abs(metrics[key] - expected[key]) < 1e-6 for key in expected):
+        print('OK: eval_util matches the hand-computed fixture.')
+    else:
+        print('FAILED: eval_util deviates from the hand-computed fixture.')
+        sys.exit(1)
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Numerical checks for the optional train/inference modes.')
+    subparsers = parser.add_subparsers(dest='check', required=True)
+
+    mp_parser = subparsers.add_parser('mixed_precision', help='mixed precision + XLA against float32')
+    mp_parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    mp_parser.add_argument('--policy', default='mixed_bfloat16', choices=['mixed_bfloat16', 'mixed_float16'])
+    mp_parser.add_argument('--batch_size', type=int, default=2)
+    mp_parser.add_argument('--num_batches', type=int, default=10)
+    mp_parser.add_argument('--learning_rate', type=float, default=0.01)
+    mp_parser.add_argument('--rtol', type=float, default=0.05)
+    mp_parser.add_argument('--seed', type=int, default=0)
+    mp_parser.set_defaults(func=check_mixed_precision)
+
+    export_parser = subparsers.add_parser('export', help='exported artifacts against the checkpoint path')
+    export_parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    export_parser.add_argument('--saved_model', default=None, help='SavedModel directory from export_model.py')
+    export_parser.add_argument('--tflite', default=None, help='.tflite file from export_model.py --tflite')
+    export_parser.add_argument('--image_path', default='./test_image/Naxos_Taverna.jpg')
+    export_parser.add_argument('--image_size', type=int, default=512)
+    export_parser.add_argument('--min_score', type=float, default=0.3)
+    export_parser.set_defaults(func=check_export)
+
+    eval_parser = subparsers.add_parser('eval', help='streaming mAP evaluator against a hand-computed fixture')
+    eval_parser.set_defaults(func=check_eval)
+
+    cold_start_parser = subparsers.add_parser('cold_start')  # internal, spawned by `export`
+    cold_start_parser.add_argument('--mode', choices=['checkpoint', 'saved_model', 'tflite'])
+    cold_start_parser.add_argument('--artifact', default=None)
+    cold_start_parser.add_argument('--model_name')
+    cold_start_parser.add_argument('--image_path')
+    cold_start_parser.add_argument('--image_size', type=int)
+    cold_start_parser.add_argument('--output')
+    cold_start_parser.set_defaults(func=cold_start)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,101 @@
+'''
+This code is for measuring the COCO-style mAP of the inference.py model on our own annotated images.
+
+The images of a .jsonl manifest (see util/data_util.py) are run through the
+model batch by batch and the detections are streamed into
+util.eval_util.StreamingCocoEvaluator, so memory does not grow with the
+number of images.
+'''
+import argparse
+import json
+import time
+
+import numpy as np
+
+import tensorflow as tf
+
+from inference import build_detection_model, get_model_detection_function
+from util import data_util
+from util import eval_util
+from util import export_util
+from util import image_util
+from util import pipeline_util
+from util import profile_util
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COCO-style mAP@[.5:.95] on a groundtruth manifest.')
+    parser.add_argument('--manifest', required=True, help='.jsonl manifest with groundtruth boxes and classes')
+    parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    parser.add_argument('--exported_model', default=None, help='SavedModel directory or .tflite file')
+    parser.add_argument('--num_classes', type=int, default=None, help='defaults to the model num_classes')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=4, help='decode/resize threads')
+    parser.add_argument('--max_detections', type=int, default=100)
+    parser.add_argument('--report', default=None, help='optional .json file for the metrics')
+    args = parser.parse_args()
+
+    image_paths, boxes_list, classes_list = data_util.load_manifest(args.manifest)
+    if args.exported_model:
+        max_batch_size = export_util.exported_max_batch_size(args.exported_model)
+        if max_batch_size is not None and args.batch_size > max_batch_size:
+            print('%s only accepts batches of %d, batch_size lowered accordingly.' %
+                  (args.exported_model, max_batch_size))
+            args.batch_size = max_batch_size
+        detect_fn = export_util.load_exported_detection_function(args.exported_model)
+        num_classes = args.num_classes or int(max(np.max(c, initial=1) for c in classes_list))
+    else:
+        detection_model, configs = build_detection_model(args.model_name)
+        detect_fn = get_model_detection_function(
+            detection_model, [args.batch_size, args.image_size, args.image_size, 3])
+        num_classes = args.num_classes or configs['model'].ssd.num_classes
+
+    evaluator = eval_util.StreamingCocoEvaluator(num_classes, max_detections=args.max_detections)
+    timer = profile_util.Profiler()
+
+    def _load(index):
+        return index, image_util.load_resized_image(image_paths[index], args.image_size)
+
+    batch_np = np.zeros((args.batch_size, args.image_size, args.image_size, 3), dtype=np.float32)
+    start_time = time.perf_counter()
+    loaded = pipeline_util.bounded_map(_load, range(len(image_paths)), args.num_workers, 4 * args.batch_size)
+    for batch in pipeline_util.batched(loaded, args.batch_size):
+        for i, (_, (image, _, _)) in enumerate(batch):
+            batch_np[i] = image
+        batch_np[len(batch):] = 0
+        detections, _, _ = timer.time('predict', detect_fn, tf.convert_to_tensor(batch_np), count=len(batch))
+        detections = {key: np.array(detections[key][:len(batch)])
+                      for key in ['detection_boxes', 'detection_scores', 'detection_classes']}
+        # back from the padded square to the original image frame of the groundtruth
+        for i, (_, (_, valid_fraction, _)) in enumerate(batch):
+            detections['detection_boxes'][i] = image_util.unpad_boxes(detections['detection_boxes'][i],
+                                                                      valid_fraction)
+        indices = [index for index, _ in batch]
+        timer.time('evaluate', evaluator.add_batch, detections,
+                   [boxes_list[index] for index in indices], [classes_list[index] for index in indices],
+                   1, count=len(batch))
+    elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    metrics = evaluator.evaluate()
+    timer.add('accumulate', time.perf_counter() - start_time, count=0)
+
+    num_images = evaluator.num_images
+    print('%d images in %.2f s' % (num_images, elapsed))
+    print('mAP@[.5:.95]=%.4f  mAP@.50=%.4f  mAP@.75=%.4f' %
+          (metrics['mAP'], metrics['mAP@0.50'], metrics['mAP@0.75']))
+    evaluation_seconds = timer.seconds['evaluate'] + timer.seconds['accumulate']
+    print('Evaluator wall time: %.3f s per 1k images (matching + final accumulation)' %
+          (1000 * evaluation_seconds / max(num_images, 1)))
+    for line in timer.report():
+        print('  ' + line)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'num_images': num_images,
+                       'mAP': metrics['mAP'],
+                       'mAP@0.50': metrics['mAP@0.50'],
+                       'mAP@0.75': metrics['mAP@0.75'],
+                       'per_class_AP': [None if np.isnan(ap) else float(ap) for ap in metrics['per_class_AP']],
+                       'evaluator_seconds_per_1k_images': 1000 * evaluation_seconds / max(num_images, 1)},
+                      f, indent=2)
@@ -0,0 +1,32 @@
+'''
+This code is for exporting the detection model restored by inference.py as a SavedModel and TFLite model.
+'''
+import argparse
+import os
+
+from inference import build_detection_model
+from util import export_util
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a restored detection model for fast cold start.')
+    parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    parser.add_argument('--output_dir', default=None, help='defaults to ./exported/<model_name>')
+    parser.add_argument('--tflite', action='store_true',
+                        help='also write a dynamic-range quantized model.tflite')
+    parser.add_argument('--tflite_image_size', type=int, default=512)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join('./exported', args.model_name)
+
+    print('Building model and restoring weights......', flush=True)
+    detection_model, _ = build_detection_model(args.model_name)
+
+    saved_model_dir = os.path.join(output_dir, 'saved_model')
+    export_util.export_saved_model(detection_model, saved_model_dir)
+    print('SavedModel written to ' + saved_model_dir)
+
+    if args.tflite:
+        tflite_path = os.path.join(output_dir, 'model.tflite')
+        num_bytes = export_util.export_tflite(detection_model, tflite_path, args.tflite_image_size)
+        print('TFLite model (%.1f MiB) written to %s' % (num_bytes / 2**20, tflite_path))
@@ -1,43 +1,29 @@
 '''
 This code is for using TensorFlow 2.X object detection API to run inference on the customized dataset.
-'''
-import matplotlib
-import matplotlib.pyplot as plt
 
-import io
+Usage:
+    python inference.py image [--buckets 512x512,768x1024] [--exported_model DIR_OR_TFLITE]
+    python inference.py batch --input ./images/ [--output detections.jsonl] [--tile_size 512]
+
+TensorFlow, the TensorFlow-backed util modules, the object detection API
+builders, matplotlib and the visualization utilities are imported by the code
+paths that use them, so importing this module (as evaluate.py, serve.py... do),
+--help or a bad argument stays fast.
+'''
+import argparse
+import collections
+import json
 import os
-import scipy.misc
+import time
 import numpy as np
-from six import BytesIO
-from PIL import Image, ImageDraw, ImageFont
-import pdb
 
-import tensorflow as tf
-
-from object_detection.utils import label_map_util
-from object_detection.utils import config_util
-from object_detection.utils import visualization_utils as viz_utils
-from object_detection.builders import model_builder
+# TensorFlow-free utilities, cheap to import
+from util import label_util
+from util import pipeline_util
+from util import postprocess_util
+from util import tile_util
 
 # utilities
-def load_image_into_numpy_array(path):
-    """Load an image from file into a numpy array.
-
-    Puts image into numpy array to feed into tensorflow graph.
-    Note that by convention we put it into a numpy array with shape
-    (height, width, channels), where channels=3 for RGB.
-
-    Args:
-        path: the file path to the image
-
-    Returns:
-        uint8 numpy array with shape (img_height, img_width, 3)
-    """
-    img_data = tf.io.gfile.GFile(path, 'rb').read()
-    image = Image.open(BytesIO(img_data))
-    (im_width, im_height) = image.size
-    return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
-
 def get_keypoint_tuples(eval_config):
     """Return a tuple list of keypoint edges from the eval config.
   
@@ -53,10 +39,19 @@ def get_keypoint_tuples(eval_config):
         tuple_list.append((edge.start, edge.end))
     return tuple_list
 
-def get_model_detection_function(model):
-    """Get a tf.function for detection."""
+def get_model_detection_function(model, input_shape=None):
+    """Get a tf.function for detection.
 
-    @tf.function
+    Args:
+        model: the detection model.
+        input_shape: optional static input shape, e.g. [None, 512, 512, 3]. When
+        given, the function carries an input_signature and is traced only once.
+    """
+    import tensorflow as tf
+
+    input_signature = None if input_shape is None else [tf.TensorSpec(input_shape, tf.float32)]
+
+    @tf.function(input_signature=input_signature)
     def detect_fn(image):
         """Detect objects in image."""
 
@@ -68,16 +63,84 @@ def get_model_detection_function(model):
 
     return detect_fn
 
-# main function:
-if __name__ == '__main__':
-    # download the checkpoint and put it into models/research/object_detection/test_data/
-    # @title Choose the model to use, then evaluate the cell.
-    model_display_name = 'efficientdet_d0' 
-    model_name = 'efficientdet_d0_coco17_tpu-32'
+class BucketedDetectionFunction(object):
+    """Detection over a small, fixed set of input shapes so that nothing is retraced.
+
+    Each input image is resized (keeping its aspect ratio) and padded to the
+    smallest configured bucket that holds it, or to the largest bucket if none
+    does. Every bucket has its own signature-fixed detection function, traced
+    once by warmup() with a dummy tensor, so mixed-resolution streams never pay
+    for tracing at request time.
+
+    Args:
+        model: the detection model.
+        buckets: a list of (height, width) input shapes.
+    """
 
-    # build a detection model and load pre-trained model weights
-    pipeline_config = os.path.join('./object_detection/test_data/', model_name, 'pipeline.config')
-    model_dir = os.path.join('./object_detection/test_data/', model_name, 'checkpoint')
+    def __init__(self, model, buckets):
+        self.buckets = sorted(buckets, key=lambda bucket: bucket[0] * bucket[1])
+        self._detect_fns = {bucket: get_model_detection_function(model, [None, bucket[0], bucket[1], 3])
+                            for bucket in self.buckets}
+        self.first_call_seconds = {}
+
+    def warmup(self):
+        """Trace and run every bucket once, recording its first-call latency."""
+        import tensorflow as tf
+
+        for bucket, detect_fn in self._detect_fns.items():
+            start_time = time.perf_counter()
+            detections, _, _ = detect_fn(tf.zeros([1, bucket[0], bucket[1], 3]))
+            detections['detection_scores'].numpy()
+            self.first_call_seconds[bucket] = time.perf_counter() - start_time
+
+    @property
+    def trace_counts(self):
+        """The number of times each bucket's function has been traced."""
+        return {bucket: detect_fn.experimental_get_tracing_count()
+                for bucket, detect_fn in self._detect_fns.items()}
+
+    def select_bucket(self, height, width):
+        """Return the smallest bucket holding a height x width image, else the largest."""
+        for bucket in self.buckets:
+            if height <= bucket[0] and width <= bucket[1]:
+                return bucket
+        return self.buckets[-1]
+
+    def __call__(self, image_np):
+        """Detect objects in one uint8 [H, W, 3] image.
+
+        Returns:
+            the detections dict of numpy arrays with a batch dimension of 1, with
+            detection_boxes normalized to the original (unpadded) image.
+        """
+        import tensorflow as tf
+        from util import image_util
+
+        bucket = self.select_bucket(image_np.shape[0], image_np.shape[1])
+        padded, valid_fraction = image_util.resize_and_pad(image_np, bucket[0], bucket[1])
+        detections, _, _ = self._detect_fns[bucket](tf.convert_to_tensor(padded[np.newaxis], dtype=tf.float32))
+        detections = {key: value.numpy() for key, value in detections.items()}
+        detections['detection_boxes'] = image_util.unpad_boxes(detections['detection_boxes'], valid_fraction)
+        return detections
+
+def build_detection_model(model_name, model_root='./object_detection/test_data/'):
+    """Build a detection model from its pipeline.config and restore its checkpoint.
+
+    Args:
+        model_name: the model directory name under model_root, holding
+        pipeline.config and checkpoint/ckpt-0.
+        model_root: the directory holding the downloaded models.
+
+    Returns:
+        detection_model: the restored detection model.
+        configs: the pipeline configs dict.
+    """
+    import tensorflow as tf
+    from object_detection.utils import config_util
+    from object_detection.builders import model_builder
+
+    pipeline_config = os.path.join(model_root, model_name, 'pipeline.config')
+    model_dir = os.path.join(model_root, model_name, 'checkpoint')
 
     # load pipeline config and build a detection model
     configs = config_util.get_configs_from_pipeline_file(pipeline_config)
@@ -87,29 +150,396 @@ if __name__ == '__main__':
     # restore checkpoint
     ckpt = tf.compat.v2.train.Checkpoint(model=detection_model)
     ckpt.restore(os.path.join(model_dir, 'ckpt-0')).expect_partial()
+    return detection_model, configs
+
+def _open_detection_writer(output_path):
+    """Return (write_fn, close_fn) appending detection records to a .jsonl or .parquet file."""
+    if output_path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([('image_path', pa.string()),
+                            ('height', pa.int32()),
+                            ('width', pa.int32()),
+                            ('detection_boxes', pa.list_(pa.list_(pa.float32()))),
+                            ('detection_scores', pa.list_(pa.float32())),
+                            ('detection_classes', pa.list_(pa.int32()))])
+        parquet_writer = pq.ParquetWriter(output_path, schema)
+        rows = []
+
+        def _flush():
+            parquet_writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            del rows[:]
+
+        def write_fn(record):
+            rows.append(record)
+            if len(rows) >= 1024:  # one row group per 1024 images keeps memory flat
+                _flush()
+
+        def close_fn():
+            if rows:
+                _flush()
+            parquet_writer.close()
+
+        return write_fn, close_fn
+
+    f = open(output_path, 'w')
+
+    def write_fn(record):
+        f.write(json.dumps(record) + '\n')
 
-    detect_fn = get_model_detection_function(detection_model)
+    return write_fn, f.close
+
+def _skip_unreadable_image(image_path, error):
+    """The default on_error of the batch runs: log the image that failed to load and go on."""
+    print('Skipping %s: %s: %s' % (image_path, type(error).__name__, error), flush=True)
+
+def run_batch_inference(detect_fn,
+                        image_paths,
+                        output_path,
+                        batch_size=8,
+                        image_size=512,
+                        num_workers=4,
+                        queue_size=64,
+                        min_score=0.3,
+                        label_id_offset=1,
+                        nms_method='none',
+                        iou_threshold=0.5,
+                        profiler=None,
+                        on_error=_skip_unreadable_image):
+    """Run headless detection over many images and stream the results to a file.
+
+    Images are decoded and resized by a thread pool, grouped into fixed-size
+    batches for detect_fn and the detections are written by a background thread
+    to JSON Lines or Parquet. The queues between the stages are bounded, so
+    memory stays flat however many images there are.
+
+    Args:
+        detect_fn: a detection function from get_model_detection_function().
+        image_paths: an iterable of image file paths.
+        output_path: a .jsonl or .parquet file for the detections.
+        batch_size: the number of images per detect_fn call; the last batch is
+        zero-padded so detect_fn always sees the same shape.
+        image_size: images are resized (keeping aspect ratio) and padded to this size.
+        num_workers: the number of decode/resize threads.
+        queue_size: the bound of the decoded-image and output queues.
+        min_score: detections below this score are not written.
+        label_id_offset: added to the 0-based model classes to get label map ids.
+        nms_method: extra suppression on top of the model's own, one of
+        postprocess_util.NMS_METHODS.
+        iou_threshold: the IoU threshold of nms_method 'nms'.
+        profiler: a profile_util.Profiler recording the decode/predict/
+        postprocess/io stages, one step per batch; a new one by default.
+        on_error: called with (image path, exception) for the images that fail
+        to load, which get no record; logs them by default. None stops the run
+        on the first unreadable image instead.
+
+    Returns:
+        (number of images, wall time in seconds, profile_util.Profiler)
+    """
+    import tensorflow as tf
+    from util import image_util
+    from util import profile_util
+
+    profiler = profiler or profile_util.Profiler()
+    write_fn, close_fn = _open_detection_writer(output_path)
+    writer = pipeline_util.BackgroundWriter(
+        lambda record: profiler.time('io', write_fn, record),
+        max_queue_size=queue_size, close_fn=close_fn)
+
+    def _load(image_path):
+        return image_path, profiler.time('decode', image_util.load_resized_image, image_path, image_size)
+
+    def _predict(batch_np):
+        detections, _, _ = detect_fn(tf.convert_to_tensor(batch_np))
+        # .numpy() waits for the result, so the stage time covers the whole call
+        return {key: detections[key].numpy()
+                for key in ['detection_boxes', 'detection_scores', 'detection_classes']}
+
+    def _postprocess(batch, detections):
+        # score threshold (and optional NMS) over the whole batch at once
+        detections = postprocess_util.postprocess_detections(
+            {key: value[:len(batch)] for key, value in detections.items()},
+            min_score=min_score, method=nms_method, iou_threshold=iou_threshold,
+            max_detections=detections['detection_scores'].shape[1])
+        classes = detections['detection_classes'].astype(np.int32) + label_id_offset
+        records = []
+        for i, (image_path, (_, valid_fraction, original_shape)) in enumerate(batch):
+            num = detections['num_detections'][i]
+            boxes = image_util.unpad_boxes(detections['detection_boxes'][i, :num], valid_fraction)
+            records.append({'image_path': image_path,
+                            'height': int(original_shape[0]),
+                            'width': int(original_shape[1]),
+                            'detection_boxes': boxes.tolist(),
+                            'detection_scores': detections['detection_scores'][i, :num].tolist(),
+                            'detection_classes': classes[i, :num].tolist()})
+        return records
+
+    num_images = 0
+    batch_np = np.zeros((batch_size, image_size, image_size, 3), dtype=np.float32)
+    start_time = time.perf_counter()
+    try:
+        loaded = pipeline_util.bounded_map(_load, image_paths, num_workers, queue_size, on_error=on_error)
+        for batch in pipeline_util.batched(loaded, batch_size):
+            with profiler.step():
+                for i, (_, (image, _, _)) in enumerate(batch):
+                    batch_np[i] = image
+                batch_np[len(batch):] = 0
+                detections = profiler.time('predict', _predict, batch_np, count=len(batch))
+                for record in profiler.time('postprocess', _postprocess, batch, detections, count=len(batch)):
+                    writer.put(record)
+            num_images += len(batch)
+    finally:
+        writer.close()
+        profiler.stop_trace()
+    return num_images, time.perf_counter() - start_time, profiler
+
+def run_sliced_inference(detect_fn,
+                         image_paths,
+                         output_path,
+                         batch_size=8,
+                         tile_size=512,
+                         tile_overlap=0.2,
+                         full_frame=True,
+                         num_workers=2,
+                         queue_size=4,
+                         min_score=0.3,
+                         label_id_offset=1,
+                         iou_threshold=0.5,
+                         max_detections=100,
+                         profiler=None,
+                         on_error=_skip_unreadable_image):
+    """Detect small objects in very large images by running overlapping tiles at native resolution.
+
+    Each image is sliced into tile_size x tile_size tiles (views, not copies),
+    plus optionally the whole frame resized to tile_size for the objects larger
+    than the tiles. The tiles of consecutive images are packed into full
+    batches for detect_fn, and the detections of each image are mapped back to
+    its normalized coordinates and merged across the tile seams with NMS, see
+    tile_util.merge_tile_detections().
+
+    Args:
+        detect_fn: a detection function from get_model_detection_function(),
+        e.g. with the static input shape [batch_size, tile_size, tile_size, 3].
+        image_paths: an iterable of image file paths.
+        output_path: a .jsonl or .parquet file for the detections.
+        batch_size: the number of tiles per detect_fn call.
+        tile_size: the tile height and width, the model input size.
+        tile_overlap: the fraction of tile_size shared by neighbouring tiles;
+        objects smaller than the overlap are seen whole by at least one tile.
+        full_frame: also detect on the whole frame resized to tile_size.
+        num_workers: the number of decode threads.
+        queue_size: the bound of the decoded-image queue (whole decoded images,
+        so keep it small).
+        min_score: detections below this score are not written.
+        label_id_offset: added to the 0-based model classes to get label map ids.
+        iou_threshold: the IoU of the NMS merging duplicates across tiles.
+        max_detections: the maximum number of detections written per image.
+        profiler: a profile_util.Profiler recording the decode/predict/
+        postprocess/io stages, one step per batch; a new one by default.
+        on_error: see run_batch_inference().
+
+    Returns:
+        (number of images, number of tiles, wall time in seconds, profile_util.Profiler)
+    """
+    import tensorflow as tf
+    from util import image_util
+    from util import profile_util
+
+    profiler = profiler or profile_util.Profiler()
+    write_fn, close_fn = _open_detection_writer(output_path)
+    writer = pipeline_util.BackgroundWriter(
+        lambda record: profiler.time('io', write_fn, record),
+        max_queue_size=queue_size, close_fn=close_fn)
+
+    def _load(image_path):
+        return image_path, profiler.time('decode', image_util.load_image_into_numpy_array, image_path)
+
+    # per image: [path, shape, windows, num_tiles, number of inputs not predicted yet, detections]
+    pending_images = collections.deque()
+
+    def _inputs(loaded):
+        """Yield (image state, input array view) for every tile (and full frame) of every image."""
+        for image_path, image_np in loaded:
+            tiles, windows = tile_util.slice_image(image_np, tile_size, tile_overlap)
+            inputs = list(tiles)
+            if full_frame:
+                resized, valid_fraction = image_util.resize_and_pad(image_np, tile_size, tile_size)
+                inputs.append(resized)
+                windows = np.concatenate([windows, tile_util.full_frame_window(image_np.shape, valid_fraction)[
+                    np.newaxis]])
+            state = [image_path, image_np.shape[:2], windows, len(tiles), len(inputs), []]
+            pending_images.append(state)
+            for input_np in inputs:
+                yield state, input_np
+
+    def _predict(batch_np):
+        detections, _, _ = detect_fn(tf.convert_to_tensor(batch_np))
+        return {key: detections[key].numpy()
+                for key in ['detection_boxes', 'detection_scores', 'detection_classes']}
+
+    def _merge(state):
+        image_path, image_shape, windows, num_tiles, _, outputs = state
+        detections = {key: np.concatenate([output[key] for output in outputs])
+                      for key in ['detection_boxes', 'detection_scores', 'detection_classes']}
+        detections = tile_util.merge_tile_detections(
+            detections, windows, image_shape, num_tiles, min_score=min_score, iou_threshold=iou_threshold,
+            max_detections=max_detections)
+        num = detections['num_detections'][0]
+        return {'image_path': image_path,
+                'height': int(image_shape[0]),
+                'width': int(image_shape[1]),
+                'detection_boxes': detections['detection_boxes'][0, :num].tolist(),
+                'detection_scores': detections['detection_scores'][0, :num].tolist(),
+                'detection_classes': (detections['detection_classes'][0, :num].astype(np.int32) +
+                                      label_id_offset).tolist()}
+
+    num_images, num_tiles = 0, 0
+    batch_np = np.zeros((batch_size, tile_size, tile_size, 3), dtype=np.float32)
+    start_time = time.perf_counter()
+    try:
+        loaded = pipeline_util.bounded_map(_load, image_paths, num_workers, queue_size, on_error=on_error)
+        for batch in pipeline_util.batched(_inputs(loaded), batch_size):
+            with profiler.step():
+                # the only copy of the tile pixels: view -> model input buffer (zero-padded at the edges)
+                batch_np[:] = 0
+                for i, (_, input_np) in enumerate(batch):
+                    batch_np[i, :input_np.shape[0], :input_np.shape[1]] = input_np
+                detections = profiler.time('predict', _predict, batch_np, count=len(batch))
+                for i, (state, _) in enumerate(batch):
+                    state[5].append({key: value[i:i + 1] for key, value in detections.items()})
+                    state[4] -= 1
+                # images come out in order, once all their inputs are predicted
+                while pending_images and pending_images[0][4] == 0:
+                    state = pending_images.popleft()
+                    writer.put(profiler.time('postprocess', _merge, state))
+                    num_images += 1
+                    num_tiles += state[3]
+    finally:
+        writer.close()
+        profiler.stop_trace()
+    return num_images, num_tiles, time.perf_counter() - start_time, profiler
+
+def _load_detection_model(args):
+    """Build the detection model, or return (None, None) for an exported one (no building or tracing)."""
+    if args.exported_model:
+        return None, None
+    return build_detection_model(args.model_name)
+
+
+def run_batch(args, profiler):
+    """The `batch` subcommand: headless inference over many images, streamed to a file."""
+    from util import data_util
+    from util import export_util
+
+    detection_model, _ = _load_detection_model(args)
+    input_size = args.tile_size or args.image_size
+    if args.exported_model:
+        max_batch_size = export_util.exported_max_batch_size(args.exported_model)
+        if max_batch_size is not None and args.batch_size > max_batch_size:
+            print('%s only accepts batches of %d, batch_size lowered accordingly.' %
+                  (args.exported_model, max_batch_size))
+            args.batch_size = max_batch_size
+        detect_fn = export_util.load_exported_detection_function(args.exported_model)
+    else:
+        detect_fn = get_model_detection_function(
+            detection_model, [args.batch_size, input_size, input_size, 3])
+    image_paths = data_util.list_image_paths(args.input)
+    if not image_paths:
+        print('No images found in %s' % args.input)
+        return
+    if args.tile_size:
+        num_images, num_tiles, elapsed, profiler = run_sliced_inference(
+            detect_fn, image_paths, args.output,
+            batch_size=args.batch_size,
+            tile_size=args.tile_size,
+            tile_overlap=args.tile_overlap,
+            full_frame=not args.no_full_frame,
+            num_workers=args.num_workers,
+            # the queue holds whole full-resolution images here, so keep it to a few per thread
+            queue_size=min(args.queue_size, 2 * args.num_workers),
+            min_score=args.min_score,
+            iou_threshold=args.iou_threshold,
+            profiler=profiler)
+        print('Sliced: %d images (%d tiles) in %.2f s: %.2f images/sec, %.1f tiles/sec' %
+              (num_images, num_tiles, elapsed, num_images / elapsed, num_tiles / elapsed))
+    else:
+        num_images, elapsed, profiler = run_batch_inference(
+            detect_fn, image_paths, args.output,
+            batch_size=args.batch_size,
+            image_size=args.image_size,
+            num_workers=args.num_workers,
+            queue_size=args.queue_size,
+            min_score=args.min_score,
+            nms_method=args.nms,
+            iou_threshold=args.iou_threshold,
+            profiler=profiler)
+    print('Processed %d images in %.2f s: %.2f images/sec' % (num_images, elapsed, num_images / elapsed))
+    print('Per-stage time (decode is summed over %d threads):' % args.num_workers)
+    for line in profiler.report():
+        print('  ' + line)
+    if args.tile_size and args.compare_full_frame:
+        # the same model and input size on the whole frame, for the cost of slicing
+        full_frame_path = os.path.splitext(args.output)[0] + '_full_frame' + os.path.splitext(args.output)[1]
+        full_frame_images, full_frame_elapsed, _ = run_batch_inference(
+            detect_fn, image_paths, full_frame_path,
+            batch_size=args.batch_size,
+            image_size=args.tile_size,
+            num_workers=args.num_workers,
+            queue_size=args.queue_size,
+            min_score=args.min_score,
+            nms_method=args.nms,
+            iou_threshold=args.iou_threshold)
+        if num_images and full_frame_images:
+            print('Full frame: %d images in %.2f s: %.2f images/sec; sliced is %.1fx slower (detections in %s)' %
+                  (full_frame_images, full_frame_elapsed, full_frame_images / full_frame_elapsed,
+                   (elapsed / num_images) / (full_frame_elapsed / full_frame_images), full_frame_path))
+    if args.profile_summary:
+        profiler.write_summary(args.profile_summary, mode='sliced' if args.tile_size else 'batch',
+                               model_name=args.model_name, batch_size=args.batch_size, image_size=input_size,
+                               num_images=num_images, images_per_second=num_images / elapsed)
+
+
+def run_image(args, profiler):
+    """The `image` subcommand: detect on one image and visualize the boxes."""
+    import tensorflow as tf
+    from util import export_util
+    from util import image_util
+
+    detection_model, configs = _load_detection_model(args)
 
     # load label map data for visualization
-    # can create your own customized category_index and label_map_dict
+    # can create your own customized category_index
     # example for category_index:
     # {1: {'id': 1, 'name': 'person'}, 2: {'id': 2, 'name': 'bicycle'}}
-    label_map_path = './object_detection/data/mscoco_label_map.pbtxt'
-    label_map = label_map_util.load_labelmap(label_map_path)
-    categories = label_map_util.convert_label_map_to_categories(
-        label_map,
-        max_num_classes=label_map_util.get_max_label_map_index(label_map),
-        use_display_name=True)
-    category_index = label_map_util.create_category_index(categories)
-    label_map_dict = label_map_util.get_label_map_dict(label_map, use_display_name=True)
+    category_index = label_util.load_category_index(args.label_map)
 
     # run inference
-    image_dir = './object_detection/test_images/'
-    image_path = os.path.join(image_dir, 'image1.jpg')
-    image_np = load_image_into_numpy_array(image_path)
+    image_np = profiler.time('decode', image_util.load_image_into_numpy_array, args.image)
 
-    input_tensor = tf.convert_to_tensor(np.expand_dims(image_np, 0), dtype=tf.float32)
-    detections, predictions_dict, shapes = detect_fn(input_tensor)
+    if args.exported_model:
+        detect_fn = export_util.load_exported_detection_function(args.exported_model)
+        padded, valid_fraction = profiler.time('preprocess', image_util.resize_and_pad,
+                                               image_np, args.image_size, args.image_size)
+        detections, _, _ = profiler.time('predict', detect_fn, padded[np.newaxis].astype(np.float32))
+        with profiler.stage('postprocess'):
+            detections = {key: value.numpy() for key, value in detections.items()}
+            detections['detection_boxes'] = image_util.unpad_boxes(detections['detection_boxes'], valid_fraction)
+    elif args.buckets:
+        buckets = [tuple(int(v) for v in bucket.split('x')) for bucket in args.buckets.split(',')]
+        detect_fn = BucketedDetectionFunction(detection_model, buckets)
+        detect_fn.warmup()
+        for bucket in detect_fn.buckets:
+            print('bucket %dx%d: first call %.3f s' % (bucket + (detect_fn.first_call_seconds[bucket],)))
+        detections = profiler.time('predict', detect_fn, image_np)
+        print('trace counts per bucket:', detect_fn.trace_counts)
+    else:
+        detect_fn = get_model_detection_function(detection_model)
+        input_tensor = profiler.time('preprocess', tf.convert_to_tensor, np.expand_dims(image_np, 0), tf.float32)
+        # includes the tf.function tracing of the first call
+        detections, predictions_dict, shapes = profiler.time('predict', detect_fn, input_tensor)
+        with profiler.stage('postprocess'):
+            detections = {key: value.numpy() for key, value in detections.items()}
 
     label_id_offset = 1
     image_np_with_detections = image_np.copy()
@@ -117,24 +547,93 @@ if __name__ == '__main__':
     # Use keypoints if available in detections
     keypoints, keypoint_scores = None, None
     if 'detection_keypoints' in detections:
-        keypoints = detections['detection_keypoints'][0].numpy()
-        keypoint_scores = detections['detection_keypoint_scores'][0].numpy()
-    
+        keypoints = detections['detection_keypoints'][0]
+        keypoint_scores = detections['detection_keypoint_scores'][0]
+
     # visualization
-    viz_utils.visualize_boxes_and_labels_on_image_array(
-        image_np_with_detections,
-        detections['detection_boxes'][0].numpy(),
-        (detections['detection_classes'][0].numpy() + label_id_offset).astype(int),
-        detections['detection_scores'][0].numpy(),
-        category_index,
-        use_normalized_coordinates=True,
-        max_boxes_to_draw=200,
-        min_score_thresh=.30,
-        agnostic_mode=False,
-        keypoints=keypoints,
-        keypoint_scores=keypoint_scores,
-        keypoint_edges=get_keypoint_tuples(configs['eval_config']))
+    with profiler.stage('render'):
+        from object_detection.utils import visualization_utils as viz_utils
+        viz_utils.visualize_boxes_and_labels_on_image_array(
+            image_np_with_detections,
+            detections['detection_boxes'][0],
+            (detections['detection_classes'][0] + label_id_offset).astype(int),
+            detections['detection_scores'][0],
+            category_index,
+            use_normalized_coordinates=True,
+            max_boxes_to_draw=200,
+            min_score_thresh=.30,
+            agnostic_mode=False,
+            keypoints=keypoints,
+            keypoint_scores=keypoint_scores,
+            keypoint_edges=get_keypoint_tuples(configs['eval_config']) if configs else None)
+    for line in profiler.report():
+        print(line)
+    if args.profile_summary:
+        profiler.write_summary(args.profile_summary, mode='single_image', model_name=args.model_name)
 
+    if args.no_display:
+        return
+    import matplotlib
     matplotlib.use('TkAgg')
+    import matplotlib.pyplot as plt
     plt.imshow(image_np_with_detections)
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+# main function:
+if __name__ == '__main__':
+    # download the checkpoint and put it into models/research/object_detection/test_data/
+    # common options of the subcommands
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32',
+                               help='model directory under ./object_detection/test_data/')
+    common_parser.add_argument('--image_size', type=int, default=512)
+    common_parser.add_argument('--exported_model', default=None,
+                               help='SavedModel directory or .tflite file written by export_model.py, '
+                                    'loaded instead of building the model from pipeline.config')
+    common_parser.add_argument('--profile_summary', default=None,
+                               help='optional .json file for the per-stage timings with percentiles')
+    common_parser.add_argument('--trace_dir', default=None,
+                               help='capture a tf.profiler trace of a window of batches into this directory')
+    common_parser.add_argument('--trace_start_step', type=int, default=10)
+    common_parser.add_argument('--trace_steps', type=int, default=5)
+
+    parser = argparse.ArgumentParser(description='Run object detection inference.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    image_parser = subparsers.add_parser('image', parents=[common_parser],
+                                         help='detect on one image and visualize the boxes')
+    image_parser.add_argument('--image', default='./object_detection/test_images/image1.jpg')
+    image_parser.add_argument('--label_map', default='./object_detection/data/mscoco_label_map.pbtxt')
+    image_parser.add_argument('--buckets', default=None,
+                              help='comma-separated HEIGHTxWIDTH input shapes, e.g. 512x512,768x1024; '
+                                   'traced at startup so that no image triggers a retrace')
+    image_parser.add_argument('--no_display', action='store_true', help='skip the matplotlib window')
+    image_parser.set_defaults(func=run_image)
+
+    batch_parser = subparsers.add_parser('batch', parents=[common_parser],
+                                         help='headless inference over many images, streamed to a file')
+    batch_parser.add_argument('--input', required=True,
+                              help='directory, glob pattern or manifest (.txt/.jsonl) of images')
+    batch_parser.add_argument('--output', default='detections.jsonl', help='.jsonl or .parquet output file')
+    batch_parser.add_argument('--batch_size', type=int, default=8)
+    batch_parser.add_argument('--num_workers', type=int, default=4, help='decode/resize threads')
+    batch_parser.add_argument('--queue_size', type=int, default=64, help='bound of the inter-stage queues')
+    batch_parser.add_argument('--min_score', type=float, default=0.3)
+    batch_parser.add_argument('--nms', default='none', choices=postprocess_util.NMS_METHODS,
+                              help='extra NMS on top of the model post-processing')
+    batch_parser.add_argument('--iou_threshold', type=float, default=0.5)
+    batch_parser.add_argument('--tile_size', type=int, default=None,
+                              help='sliced inference for very large images: detect on overlapping tiles of '
+                                   'this size at native resolution')
+    batch_parser.add_argument('--tile_overlap', type=float, default=0.2,
+                              help='fraction of a tile shared with the next')
+    batch_parser.add_argument('--no_full_frame', action='store_true',
+                              help='with --tile_size, skip the extra pass on the whole downscaled frame')
+    batch_parser.add_argument('--compare_full_frame', action='store_true',
+                              help='with --tile_size, also run plain full-frame inference and compare throughput')
+    batch_parser.set_defaults(func=run_batch)
+
+    args = parser.parse_args()
+    from util import profile_util
+    profiler = profile_util.Profiler(args.trace_dir, args.trace_start_step, args.trace_steps)
+    args.func(args, profiler)
@@ -1,33 +1,36 @@
 '''
 This code is to use TensorFlow hub to retrive already trained object detection model for inference.
+
+Usage:
+    python inference_tfhub.py detect [--image IMAGE] [--module ./model/efficientdet_d6_1] [--no_render]
+    python inference_tfhub.py features [--image IMAGE] [--module ./model/resnet_50_feature_vector_1] [--store_dir DIR]
+
+tensorflow_hub is imported by the subcommands (it pulls in a lot at import
+time) and matplotlib only when an image is displayed, so headless runs start
+faster.
 '''
 
 #@title Imports and function definitions
 
+import argparse
+
 # For running inference on the TF-Hub module.
 import tensorflow as tf
 
-import tensorflow_hub as hub
-
-# For downloading the image.
-import matplotlib.pyplot as plt
-import tempfile
-from six.moves.urllib.request import urlopen
-from six import BytesIO
-
 # For drawing onto the image.
 import numpy as np
-from PIL import Image
-from PIL import ImageColor
-from PIL import ImageDraw
-from PIL import ImageFont
-from PIL import ImageOps
+from util import data_util
+from util import feature_store
+from util import label_util
+from util import pipeline_util
+from util import render_util
 
 # For measuring the inference time.
-import time
+from util import profile_util
 
 
 def display_image(image):
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(20, 15))
     plt.grid(False)
     plt.imsave('test.jpg', image)
@@ -35,81 +38,16 @@ def display_image(image):
     plt.show()
 
 
-def draw_bounding_box_on_image(image,
-                               ymin,
-                               xmin,
-                               ymax,
-                               xmax,
-                               color,
-                               font,
-                               thickness=4,
-                               display_str_list=()):
-    """Adds a bounding box to an image."""
-    draw = ImageDraw.Draw(image)
-    im_width, im_height = image.size
-    (left, right, top, bottom) = (xmin * im_width, xmax * im_width,
-                                  ymin * im_height, ymax * im_height)
-    draw.line([(left, top), (left, bottom), (right, bottom), (right, top),
-               (left, top)],
-              width=thickness,
-              fill=color)
-
-    # If the total height of the display strings added to the top of the bounding
-    # box exceeds the top of the image, stack the strings below the bounding box
-    # instead of above.
-    display_str_heights = [font.getsize(ds)[1] for ds in display_str_list]
-    # Each display_str has a top and bottom margin of 0.05x.
-    total_display_str_height = (1 + 2 * 0.05) * sum(display_str_heights)
-
-    if top > total_display_str_height:
-        text_bottom = top
-    else:
-        text_bottom = top + total_display_str_height
-    # Reverse list and print from bottom to top.
-    for display_str in display_str_list[::-1]:
-        text_width, text_height = font.getsize(display_str)
-        margin = np.ceil(0.05 * text_height)
-        draw.rectangle([(left, text_bottom - text_height - 2 * margin),
-                        (left + text_width, text_bottom)],
-                       fill=color)
-        draw.text((left + margin, text_bottom - text_height - margin),
-                  display_str,
-                  fill="black",
-                  font=font)
-        text_bottom -= text_height - 2 * margin
+# created on first use, so that the font is resolved once per process
+_box_renderer = None
 
 
 def draw_boxes(image, boxes, class_names, scores, max_boxes=10, min_score=0.1):
     """Overlay labeled boxes on an image with formatted scores and label names."""
-    colors = list(ImageColor.colormap.values())
-
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/liberation/LiberationSansNarrow-Regular.ttf",
-                                  25)
-    except IOError:
-        print("Font not found, using default font.")
-        font = ImageFont.load_default()
-
-    for i in range(min(boxes.shape[0], max_boxes)):
-        if scores[i] >= min_score:
-            ymin, xmin, ymax, xmax = tuple(boxes[i])
-            #display_str = "{}: {}%".format(class_names[i].decode("ascii"),
-            #                               int(100 * scores[i]))
-            display_str = "{}: {}%".format(class_names[i], int(100 * scores[i]))
-            color = colors[hash(class_names[i]) % len(colors)]
-            image_pil = Image.fromarray(np.uint8(image)).convert("RGB")
-            draw_bounding_box_on_image(
-                image_pil,
-                ymin,
-                xmin,
-                ymax,
-                xmax,
-                color,
-                font,
-                display_str_list=[display_str])
-            np.copyto(image, np.array(image_pil))
-
-    return image
+    global _box_renderer
+    if _box_renderer is None:
+        _box_renderer = render_util.BoxRenderer()
+    return _box_renderer.draw(image, boxes, class_names, scores, max_boxes, min_score)
 
 
 def load_img(path):
@@ -119,65 +57,184 @@ def load_img(path):
 
 
 def coco_label_conversion(detection_classes, label_path):
-    class_names = []
-    file = open(label_path, "r")
-    classes = file.read().splitlines()
-    for cls_idx in detection_classes[0, :]:
-        class_names.append(classes[int(cls_idx) - 1])
-
-    return class_names
+    # the label file is parsed once, then the 1-based classes index into it
+    label_array = label_util.load_label_array(label_path)
+    return label_util.lookup_labels(detection_classes[0, :], label_array)
 
 
-def run_detector(detector, image_path, label_path):
-    img = load_img(image_path)
+def run_detector(detector, image_path, label_path, render=True, profiler=None):
+    # per-stage timings; each stage waits for its tensors so that the
+    # asynchronously dispatched device work is timed in the right stage
+    profiler = profiler or profile_util.Profiler()
+    img = profiler.time("decode", load_img, image_path)
 
     #converted_img  = tf.image.convert_image_dtype(img, tf.float32)[tf.newaxis, ...]
-    converted_img  = tf.image.convert_image_dtype(img, tf.uint8)[tf.newaxis, ...]
-    start_time = time.time()
-    result = detector(converted_img)
-    end_time = time.time()
+    converted_img = profiler.time("preprocess", lambda: tf.image.convert_image_dtype(img, tf.uint8)[tf.newaxis, ...])
+    result = profiler.time("predict", detector, converted_img)
 
-    result = {key:value.numpy() for key,value in result.items()}
+    with profiler.stage("postprocess"):
+        result = {key:value.numpy() for key,value in result.items()}
 
     print("Found %d objects." % len(result["detection_scores"][0, :]))
-    print("Inference time: ", end_time-start_time)
+    print("Inference time: %.3f s" % profiler.seconds["predict"])
     
+    if not render:
+        return result
+
     # For Faster RCNN
     #image_with_boxes = draw_boxes(
     #    img.numpy(), result["detection_boxes"],
     #    result["detection_class_entities"], result["detection_scores"])
 
     # For EfficientDet
-    detection_class_entities = coco_label_conversion(result["detection_classes"], label_path)
-    image_with_boxes = draw_boxes(
-        img.numpy(), result["detection_boxes"][0, :],
-        detection_class_entities, result["detection_scores"][0, :])
+    with profiler.stage("render"):
+        detection_class_entities = coco_label_conversion(result["detection_classes"], label_path)
+        image_with_boxes = draw_boxes(
+            img.numpy(), result["detection_boxes"][0, :],
+            detection_class_entities, result["detection_scores"][0, :])
 
+    profiler.time("io", display_image, image_with_boxes)
+    return result
 
-    display_image(image_with_boxes)
 
+def run_feature_extraction(feature_extractor, height, width, image_path, profiler=None):
+    profiler = profiler or profile_util.Profiler()
+    img = profiler.time("decode", load_img, image_path)
 
-def run_feature_extraction(feature_extractor, height, width, image_path):
-    img = load_img(image_path)
+    def preprocess(img):
+        converted_img  = tf.image.convert_image_dtype(img, tf.float32)[tf.newaxis, ...]
+        return tf.image.resize(converted_img, [height, width])
 
-    converted_img  = tf.image.convert_image_dtype(img, tf.float32)[tf.newaxis, ...]
-    converted_img = tf.image.resize(converted_img, [height, width])
-    start_time = time.time()
-    features = feature_extractor(converted_img)   # A batch with shape [batch_size, num_features].
-    end_time = time.time()
+    converted_img = profiler.time("preprocess", preprocess, img)
+    # A batch with shape [batch_size, num_features].
+    features = profiler.time("predict", feature_extractor, converted_img)
 
-    print("Inference time: ", end_time-start_time)
+    print("Inference time: %.3f s" % profiler.seconds["predict"])
 
     return features
 
 
+def extract_features_cached(feature_extractor, height, width, image_paths, store, batch_size=32,
+                            num_workers=4, profiler=None):
+    """Embed images in batches into a feature_store.FeatureStore, skipping images already in it.
+
+    Images are keyed by the hash of their file bytes, so renamed or copied
+    images are not embedded again.
+
+    Args:
+        feature_extractor: the TF-Hub feature vector model.
+        height, width: the input size of the model.
+        image_paths: the images to embed.
+        store: the feature_store.FeatureStore the new vectors are appended to.
+        batch_size: the number of images per extractor call.
+        num_workers: the number of read/decode threads.
+        profiler: optional profile_util.Profiler for the per-stage timings.
+
+    Returns:
+        the [len(image_paths)] row indices of the images into store.vectors.
+    """
+    profiler = profiler or profile_util.Profiler()
+    keys = []
+
+    def _read(image_path):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        return image_path, image_bytes, feature_store.content_hash(image_bytes)
+
+    def _missing():
+        pending = set()
+        for image_path, image_bytes, key in pipeline_util.bounded_map(
+                _read, image_paths, num_workers, 4 * batch_size):
+            keys.append(key)
+            if key not in store and key not in pending:
+                pending.add(key)
+                yield image_path, image_bytes, key
+
+    def _decode(record):
+        image_path, image_bytes, key = record
+        img = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+        img = tf.image.resize(tf.image.convert_image_dtype(img, tf.float32), [height, width])
+        return image_path, img, key
+
+    num_embedded = 0
+    decoded = pipeline_util.bounded_map(_decode, _missing(), num_workers, 2 * batch_size)
+    for batch in pipeline_util.batched(decoded, batch_size):
+        with profiler.step():
+            images = profiler.time("preprocess", lambda: tf.stack([img for _, img, _ in batch]), count=len(batch))
+            features = profiler.time("predict", feature_extractor, images, count=len(batch))
+            with profiler.stage("io", count=len(batch)):
+                num_embedded += store.add([key for _, _, key in batch], features.numpy(),
+                                          [image_path for image_path, _, _ in batch])
+
+    print("Embedded %d new images, %d of %d already in %s" %
+          (num_embedded, len(keys) - num_embedded, len(keys), store.directory), flush=True)
+    return store.rows(keys)
+
+
+def run_detect(args):
+    """The `detect` subcommand."""
+    import tensorflow_hub as hub
+
+    # load model
+    #detector = hub.load(args.module).signatures['default'] # for Faster RCNN
+    detector = hub.load(args.module) # for EfficientDet
+
+    # run inference
+    profiler = profile_util.Profiler(args.trace_dir, trace_start_step=0, trace_num_steps=1)
+    with profiler.step():
+        run_detector(detector, args.image, args.labels, not args.no_render, profiler)
+    for line in profiler.report():
+        print(line)
+    if args.profile_summary:
+        profiler.write_summary(args.profile_summary, detection_module_handle=args.module)
+
+
+def run_features(args):
+    """The `features` subcommand."""
+    import tensorflow_hub as hub
+
+    # feature vector extractor
+    feature_extractor = hub.load(args.module)
+    height, width = args.height, args.width
+    features = run_feature_extraction(feature_extractor, height, width, args.image)
+    print(features.shape)
+    if args.store_dir:
+        store = feature_store.FeatureStore(args.store_dir, dtype=args.dtype)
+        rows = extract_features_cached(feature_extractor, height, width,
+                                       data_util.list_image_paths(args.image_dir), store)
+        # store.vectors is mapped from disk: no copy until rows are gathered
+        print(store.vectors[rows].shape)
+
+
 if __name__ == "__main__":
-    # Configurations
-    image_path = "./test_image/Naxos_Taverna.jpg"
-    detection_module_handle = "./model/efficientdet_d6_1"
-    #feature_module_handle = "./model/efficientnet_b6_feature-vector_1"
-    feature_module_handle = "./model/resnet_50_feature_vector_1"
-    label_path = "./util/coco-labels-paper.txt"
+    parser = argparse.ArgumentParser(description="Object detection / feature vectors with TF-Hub modules.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    detect_parser = subparsers.add_parser("detect", help="detect objects on an image")
+    detect_parser.add_argument("--image", default="./test_image/Naxos_Taverna.jpg")
+    detect_parser.add_argument("--module", default="./model/efficientdet_d6_1")
+    detect_parser.add_argument("--labels", default="./util/coco-labels-paper.txt")
+    detect_parser.add_argument("--no_render", action="store_true",
+                               help="headless: no box drawing, no display")
+    detect_parser.add_argument("--profile_summary", default=None,
+                               help="e.g. tfhub_profile.json for per-stage timings with percentiles")
+    detect_parser.add_argument("--trace_dir", default=None, help="e.g. ./logs/tfhub to capture a tf.profiler trace")
+    detect_parser.set_defaults(func=run_detect)
+
+    features_parser = subparsers.add_parser("features", help="extract feature vectors")
+    features_parser.add_argument("--image", default="./test_image/Naxos_Taverna.jpg")
+    # e.g. ./model/efficientnet_b6_feature-vector_1 with --height 528 --width 528
+    features_parser.add_argument("--module", default="./model/resnet_50_feature_vector_1")
+    features_parser.add_argument("--height", type=int, default=224)
+    features_parser.add_argument("--width", type=int, default=224)
+    features_parser.add_argument("--store_dir", default=None,
+                                 help="e.g. ./features/resnet_50 to cache the embeddings of --image_dir")
+    features_parser.add_argument("--image_dir", default="./test_image/")
+    features_parser.add_argument("--dtype", default="float16", choices=["float16", "float32"],
+                                 help="dtype of a new --store_dir; float16 halves the disk and page cache, "
+                                      "an existing store keeps its own")
+    features_parser.set_defaults(func=run_features)
+    args = parser.parse_args()
 
     # Print Tensorflow version
     print(tf.__version__)
@@ -185,16 +242,4 @@ if __name__ == "__main__":
     # Check available GPU devices.
     print("The following GPU devices are available: %s" % tf.test.gpu_device_name())
 
-    # load model
-    #detector = hub.load(detection_module_handle).signatures['default'] # for Faster RCNN
-    detector = hub.load(detection_module_handle) # for EfficientDet
-
-    # feature vector extractor
-    feature_extractor = hub.load(feature_module_handle)
-    #height, width = 528, 528 # EfficientNet
-    height, width = 224, 224 # ResNet-50
-    features = run_feature_extraction(feature_extractor, height, width, image_path)
-    print(features.shape)
-
-    # run inference
-    run_detector(detector, image_path, label_path)
+    args.func(args)
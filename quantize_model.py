@@ -0,0 +1,287 @@
+'''
+This code is for post-training full-integer (int8) quantization of the inference.py model with a calibration set.
+
+The model is exported with the object detection API's TFLite-friendly graph (box
+decoding and NMS in the TFLite_Detection_PostProcess custom op), converted once
+in float32 and once in int8 calibrated on representative images, and both are
+evaluated on the same held-out images for latency, model size and mAP (or,
+without annotations, their agreement with the float32 detections).
+'''
+import argparse
+import collections
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import tensorflow as tf
+
+from object_detection.utils import config_util
+from object_detection.core import standard_fields
+from object_detection.metrics import coco_evaluation
+
+from inference import build_detection_model
+from util import data_util
+from util import image_util
+
+# the signature outputs of the TFLite-friendly graph, which returns the outputs of
+# the TFLite_Detection_PostProcess op as a list, and our names for them
+POSTPROCESS_OUTPUTS = {'output_0': 'detection_boxes',
+                       'output_1': 'detection_classes',
+                       'output_2': 'detection_scores',
+                       'output_3': 'num_detections'}
+# custom op of the TFLite-friendly graph, float by design
+_POSTPROCESS_OP = 'TFLite_Detection_PostProcess'
+
+
+def export_tflite_friendly_saved_model(model_name, output_dir, max_detections=100,
+                                       model_root='./object_detection/test_data/'):
+    """Export the model with the TFLite detection post-processing op.
+
+    Returns:
+        the exported SavedModel directory.
+    """
+    from object_detection import export_tflite_graph_lib_tf2
+
+    configs = config_util.get_configs_from_pipeline_file(
+        os.path.join(model_root, model_name, 'pipeline.config'))
+    pipeline_proto = config_util.create_pipeline_proto_from_configs(configs)
+    export_tflite_graph_lib_tf2.export_tflite_model(
+        pipeline_proto, os.path.join(model_root, model_name, 'checkpoint'), output_dir,
+        max_detections, use_regular_nms=False)
+    return os.path.join(output_dir, 'saved_model')
+
+
+def get_preprocess_function(detection_model):
+    """Get a tf.function resizing and normalizing one image the way the model expects.
+
+    The TFLite-friendly graph starts at model.predict(), so the model's own
+    preprocess() runs on the host, for calibration and evaluation alike.
+    """
+
+    @tf.function(input_signature=[tf.TensorSpec([1, None, None, 3], tf.float32)])
+    def preprocess_fn(image):
+        return detection_model.preprocess(image)
+
+    return preprocess_fn
+
+
+def convert_to_tflite(saved_model_dir, representative_dataset=None, allow_float_fallback=False):
+    """Convert the TFLite-friendly SavedModel to float32, or to int8 if calibration data is given.
+
+    Args:
+        saved_model_dir: the SavedModel from export_tflite_friendly_saved_model().
+        representative_dataset: a callable returning a generator of [input] lists,
+        used to calibrate the activation ranges. When given, weights and
+        activations are quantized to int8, including the model input.
+        allow_float_fallback: let the ops without an int8 kernel run in float32
+        instead of failing the int8 conversion; see float_ops().
+
+    Returns:
+        the TFLite flatbuffer bytes.
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    if representative_dataset is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if allow_float_fallback:
+            converter.target_spec.supported_ops.append(tf.lite.OpsSet.TFLITE_BUILTINS)
+        converter.inference_input_type = tf.int8
+    # TFLite_Detection_PostProcess
+    converter.allow_custom_ops = True
+    return converter.convert()
+
+
+def float_ops(tflite_model):
+    """Count the ops of a TFLite model that compute in float32, by op name.
+
+    The detection post-processing op is float by design and not counted; the
+    DEQUANTIZE feeding it is. Anything else in an int8 model fell back to float.
+    """
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    dtypes = {tensor['index']: tensor['dtype'] for tensor in interpreter.get_tensor_details()}
+    counts = collections.Counter()
+    for op in interpreter._get_ops_details():
+        if op['op_name'] != _POSTPROCESS_OP and any(dtypes.get(index) == np.float32 for index in op['outputs']):
+            counts[op['op_name']] += 1
+    return dict(counts)
+
+
+class TFLiteDetector(object):
+    """Run a TFLite detection model on preprocessed float32 [1, H, W, 3] inputs.
+
+    Inputs are quantized on the host when the model takes int8. The outputs are
+    looked up by their signature names, see POSTPROCESS_OUTPUTS.
+    """
+
+    def __init__(self, model_content, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        signature = self.interpreter.get_signature_list()['serving_default']
+        self._input_name = signature['inputs'][0]
+        missing = sorted(set(POSTPROCESS_OUTPUTS) - set(signature['outputs']))
+        if missing:
+            raise ValueError('The TFLite model has outputs %s, expected %s' %
+                             (sorted(signature['outputs']), sorted(POSTPROCESS_OUTPUTS)))
+        self._runner = self.interpreter.get_signature_runner('serving_default')
+
+    def __call__(self, preprocessed_image):
+        if self._input['dtype'] == np.int8:
+            scale, zero_point = self._input['quantization']
+            preprocessed_image = np.clip(np.round(preprocessed_image / scale + zero_point), -128, 127)
+        outputs = self._runner(**{self._input_name: preprocessed_image.astype(self._input['dtype'])})
+        detections = {key: outputs[name] for name, key in POSTPROCESS_OUTPUTS.items()}
+        num_detections = int(detections['num_detections'].reshape(-1)[0])
+        return tuple(detections[key][0, :num_detections]
+                     for key in ['detection_boxes', 'detection_classes', 'detection_scores'])
+
+
+def evaluate(detector, examples, num_classes, label_id_offset=1):
+    """Run a detector over preprocessed examples and compute COCO mAP and latency.
+
+    Args:
+        detector: a TFLiteDetector.
+        examples: a list of dicts with 'input' (preprocessed image), 'valid_fraction',
+        'shape' (original height, width) and groundtruth 'boxes'/'classes'
+        (normalized, 1-based).
+        num_classes: the number of classes of the model.
+        label_id_offset: added to the 0-based detected classes.
+
+    Returns:
+        (mAP@[.5:.95], median latency in seconds, list of (boxes, classes, scores))
+    """
+    evaluator = coco_evaluation.CocoDetectionEvaluator(
+        [{'id': i, 'name': str(i)} for i in range(1, num_classes + 1)])
+    latencies = []
+    outputs = []
+    for image_id, example in enumerate(examples):
+        start_time = time.perf_counter()
+        boxes, classes, scores = detector(example['input'])
+        latencies.append(time.perf_counter() - start_time)
+        boxes = image_util.unpad_boxes(boxes, example['valid_fraction'])
+        classes = classes.astype(np.int32) + label_id_offset
+        outputs.append((boxes, classes, scores))
+
+        scale = np.array(example['shape'] * 2, dtype=np.float32)
+        evaluator.add_single_ground_truth_image_info(image_id, {
+            standard_fields.InputDataFields.groundtruth_boxes: example['boxes'] * scale,
+            standard_fields.InputDataFields.groundtruth_classes: example['classes']})
+        evaluator.add_single_detected_image_info(image_id, {
+            standard_fields.DetectionResultFields.detection_boxes: boxes * scale,
+            standard_fields.DetectionResultFields.detection_scores: scores,
+            standard_fields.DetectionResultFields.detection_classes: classes})
+    metrics = evaluator.evaluate()
+    return metrics['DetectionBoxes_Precision/mAP'], float(np.median(latencies)), outputs
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization with an accuracy report.')
+    parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32')
+    parser.add_argument('--calibration_data', default='./test_image/',
+                        help='directory, glob pattern or manifest of representative images')
+    parser.add_argument('--num_calibration_images', type=int, default=100)
+    parser.add_argument('--allow_float_fallback', action='store_true',
+                        help='let ops without an int8 kernel run in float32 instead of failing the conversion')
+    parser.add_argument('--eval_data', required=True,
+                        help='.jsonl manifest with groundtruth boxes (see util/data_util.py); a directory or '
+                             'glob also works, the float model detections then serve as groundtruth. '
+                             'The calibration images are left out of it.')
+    parser.add_argument('--pseudo_groundtruth_min_score', type=float, default=0.5)
+    parser.add_argument('--output_dir', default=None, help='defaults to ./exported/<model_name>')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--report', default=None, help='optional .json file for the report')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join('./exported', args.model_name)
+    tf.io.gfile.makedirs(output_dir)
+
+    calibration_paths = data_util.list_image_paths(args.calibration_data)[:args.num_calibration_images]
+
+    # evaluation set, with groundtruth from the manifest if there is one
+    if args.eval_data.endswith('.jsonl'):
+        eval_paths, eval_boxes, eval_classes = data_util.load_manifest(args.eval_data)
+    else:
+        eval_paths = data_util.list_image_paths(args.eval_data)
+        eval_boxes = eval_classes = None
+    # the int8 ranges were fit on the calibration images, so they would flatter it
+    calibration_set = set(os.path.abspath(image_path) for image_path in calibration_paths)
+    held_out = [i for i, image_path in enumerate(eval_paths) if os.path.abspath(image_path) not in calibration_set]
+    if len(held_out) < len(eval_paths):
+        print('Left %d calibration images out of the evaluation set.' % (len(eval_paths) - len(held_out)))
+    if not held_out:
+        raise ValueError('No evaluation image left in %s once the calibration images are removed' % args.eval_data)
+
+    print('Building model and exporting the TFLite-friendly graph......', flush=True)
+    detection_model, configs = build_detection_model(args.model_name)
+    num_classes = configs['model'].ssd.num_classes
+    preprocess_fn = get_preprocess_function(detection_model)
+    saved_model_dir = export_tflite_friendly_saved_model(args.model_name, tempfile.mkdtemp())
+
+    def _preprocess(image_path):
+        image_np = image_util.load_image_into_numpy_array(image_path)
+        preprocessed, true_shapes = preprocess_fn(tf.constant(image_np[np.newaxis], dtype=tf.float32))
+        padded_shape = preprocessed.shape[1:3]
+        valid_fraction = (float(true_shapes[0, 0]) / padded_shape[0], float(true_shapes[0, 1]) / padded_shape[1])
+        return preprocessed.numpy(), valid_fraction, image_np.shape[:2]
+
+    def representative_dataset():
+        for image_path in calibration_paths:
+            yield [_preprocess(image_path)[0]]
+
+    print('Converting float32 and int8 (%d calibration images) models......' % len(calibration_paths), flush=True)
+    tflite_models = {'float32': convert_to_tflite(saved_model_dir),
+                     'int8': convert_to_tflite(saved_model_dir, representative_dataset, args.allow_float_fallback)}
+    for name, tflite_model in tflite_models.items():
+        with tf.io.gfile.GFile(os.path.join(output_dir, 'model_%s.tflite' % name), 'wb') as f:
+            f.write(tflite_model)
+
+    examples = []
+    for i in held_out:
+        image_path = eval_paths[i]
+        preprocessed, valid_fraction, shape = _preprocess(image_path)
+        examples.append({'input': preprocessed, 'valid_fraction': valid_fraction, 'shape': list(shape),
+                         'boxes': eval_boxes[i] if eval_boxes else None,
+                         'classes': eval_classes[i] if eval_classes else None})
+
+    label_id_offset = 1
+    detectors = {name: TFLiteDetector(tflite_model, args.num_threads)
+                 for name, tflite_model in tflite_models.items()}
+    # without annotations the score is the agreement with float32, not an mAP
+    metric = 'mAP' if eval_boxes is not None else 'agreement'
+    if eval_boxes is None:
+        # no annotations: the confident float32 detections are the reference
+        print('No groundtruth given, using float32 detections with score >= %g as groundtruth; '
+              'the reported agreement is the COCO mAP against them.' % args.pseudo_groundtruth_min_score)
+        for example in examples:
+            boxes, classes, scores = detectors['float32'](example['input'])
+            keep = scores >= args.pseudo_groundtruth_min_score
+            example['boxes'] = image_util.unpad_boxes(boxes[keep], example['valid_fraction'])
+            example['classes'] = classes[keep].astype(np.int32) + label_id_offset
+
+    report = {}
+    for name, detector in detectors.items():
+        mean_ap, latency, _ = evaluate(detector, examples, num_classes, label_id_offset)
+        report[name] = {metric: mean_ap, 'latency_ms': 1000 * latency,
+                        'size_mb': len(tflite_models[name]) / 2**20}
+    report['int8']['float_ops'] = float_ops(tflite_models['int8'])
+    report[metric + '_delta'] = report['int8'][metric] - report['float32'][metric]
+    report['speedup'] = report['float32']['latency_ms'] / report['int8']['latency_ms']
+
+    print('%d evaluation images' % len(examples))
+    for name in ['float32', 'int8']:
+        print('%-8s %s=%.4f  latency=%.1f ms  size=%.1f MiB' %
+              (name, metric, report[name][metric], report[name]['latency_ms'], report[name]['size_mb']))
+    print('int8 - float32: %s delta=%+.4f, speedup=%.2fx' % (metric, report[metric + '_delta'], report['speedup']))
+    if report['int8']['float_ops']:
+        print('int8 ops left in float32: %s' % ', '.join('%s x%d' % item for item in
+                                                         sorted(report['int8']['float_ops'].items())))
+    else:
+        print('int8 model: every op except the detection post-processing is int8')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
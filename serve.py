@@ -0,0 +1,175 @@
+'''
+This code is for serving object detection over local HTTP with dynamic request batching.
+
+POST the encoded image bytes (JPEG/PNG/...) to /detect, optionally with ?min_score=0.3,
+and get the detections back as JSON. Concurrent requests are coalesced into batches
+bounded by --max_batch_size and --max_wait_ms before running the detector.
+'''
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import tensorflow as tf
+
+from util import image_util
+from util import pipeline_util
+
+
+def load_detector(model, image_size):
+    """Load a detector once and return (batch_fn, max_supported_batch_size).
+
+    Args:
+        model: 'hub:<handle or path>' for a TF-Hub detector (as in inference_tfhub.py),
+        a SavedModel directory or .tflite file from export_model.py, or a model name
+        under ./object_detection/test_data/ restored from its checkpoint (as in inference.py).
+        image_size: the side of the padded square the images are resized to.
+
+    Returns:
+        batch_fn taking a float32 [B, image_size, image_size, 3] array and returning
+        a dict of numpy detection arrays, and the largest batch it accepts (None
+        if unbounded; 1 for TFLite detectors).
+    """
+    if model.startswith('hub:'):
+        import tensorflow_hub as hub
+
+        detector = hub.load(model[len('hub:'):])
+        output_keys = ['detection_boxes', 'detection_scores', 'detection_classes', 'num_detections']
+
+        @tf.function(input_signature=[tf.TensorSpec([None, image_size, image_size, 3], tf.uint8)])
+        def hub_detect_fn(images):
+            # TF-Hub detection models take a single image: one traced graph loops over the batch
+            def detect_one(image):
+                result = detector(image[tf.newaxis])
+                return {key: tf.cast(result[key][0], tf.float32) for key in output_keys}
+
+            return tf.map_fn(detect_one, images, fn_output_signature={key: tf.float32 for key in output_keys})
+
+        def hub_batch_fn(images):
+            result = hub_detect_fn(tf.convert_to_tensor(images.astype(np.uint8)))
+            return {key: value.numpy() for key, value in result.items()}
+
+        return hub_batch_fn, None
+
+    max_batch_size = None
+    if model.endswith('.tflite') or tf.io.gfile.isdir(model):
+        from util import export_util
+        detect_fn = export_util.load_exported_detection_function(model)
+        max_batch_size = export_util.exported_max_batch_size(model)
+    else:
+        import inference
+        detection_model, _ = inference.build_detection_model(model)
+        detect_fn = inference.get_model_detection_function(detection_model, [None, image_size, image_size, 3])
+
+    def batch_fn(images):
+        detections, _, _ = detect_fn(tf.convert_to_tensor(images))
+        return {key: value.numpy() for key, value in detections.items()}
+
+    return batch_fn, max_batch_size
+
+
+def get_batch_function(detector_fn, label_id_offset):
+    """Wrap a detector into a DynamicBatcher batch_fn over (image, valid_fraction) items."""
+
+    def batch_fn(items):
+        images = np.stack([image for image, _ in items]).astype(np.float32)
+        detections = detector_fn(images)
+        results = []
+        for i, (_, valid_fraction) in enumerate(items):
+            results.append({
+                'detection_boxes': image_util.unpad_boxes(detections['detection_boxes'][i], valid_fraction),
+                'detection_scores': detections['detection_scores'][i],
+                'detection_classes': detections['detection_classes'][i].astype(np.int32) + label_id_offset})
+        return results
+
+    return batch_fn
+
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+    """Handle POST /detect requests; one handler thread per connection."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/detect':
+            self._send_json(404, {'error': 'unknown path %s' % url.path})
+            return
+        # read the body first, so the connection stays usable after an error response
+        image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            min_score = float(parse_qs(url.query).get('min_score', [self.server.min_score])[0])
+        except ValueError as e:
+            self._send_json(400, {'error': 'invalid min_score: %s' % e})
+            return
+        try:
+            image, valid_fraction, _ = image_util.resize_image_bytes(image_bytes, self.server.image_size)
+        except (IOError, ValueError) as e:
+            self._send_json(400, {'error': 'cannot decode image: %s' % e})
+            return
+        try:
+            result = self.server.batcher.submit((image, valid_fraction)).result()
+        except Exception as e:
+            self._send_json(500, {'error': 'detection failed: %s' % e})
+            return
+        keep = result['detection_scores'] >= min_score
+        self._send_json(200, {key: value[keep].tolist() for key, value in result.items()})
+
+    def log_message(self, format, *args):
+        pass  # no per-request logging on the hot path
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP object detection server with dynamic batching.')
+    parser.add_argument('--model', default='efficientdet_d0_coco17_tpu-32',
+                        help="'hub:<handle>', an exported SavedModel/.tflite, or a checkpoint model name")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0)
+    parser.add_argument('--min_score', type=float, default=0.3)
+    args = parser.parse_args()
+
+    print('Loading detector......', flush=True)
+    detector_fn, supported_batch_size = load_detector(args.model, args.image_size)
+    max_batch_size = args.max_batch_size
+    if supported_batch_size is not None and supported_batch_size < max_batch_size:
+        print('The detector only accepts batches of %d, max_batch_size lowered accordingly.' % supported_batch_size)
+        max_batch_size = supported_batch_size
+    # TF-Hub detectors report 1-based classes already, the others are 0-based
+    label_id_offset = 0 if args.model.startswith('hub:') else 1
+    batch_fn = get_batch_function(detector_fn, label_id_offset)
+
+    # warm up so the first request does not pay for tracing/initialization
+    start_time = time.perf_counter()
+    batch_fn([(np.zeros((args.image_size, args.image_size, 3), dtype=np.uint8), (1.0, 1.0))])
+    print('Detector warmed up in %.2f s' % (time.perf_counter() - start_time))
+
+    server = ThreadingHTTPServer((args.host, args.port), DetectionRequestHandler)
+    server.daemon_threads = True
+    server.batcher = pipeline_util.DynamicBatcher(batch_fn, max_batch_size, args.max_wait_ms / 1000.0)
+    server.image_size = args.image_size
+    server.min_score = args.min_score
+    print('Serving on http://%s:%d/detect (max_batch_size=%d, max_wait_ms=%g)' %
+          (args.host, args.port, max_batch_size, args.max_wait_ms), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        print('Batch size histogram:', dict(sorted(server.batcher.batch_sizes.items())))
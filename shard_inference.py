@@ -0,0 +1,243 @@
+'''
+This code is for running batch inference across many CPU cores with several model processes.
+
+One inference.py process stops scaling well before a many-core machine is
+busy, TensorFlow's intra-op parallelism saturating early for a small model
+such as EfficientDet-D0. The launcher splits the image list into N shards and
+runs one worker process per shard, each pinned to its own block of CPUs with
+matching thread pools and its own copy of the model. Every worker streams its
+detections to a per-shard .jsonl file; the launcher then merges the shards
+back into the order of the image list, so the output does not depend on the
+number of workers.
+
+Usage:
+    python shard_inference.py --input ./images/ --output detections.jsonl --workers 8
+    python shard_inference.py --input ./images/ --output detections.jsonl --workers 1 2 4 8 16 --json scaling.json
+
+With several --workers values the whole run is repeated for each of them and
+a scaling curve of throughput against the number of workers is printed.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_cpu_list(spec):
+    """Parse a CPU list such as '0-3,8' into [0, 1, 2, 3, 8]."""
+    cpus = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def shard_cpus(cpus, num_workers):
+    """Split the CPUs into num_workers contiguous, equal blocks (the remainder is left idle)."""
+    if num_workers > len(cpus):
+        raise ValueError('%d workers but only %d CPUs' % (num_workers, len(cpus)))
+    per_worker = len(cpus) // num_workers
+    return [cpus[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+def worker(args):
+    """Run inference on one shard of the images in this process (spawned by launch())."""
+    os.sched_setaffinity(0, parse_cpu_list(args.cpus))
+    import tensorflow as tf
+    # thread pools can only be sized before TensorFlow runs its first op
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+    import inference
+    from util import data_util
+    from util import export_util
+
+    start_time = time.perf_counter()
+    if args.exported_model:
+        detect_fn = export_util.load_exported_detection_function(args.exported_model)
+    else:
+        detection_model, _ = inference.build_detection_model(args.model_name)
+        detect_fn = inference.get_model_detection_function(
+            detection_model, [args.batch_size, args.image_size, args.image_size, 3])
+    # trace (or let the interpreter allocate) outside the timed run
+    detect_fn(tf.zeros([args.batch_size, args.image_size, args.image_size, 3]))
+    load_seconds = time.perf_counter() - start_time
+
+    # every worker lists the same sorted images and takes every num_shards-th one
+    image_paths = data_util.list_image_paths(args.input)[args.shard::args.num_shards]
+    skipped_paths = set()
+
+    def _skip(image_path, error):
+        print('Skipping %s: %s: %s' % (image_path, type(error).__name__, error), flush=True)
+        skipped_paths.add(image_path)
+
+    num_images, elapsed, _ = inference.run_batch_inference(
+        detect_fn, image_paths, args.output,
+        batch_size=args.batch_size,
+        image_size=args.image_size,
+        num_workers=args.decode_threads,
+        min_score=args.min_score,
+        on_error=_skip)
+    # the positions without a record, for the merge
+    skipped = [index for index, image_path in enumerate(image_paths) if image_path in skipped_paths]
+    with open(args.output + '.stats.json', 'w') as f:
+        json.dump({'num_images': num_images, 'num_listed': len(image_paths), 'skipped': skipped,
+                   'seconds': elapsed, 'load_seconds': load_seconds}, f)
+
+
+def merge_shards(shard_paths, output_path, num_listed, skipped):
+    """Interleave the per-shard records back into the order of the image list.
+
+    Shard i holds the images i, i + N, i + 2N... in order, so reading one line
+    of every shard in turn restores the original order. The records are copied
+    line by line, without parsing, and the memory stays flat.
+
+    Args:
+        shard_paths: the N per-shard .jsonl files.
+        output_path: the merged .jsonl file.
+        num_listed: the number of images of each shard.
+        skipped: the positions in each shard of the images that failed to load
+        (and have no record).
+
+    Returns:
+        the number of records written.
+    """
+    shard_files = [open(path) for path in shard_paths]
+    skipped = [set(positions) for positions in skipped]
+    num_records = 0
+    try:
+        with open(output_path, 'w') as output_file:
+            for position in range(max(num_listed)):
+                for shard_file, shard_size, shard_skipped in zip(shard_files, num_listed, skipped):
+                    if position >= shard_size or position in shard_skipped:
+                        continue
+                    line = shard_file.readline()
+                    if not line:
+                        raise ValueError('The shard %s ended early: a worker lost records' % shard_file.name)
+                    output_file.write(line)
+                    num_records += 1
+            if any(shard_file.readline() for shard_file in shard_files):
+                raise ValueError('The shards of %s have more records than images' % output_path)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+    return num_records
+
+
+def launch(args, num_workers, cpus, shard_dir):
+    """Run num_workers worker processes over the images and merge their shards into args.output.
+
+    Returns:
+        a dict of the run: workers, threads per worker, images, wall seconds
+        (process start to merged output) and images/sec, both on the wall time
+        and on the slowest worker's inference time (without model loading).
+    """
+    cpu_blocks = shard_cpus(cpus, num_workers)
+    threads = len(cpu_blocks[0])
+    intra_op_threads = args.intra_op_threads or threads
+    shard_paths = [os.path.join(shard_dir, '%d-of-%d.jsonl' % (shard, num_workers)) for shard in range(num_workers)]
+
+    start_time = time.perf_counter()
+    processes = []
+    for shard, (shard_path, cpu_block) in enumerate(zip(shard_paths, cpu_blocks)):
+        command = [sys.executable, os.path.abspath(__file__), '--worker',
+                   '--input', args.input, '--output', shard_path,
+                   '--shard', str(shard), '--num_shards', str(num_workers),
+                   '--cpus', ','.join(str(cpu) for cpu in cpu_block),
+                   '--intra_op_threads', str(intra_op_threads), '--inter_op_threads', str(args.inter_op_threads),
+                   '--model_name', args.model_name, '--image_size', str(args.image_size),
+                   '--batch_size', str(args.batch_size), '--decode_threads', str(args.decode_threads),
+                   '--min_score', str(args.min_score)]
+        if args.exported_model:
+            command += ['--exported_model', args.exported_model]
+        processes.append(subprocess.Popen(command))
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError('Workers %s of %d failed' % (failed, num_workers))
+    stats = []
+    for shard_path in shard_paths:
+        with open(shard_path + '.stats.json') as f:
+            stats.append(json.load(f))
+    num_images = merge_shards(shard_paths, args.output, [stat['num_listed'] for stat in stats],
+                              [stat['skipped'] for stat in stats])
+    elapsed = time.perf_counter() - start_time
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+        os.remove(shard_path + '.stats.json')
+    inference_seconds = max(stat['seconds'] for stat in stats)
+    return {'workers': num_workers,
+            'cpus_per_worker': threads,
+            'intra_op_threads': intra_op_threads,
+            'inter_op_threads': args.inter_op_threads,
+            'num_images': num_images,
+            'num_skipped': sum(len(stat['skipped']) for stat in stats),
+            'seconds': elapsed,
+            'load_seconds': max(stat['load_seconds'] for stat in stats),
+            'inference_seconds': inference_seconds,
+            'images_per_sec': num_images / elapsed,
+            'inference_images_per_sec': num_images / inference_seconds if num_images else 0.0}
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch inference sharded over several pinned worker processes.')
+    parser.add_argument('--input', required=True, help='image directory, glob pattern, .txt list or .jsonl manifest')
+    parser.add_argument('--output', default='detections.jsonl', help='merged .jsonl detections, in input order')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4],
+                        help='the number of worker processes; several values give a scaling curve')
+    parser.add_argument('--cpus', default=None,
+                        help="the CPUs to share between the workers, e.g. '0-63'; all usable CPUs by default")
+    parser.add_argument('--intra_op_threads', type=int, default=0,
+                        help='TF intra-op threads per worker; 0 for the number of CPUs of the worker')
+    parser.add_argument('--inter_op_threads', type=int, default=1)
+    parser.add_argument('--model_name', default='efficientdet_d0_coco17_tpu-32',
+                        help='model directory under ./object_detection/test_data/')
+    parser.add_argument('--exported_model', default=None,
+                        help='SavedModel directory or .tflite file written by export_model.py')
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--decode_threads', type=int, default=2, help='decode/resize threads per worker')
+    parser.add_argument('--min_score', type=float, default=0.3)
+    parser.add_argument('--json', default=None, help='optional .json file for the scaling curve')
+    # internal: one worker process, run by the launcher
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--shard', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--num_shards', type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        sys.exit(0)
+
+    # .tflite models are traced at batch 1 (see util/export_util.py)
+    if args.exported_model and args.exported_model.endswith('.tflite') and args.batch_size > 1:
+        print('%s only accepts batches of 1, batch_size lowered accordingly.' % args.exported_model)
+        args.batch_size = 1
+    cpus = parse_cpu_list(args.cpus) if args.cpus else sorted(os.sched_getaffinity(0))
+    results = []
+    # the shards next to the output, on the same file system
+    with tempfile.TemporaryDirectory(prefix='shards_', dir=os.path.dirname(os.path.abspath(args.output))) as shard_dir:
+        for num_workers in args.workers:
+            print('Running %d workers on %d CPUs......' % (num_workers, len(cpus)), flush=True)
+            results.append(launch(args, num_workers, cpus, shard_dir))
+
+    if not results[0]['num_images']:
+        print('No images were processed from %s (empty input or every image skipped)' % args.input)
+        sys.exit(1)
+    # the scaling curve, speedup and efficiency against the first --workers value
+    base = results[0]
+    print('%8s %8s %8s %10s %12s %10s %10s' % ('workers', 'threads', 'images', 'wall img/s', 'infer img/s',
+                                               'speedup', 'efficiency'))
+    for result in results:
+        speedup = result['inference_images_per_sec'] / base['inference_images_per_sec']
+        result['speedup'] = speedup
+        result['efficiency'] = speedup * base['workers'] / result['workers']
+        print('%8d %8d %8d %10.2f %12.2f %10.2f %10.2f' % (
+            result['workers'], result['intra_op_threads'], result['num_images'], result['images_per_sec'],
+            result['inference_images_per_sec'], speedup, result['efficiency']))
+    print('Detections of %d images merged in input order into %s' % (results[-1]['num_images'], args.output))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,247 @@
+'''
+This code is for running object detection on a video file or a camera stream (e.g. RTSP) in real time.
+
+Three overlapped stages: a reader thread decodes and resizes the frames, the
+main thread runs the detector, and a background thread writes the detections
+(and optionally an annotated video). For live sources the reader never waits:
+when the detector falls behind, the stale frames are dropped and the newest
+one is detected next, so the output keeps up with real time. An optional IoU
+tracker carries the boxes over the dropped frames.
+
+A video file can stand in for a live camera with --realtime, which reads it
+at its own frame rate instead of as fast as possible.
+'''
+import argparse
+import json
+import threading
+import time
+
+import imageio
+import numpy as np
+
+from serve import load_detector
+from util import image_util
+from util import pipeline_util
+from util import profile_util
+from util import render_util
+from util import track_util
+
+
+def is_live_source(source):
+    return source.split('://')[0] in ('rtsp', 'rtmp', 'http', 'https', 'udp', 'tcp') or source.startswith('<video')
+
+
+def read_frames(source, frame_queue, image_size, realtime, profiler, stop_event=None, metadata=None):
+    """Decode frames into frame_queue as (index, capture time, frame, resized, valid_fraction); run on a thread.
+
+    Args:
+        source: a video file, a stream URL (e.g. rtsp://...) or '<video0>' for a webcam.
+        frame_queue: a pipeline_util.LatestQueue, closed at the end of the stream.
+        image_size: the side of the padded square of the detector input.
+        realtime: pace a video file at its frame rate, like a live camera.
+        profiler: records the decode stage.
+        stop_event: optional threading.Event; the reader stops at the next frame once it is set.
+        metadata: optional dict, updated with the source metadata (e.g. 'fps')
+        before the first frame is queued.
+    """
+    reader = imageio.get_reader(source)
+    try:
+        source_metadata = reader.get_meta_data()
+        if metadata is not None:
+            metadata.update(source_metadata)
+        frame_seconds = 1.0 / source_metadata.get('fps', 30) if realtime else 0
+        start_time = time.perf_counter()
+        frame_start = time.perf_counter()
+        for index, frame in enumerate(reader):
+            if stop_event is not None and stop_event.is_set():
+                break
+            capture_time = time.perf_counter()
+            resized, valid_fraction = image_util.resize_and_pad(np.asarray(frame)[..., :3], image_size, image_size)
+            profiler.add('decode', time.perf_counter() - frame_start)
+            frame_queue.put((index, capture_time, frame, resized, valid_fraction))
+            if frame_seconds:
+                time.sleep(max(0.0, start_time + (index + 1) * frame_seconds - time.perf_counter()))
+            frame_start = time.perf_counter()
+    finally:
+        reader.close()
+        frame_queue.close()
+
+
+def run_stream_inference(detector_fn,
+                         source,
+                         output_path,
+                         image_size=512,
+                         realtime=None,
+                         min_score=0.3,
+                         label_id_offset=1,
+                         tracker=None,
+                         video_output_path=None,
+                         class_names=None,
+                         profiler=None):
+    """Detect objects in every frame the detector can keep up with, and write a record per detected frame.
+
+    Args:
+        detector_fn: a batch function from serve.load_detector().
+        source: a video file or stream URL, see read_frames().
+        output_path: the .jsonl file of the per-frame detections.
+        image_size: the side of the padded square of the detector input.
+        realtime: drop frames when the detector falls behind; by default only
+        for live sources, video files being processed frame by frame.
+        min_score: detections below this score are not written.
+        label_id_offset: added to the model classes to get label map ids.
+        tracker: an optional track_util.IoUTracker; the records then carry
+        track ids, and the dropped frames get the extrapolated tracks
+        ('tracked': true) instead of no detections.
+        video_output_path: optional annotated video of the detected frames.
+        class_names: optional label array (see label_util.load_label_array())
+        for the annotated video.
+        profiler: a profile_util.Profiler, a new one by default.
+
+    Returns:
+        a dict of stream statistics: source frames, detected frames, dropped
+        frames, wall seconds and sustained detected FPS.
+    """
+    profiler = profiler or profile_util.Profiler()
+    realtime = is_live_source(source) if realtime is None else realtime
+    frame_queue = pipeline_util.LatestQueue(max_size=1 if realtime else 8, drop_oldest=realtime)
+    reader_errors = []
+    stop_event = threading.Event()
+    source_metadata = {}
+
+    def _read():
+        try:
+            read_frames(source, frame_queue, image_size, realtime, profiler, stop_event, source_metadata)
+        except Exception as e:  # re-raised on the main thread once the frames read so far are done
+            reader_errors.append(e)
+
+    reader_thread = threading.Thread(target=_read, daemon=True)
+
+    output_file = open(output_path, 'w')
+    # opened on the first frame, once the reader knows the frame rate of the source
+    video_writers = []
+    renderer = render_util.BoxRenderer() if video_output_path else None
+
+    def _write(record):
+        record, frame = record
+        output_file.write(json.dumps(record) + '\n')
+        if video_output_path and frame is not None:
+            if not video_writers:
+                video_writers.append(imageio.get_writer(video_output_path, fps=source_metadata.get('fps', 30)))
+            names = [class_names[c] if class_names is not None and 0 <= c < len(class_names) else str(c)
+                     for c in record['detection_classes']]
+            boxes = np.array(record['detection_boxes'], dtype=np.float32).reshape(-1, 4)
+            video_writers[0].append_data(renderer.draw(np.array(frame), boxes, names, record['detection_scores'],
+                                                   max_boxes=100, min_score=min_score))
+
+    def _close():
+        output_file.close()
+        for video_writer in video_writers:
+            video_writer.close()
+
+    writer = pipeline_util.BackgroundWriter(lambda record: profiler.time('io', _write, record), close_fn=_close)
+
+    def _record(index, detections, tracked=False):
+        record = {'frame': index,
+                  'tracked': tracked,
+                  'detection_boxes': np.asarray(detections['detection_boxes']).tolist(),
+                  'detection_scores': np.asarray(detections['detection_scores']).tolist(),
+                  'detection_classes': np.asarray(detections['detection_classes']).astype(int).tolist()}
+        if 'track_ids' in detections:
+            record['track_ids'] = detections['track_ids'].tolist()
+        return record
+
+    num_detected = 0
+    last_index = -1
+    start_time = time.perf_counter()
+    reader_thread.start()
+    try:
+        for index, capture_time, frame, resized, valid_fraction in frame_queue:
+            with profiler.step():
+                num_skipped = index - last_index - 1
+                if tracker is not None:
+                    # the dropped frames get the tracks extrapolated from the last detected frame
+                    for skipped in range(1, num_skipped + 1):
+                        writer.put((_record(last_index + skipped, tracker.predict(skipped), tracked=True), None))
+                result = profiler.time('predict', detector_fn, resized[np.newaxis].astype(np.float32))
+                with profiler.stage('postprocess'):
+                    keep = result['detection_scores'][0] >= min_score
+                    detections = {
+                        'detection_boxes': image_util.unpad_boxes(result['detection_boxes'][0][keep], valid_fraction),
+                        'detection_scores': result['detection_scores'][0][keep],
+                        'detection_classes': result['detection_classes'][0][keep].astype(np.int64) + label_id_offset}
+                    if tracker is not None:
+                        detections = tracker.update(detections['detection_boxes'], detections['detection_scores'],
+                                                    detections['detection_classes'], num_frames=num_skipped + 1)
+                writer.put((_record(index, detections), frame))
+                # from the frame leaving the decoder to its detections being queued for writing
+                profiler.add('end_to_end', time.perf_counter() - capture_time)
+            num_detected += 1
+            last_index = index
+    finally:
+        # on an error or Ctrl-C the reader may be blocked on a full queue or reading an
+        # endless live stream: ask it to stop, unblock it and do not wait for it forever
+        stop_event.set()
+        frame_queue.set_drop_oldest()
+        reader_thread.join(timeout=5)
+        if reader_thread.is_alive():
+            print('The frame reader did not stop within 5 s, leaving it behind', flush=True)
+        try:
+            writer.close()
+        finally:
+            profiler.stop_trace()
+    if reader_errors:
+        raise reader_errors[0]
+    elapsed = time.perf_counter() - start_time
+    return {'source_frames': num_detected + frame_queue.num_dropped,
+            'detected_frames': num_detected,
+            'dropped_frames': frame_queue.num_dropped,
+            'seconds': elapsed,
+            'detected_fps': num_detected / elapsed}
+
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time object detection on a video file or camera stream.')
+    parser.add_argument('--source', required=True, help="video file, stream URL (rtsp://...) or '<video0>'")
+    parser.add_argument('--model', default='efficientdet_d0_coco17_tpu-32',
+                        help="'hub:<handle>', an exported SavedModel/.tflite, or a checkpoint model name")
+    parser.add_argument('--output', default='stream_detections.jsonl', help='.jsonl of per-frame detections')
+    parser.add_argument('--video_output', default=None, help='optional annotated video, e.g. annotated.mp4')
+    parser.add_argument('--label_map', default=None, help='label map (.pbtxt/.txt) for the annotated video')
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--min_score', type=float, default=0.3)
+    parser.add_argument('--realtime', action='store_true',
+                        help='read a video file at its frame rate and drop frames like a live camera')
+    parser.add_argument('--track', action='store_true', help='IoU tracking across frames, also over dropped frames')
+    parser.add_argument('--profile_summary', default=None,
+                        help='optional .json file for the per-stage timings with percentiles')
+    args = parser.parse_args()
+
+    print('Loading detector......', flush=True)
+    detector_fn, _ = load_detector(args.model, args.image_size)
+    # TF-Hub detectors report 1-based classes already, the others are 0-based
+    label_id_offset = 0 if args.model.startswith('hub:') else 1
+    detector_fn(np.zeros((1, args.image_size, args.image_size, 3), dtype=np.float32))  # warm up
+    class_names = None
+    if args.label_map:
+        from util import label_util
+        class_names = label_util.load_label_array(args.label_map)
+
+    profiler = profile_util.Profiler()
+    stats = run_stream_inference(
+        detector_fn, args.source, args.output,
+        image_size=args.image_size,
+        realtime=True if args.realtime else None,
+        min_score=args.min_score,
+        label_id_offset=label_id_offset,
+        tracker=track_util.IoUTracker() if args.track else None,
+        video_output_path=args.video_output,
+        class_names=class_names,
+        profiler=profiler)
+    print('%d source frames, %d detected, %d dropped in %.2f s: sustained %.2f detected FPS' %
+          (stats['source_frames'], stats['detected_frames'], stats['dropped_frames'], stats['seconds'],
+           stats['detected_fps']))
+    for line in profiler.report():
+        print('  ' + line)
+    if args.profile_summary:
+        profiler.write_summary(args.profile_summary, mode='stream', model=args.model, source=args.source, **stats)
@@ -5,7 +5,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 import os
-import random
+import time
 import io
 import imageio
 import glob
@@ -22,25 +22,15 @@ from object_detection.utils import config_util
 from object_detection.utils import visualization_utils as viz_utils
 from object_detection.builders import model_builder
 
-# utilities
-def load_image_into_numpy_array(path):
-    """Load an image from file into a numpy array.
-
-    Puts image into numpy array to feed into tensorflow graph.
-    Note that by convention we put it into a numpy array with shape
-    (height, width, channels), where channels=3 for RGB.
-
-    Args:
-        path: the file path to the image
-
-    Returns:
-        uint8 numpy array with shape (img_height, img_width, 3)
-    """
-    img_data = tf.io.gfile.GFile(path, 'rb').read()
-    image = Image.open(BytesIO(img_data))
-    (im_width, im_height) = image.size
-    return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+from util import checkpoint_util
+from util import data_util
+from util import distribute_util
+from util import feature_cache_util
+from util import profile_util
+from util import tfrecord_util
+from util.image_util import load_image_into_numpy_array
 
+# utilities
 def plot_detections(image_np,
                     boxes,
                     classes,
@@ -73,59 +63,281 @@ def plot_detections(image_np,
     else:
         plt.imshow(image_np_with_annotations)
 
+def build_fine_tune_model(pipeline_config, checkpoint_path, num_classes):
+    """Build a detection model for fine-tuning and restore the pre-trained weights.
+
+    Args:
+        pipeline_config: the file path to the pipeline.config of the pre-trained model.
+        checkpoint_path: the checkpoint prefix to restore, e.g. .../checkpoint/ckpt-0.
+        num_classes: the number of non-background classes to fine-tune on.
+
+    Returns:
+        detection_model: the built detection model with variables created.
+        ckpt: the tf.train.Checkpoint holding the restored parts of the model.
+    """
+    # Load pipeline config and build a detection model.
+    # Since we are working off of a COCO architecture which predicts 90
+    # class slots by default, we override the `num_classes` field here.
+    configs = config_util.get_configs_from_pipeline_file(pipeline_config)
+    model_config = configs['model']
+    model_config.ssd.num_classes = num_classes
+    model_config.ssd.freeze_batchnorm = True
+    detection_model = model_builder.build(model_config=model_config, is_training=True)
+
+    # Set up object-based checkpoint restore --- RetinaNet has two prediction
+    # `heads` --- one for classification, the other for box regression.  We will
+    # restore the box regression head but initialize the classification head
+    # from scratch (we show the omission below by commenting out the line that
+    # we would add if we wanted to restore both heads)
+    fake_box_predictor = tf.compat.v2.train.Checkpoint(
+        _base_tower_layers_for_heads=detection_model._box_predictor._base_tower_layers_for_heads,
+        #_prediction_heads=detection_model._box_predictor._prediction_heads,
+        #    (i.e., the classification head that we *will not* restore)
+        _box_prediction_head=detection_model._box_predictor._box_prediction_head,
+    )
+    fake_model = tf.compat.v2.train.Checkpoint(
+            _feature_extractor=detection_model._feature_extractor,
+            _box_predictor=fake_box_predictor)
+    ckpt = tf.compat.v2.train.Checkpoint(model=fake_model)
+    ckpt.restore(checkpoint_path).expect_partial()
+
+    # Run model through a dummy image so that variables are created
+    image, shapes = detection_model.preprocess(tf.zeros([1, 640, 640, 3]))
+    prediction_dict = detection_model.predict(image, shapes)
+    _ = detection_model.postprocess(prediction_dict, shapes)
+
+    return detection_model, ckpt
+
+def get_fine_tune_variables(model, prefixes_to_train):
+    """Select the trainable variables whose names start with one of the prefixes."""
+    return [var for var in model.trainable_variables
+            if any([var.name.startswith(prefix) for prefix in prefixes_to_train])]
+
+def enable_mixed_precision(policy_name='mixed_bfloat16'):
+    """Set the global Keras mixed precision policy.
+
+    Must be called before the detection model is built. bfloat16 is the reduced
+    precision type with fast kernels on CPUs; use 'mixed_float16' on GPUs.
+    """
+    tf.keras.mixed_precision.set_global_policy(policy_name)
+
+def provide_padded_groundtruth(model, groundtruth_boxes, groundtruth_classes, num_groundtruth_boxes):
+    """Provide padded groundtruth to the model, masking the padded slots with zero weights.
+
+    Keeping the padding (instead of slicing each image down to its N_i boxes) gives
+    every tensor a static shape, as XLA requires; this is how the object detection
+    API itself feeds groundtruth on TPUs.
+
+    Args:
+        model: the detection model.
+        groundtruth_boxes: A [batch_size, max_boxes, 4] float32 Tensor.
+        groundtruth_classes: A [batch_size, max_boxes, num_classes] float32 Tensor.
+        num_groundtruth_boxes: A [batch_size] int32 Tensor of valid box counts.
+    """
+    max_boxes = groundtruth_boxes.shape[1]
+    groundtruth_weights = tf.cast(
+        tf.range(max_boxes)[tf.newaxis, :] < num_groundtruth_boxes[:, tf.newaxis], tf.float32)
+    model.provide_groundtruth(
+        groundtruth_boxes_list=tf.unstack(groundtruth_boxes),
+        groundtruth_classes_list=tf.unstack(groundtruth_classes),
+        groundtruth_weights_list=tf.unstack(groundtruth_weights))
+
+def compute_losses(model, images):
+    """Run the forward pass on a batch of images and return the float32 losses dict."""
+    # a single vectorized preprocess call for the whole batch
+    preprocessed_images, shapes = model.preprocess(images)
+    prediction_dict = model.predict(preprocessed_images, shapes)
+    if tf.keras.mixed_precision.global_policy().compute_dtype != 'float32':
+        # compute the losses in float32 against the float32 groundtruth
+        prediction_dict = tf.nest.map_structure(
+            lambda t: tf.cast(t, tf.float32) if t.dtype.is_floating else t, prediction_dict)
+    return model.loss(prediction_dict, shapes)
+
 # Set up forward + backward pass for a single train step.
-def get_model_train_step_function(model, optimizer, vars_to_fine_tune):
-    """Get a tf.function for training step."""
+def get_model_train_step_function(model,
+                                  optimizer,
+                                  vars_to_fine_tune,
+                                  batch_size,
+                                  num_classes,
+                                  image_size=640,
+                                  max_boxes=100,
+                                  jit_compile=False,
+                                  accumulation_steps=1):
+    """Get a tf.function for training step.
+
+    The step takes one padded batch (as produced by util.data_util.build_train_dataset)
+    and has a fixed input_signature, so it is traced once and never retraced.
+
+    With accumulation_steps > 1 the batch is split into that many micro-batches
+    which run one after the other, their gradients are summed and applied once,
+    so the effective batch size is not limited by the activation memory of a
+    single forward/backward pass.
+
+    When called under a tf.distribute strategy (see util/distribute_util.py) the
+    batch is the per-replica batch and the gradients are averaged over replicas.
+
+    For mixed precision training call enable_mixed_precision() before building
+    the model and wrap the optimizer in tf.keras.mixed_precision.LossScaleOptimizer;
+    the step then scales the loss and unscales the gradients.
+
+    Args:
+        model: the detection model to train.
+        optimizer: the optimizer applying the gradients.
+        vars_to_fine_tune: the list of variables to train.
+        batch_size: the static number of images per batch.
+        num_classes: the number of non-background classes.
+        image_size: the static height and width of the input images.
+        max_boxes: the number of padded groundtruth box slots per image.
+        jit_compile: whether to compile the whole step with XLA.
+        accumulation_steps: the number of micro-batches to accumulate gradients
+        over; must divide batch_size.
+
+    Returns:
+        train_step_fn, a tf.function for a single training iteration.
+    """
+    if batch_size % accumulation_steps:
+        raise ValueError('batch_size=%d is not divisible by accumulation_steps=%d.' %
+                         (batch_size, accumulation_steps))
+    micro_batch_size = batch_size // accumulation_steps
+    loss_scaling = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    # the optimizer sums the gradients of all replicas, so average them here
+    gradient_scale = 1.0 / (accumulation_steps * tf.distribute.get_strategy().num_replicas_in_sync)
 
     # Use tf.function for a bit of speed.
     # Comment out the tf.function decorator if you want the inside of the
     # function to run eagerly.
-    @tf.function
-    def train_step_fn(image_tensors,
-                      groundtruth_boxes_list,
-                      groundtruth_classes_list):
+    @tf.function(input_signature=[
+        tf.TensorSpec([batch_size, image_size, image_size, 3], tf.float32),
+        tf.TensorSpec([batch_size, max_boxes, 4], tf.float32),
+        tf.TensorSpec([batch_size, max_boxes, num_classes], tf.float32),
+        tf.TensorSpec([batch_size], tf.int32)],
+        jit_compile=jit_compile)
+    def train_step_fn(images,
+                      groundtruth_boxes,
+                      groundtruth_classes,
+                      num_groundtruth_boxes):
         """A single training iteration.
 
         Args:
-            image_tensors: A list of [1, height, width, 3] Tensor of type tf.float32.
-            Note that the height and width can vary across images, as they are
-            reshaped within this function to be 640x640.
-            groundtruth_boxes_list: A list of Tensors of shape [N_i, 4] with type
-            tf.float32 representing groundtruth boxes for each image in the batch.
-            groundtruth_classes_list: A list of Tensors of shape [N_i, num_classes]
-            with type tf.float32 representing groundtruth boxes for each image in
-            the batch.
+            images: A [batch_size, image_size, image_size, 3] Tensor of type tf.float32.
+            groundtruth_boxes: A [batch_size, max_boxes, 4] Tensor of type tf.float32
+            holding the padded normalized groundtruth boxes of each image.
+            groundtruth_classes: A [batch_size, max_boxes, num_classes] Tensor of type
+            tf.float32 holding the padded one-hot groundtruth classes of each image.
+            num_groundtruth_boxes: A [batch_size] Tensor of type tf.int32 holding the
+            number of valid box slots of each image.
 
         Returns:
             A scalar tensor representing the total loss for the input batch.
         """
-        shapes = tf.constant(batch_size * [[640, 640, 3]], dtype=tf.int32)
-        model.provide_groundtruth(
-            groundtruth_boxes_list=groundtruth_boxes_list,
-            groundtruth_classes_list=groundtruth_classes_list)
+        total_loss = 0.0
+        gradients = []
+        for start in range(0, batch_size, micro_batch_size):
+            end = start + micro_batch_size
+            # start each micro-batch only once the previous gradients are computed,
+            # so that only one micro-batch worth of activations is alive at a time
+            with tf.control_dependencies(gradients):
+                micro_images = tf.identity(images[start:end])
+            provide_padded_groundtruth(model,
+                                       groundtruth_boxes[start:end],
+                                       groundtruth_classes[start:end],
+                                       num_groundtruth_boxes[start:end])
+            with tf.GradientTape() as tape:
+                losses_dict = compute_losses(model, micro_images)
+                micro_loss = losses_dict['Loss/localization_loss'] + losses_dict['Loss/classification_loss']
+                gradient_loss = micro_loss * gradient_scale
+                if loss_scaling:
+                    gradient_loss = optimizer.get_scaled_loss(gradient_loss)
+            micro_gradients = tape.gradient(gradient_loss, vars_to_fine_tune)
+            if loss_scaling:
+                micro_gradients = optimizer.get_unscaled_gradients(micro_gradients)
+            if gradients:
+                micro_gradients = [g + m for g, m in zip(gradients, micro_gradients)]
+            gradients = micro_gradients
+            total_loss += micro_loss / accumulation_steps
+        optimizer.apply_gradients(zip(gradients, vars_to_fine_tune))
+        return total_loss
+
+    return train_step_fn
+
+def get_cached_features_train_step_function(model,
+                                            optimizer,
+                                            vars_to_fine_tune,
+                                            batch_size,
+                                            num_classes,
+                                            feature_shapes,
+                                            image_size=640,
+                                            max_boxes=100,
+                                            jit_compile=False):
+    """Get a tf.function for a head-only training step on cached feature maps.
+
+    The same step as get_model_train_step_function(), minus the preprocess and
+    _feature_extractor forward pass: it takes the batches of
+    util.feature_cache_util.build_cached_feature_dataset() and runs only the
+    box predictor, so vars_to_fine_tune must all be in the box predictor.
+
+    Args:
+        feature_shapes: the [height, width, channels] of each feature map level,
+        from util.feature_cache_util.load_feature_shapes().
+        Others: as in get_model_train_step_function().
+
+    Returns:
+        train_step_fn, a tf.function for a single training iteration.
+    """
+    # the anchors and true image shapes of the image size, as the full forward pass would set them
+    preprocessed_images, shapes = model.preprocess(tf.zeros([1, image_size, image_size, 3]))
+    model.predict(preprocessed_images, shapes)
+    shapes = tf.tile(shapes, [batch_size, 1])
+    loss_scaling = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    gradient_scale = 1.0 / tf.distribute.get_strategy().num_replicas_in_sync
+
+    @tf.function(input_signature=[
+        tuple(tf.TensorSpec([batch_size] + list(shape), tf.float32) for shape in feature_shapes),
+        tf.TensorSpec([batch_size, max_boxes, 4], tf.float32),
+        tf.TensorSpec([batch_size, max_boxes, num_classes], tf.float32),
+        tf.TensorSpec([batch_size], tf.int32)],
+        jit_compile=jit_compile)
+    def train_step_fn(feature_maps,
+                      groundtruth_boxes,
+                      groundtruth_classes,
+                      num_groundtruth_boxes):
+        """A single training iteration on a batch of cached feature maps; returns the total loss."""
+        provide_padded_groundtruth(model, groundtruth_boxes, groundtruth_classes, num_groundtruth_boxes)
         with tf.GradientTape() as tape:
-            preprocessed_images = tf.concat(
-                [detection_model.preprocess(image_tensor)[0]
-            for image_tensor in image_tensors], axis=0)
-            prediction_dict = model.predict(preprocessed_images, shapes)
+            prediction_dict = feature_cache_util.predict_from_feature_maps(model, feature_maps)
             losses_dict = model.loss(prediction_dict, shapes)
             total_loss = losses_dict['Loss/localization_loss'] + losses_dict['Loss/classification_loss']
-            gradients = tape.gradient(total_loss, vars_to_fine_tune)
-            optimizer.apply_gradients(zip(gradients, vars_to_fine_tune))
+            gradient_loss = total_loss * gradient_scale
+            if loss_scaling:
+                gradient_loss = optimizer.get_scaled_loss(gradient_loss)
+        gradients = tape.gradient(gradient_loss, vars_to_fine_tune)
+        if loss_scaling:
+            gradients = optimizer.get_unscaled_gradients(gradients)
+        optimizer.apply_gradients(zip(gradients, vars_to_fine_tune))
         return total_loss
 
     return train_step_fn
 
 # main function:
 if __name__ == '__main__':
-    # Load images and visualize
-    # WARNING: should only load image paths - actual image loading should happen batch by batch later in training loop
-    print("Load images......")
+    # Load image paths - actual image loading happens batch by batch in the tf.data pipeline
+    # Set train_manifest_path to a JSON Lines manifest (see util/data_util.py) to
+    # train on your own data instead of the hard-coded ducky example below.
+    print("Load image paths......")
+    train_manifest_path = None
+    # or a dataset directory written by build_dataset.py (pre-resized images in
+    # sharded TFRecords: no full-resolution decode while training)
+    train_tfrecord_dir = None
+    # Head-only fine-tuning from cached features: the frozen _feature_extractor
+    # runs once per training image into this cache (reused by later runs and only
+    # extended for new images), then the steps run only the box predictor.
+    # One directory per model, checkpoint and image size; needs the image paths,
+    # i.e. not train_tfrecord_dir.
+    feature_cache_dir = None # e.g. './feature_cache/efficientdet_d0_640'
     train_image_dir = './object_detection/test_images/ducky/train/'
-    train_images_np = []
-    for i in range(1, 6):
-        image_path = os.path.join(train_image_dir, 'robertducky' + str(i) + '.jpg')
-        train_images_np.append(load_image_into_numpy_array(image_path))
+    if feature_cache_dir and train_tfrecord_dir:
+        raise ValueError('feature_cache_dir needs the training image paths, it cannot be combined with '
+                         'train_tfrecord_dir=%r; set one of them to None.' % train_tfrecord_dir)
 
     plt.rcParams['axes.grid'] = False
     plt.rcParams['xtick.labelsize'] = False
@@ -136,25 +348,9 @@ if __name__ == '__main__':
     plt.rcParams['ytick.right'] = False
     plt.rcParams['figure.figsize'] = [14, 7]
     matplotlib.use('TkAgg')
-    '''
-    for idx, train_image_np in enumerate(train_images_np):
-        plt.subplot(2, 3, idx+1)
-        plt.imshow(train_image_np)
-    plt.show()
-    '''
-    
+
     # load labeling - assume we have it being predefined
     print("Load labeling......")
-    gt_boxes = [
-             np.array([[0.436, 0.591, 0.629, 0.712]], dtype=np.float32),
-             np.array([[0.539, 0.583, 0.73, 0.71]], dtype=np.float32),
-             np.array([[0.464, 0.414, 0.626, 0.548]], dtype=np.float32),
-             np.array([[0.313, 0.308, 0.648, 0.526]], dtype=np.float32),
-             np.array([[0.256, 0.444, 0.484, 0.629]], dtype=np.float32)
-    ]
-
-    # data preparation
-    print("Data preparing......")
     # By convention, our non-background classes start counting at 1.  Given
     # that we will be predicting just one class, we will therefore assign it a
     # `class id` of 1.
@@ -163,21 +359,20 @@ if __name__ == '__main__':
 
     category_index = {duck_class_id: {'id': duck_class_id, 'name': 'rubber_ducky'}}
 
-    # Convert class labels to one-hot; convert everything to tensors.
-    # The `label_id_offset` here shifts all classes by a certain number of indices;
-    # we do this here so that the model receives one-hot labels where non-background
-    # classes start counting at the zeroth index.  This is ordinarily just handled
-    # automatically in our training binaries, but we need to reproduce it here.
-    label_id_offset = 1
-    train_image_tensors = []
-    gt_classes_one_hot_tensors = []
-    gt_box_tensors = []
-    for (train_image_np, gt_box_np) in zip(train_images_np, gt_boxes):
-        train_image_tensors.append(tf.expand_dims(tf.convert_to_tensor(train_image_np, dtype=tf.float32), axis=0))
-        gt_box_tensors.append(tf.convert_to_tensor(gt_box_np, dtype=tf.float32))
-        zero_indexed_groundtruth_classes = tf.convert_to_tensor(np.ones(shape=[gt_box_np.shape[0]], dtype=np.int32) - label_id_offset)
-        gt_classes_one_hot_tensors.append(tf.one_hot(zero_indexed_groundtruth_classes, num_classes))
-    print('Done preparing data......')
+    if train_tfrecord_dir:
+        train_image_paths, gt_boxes, gt_classes = None, None, None
+    elif train_manifest_path:
+        train_image_paths, gt_boxes, gt_classes = data_util.load_manifest(train_manifest_path)
+    else:
+        train_image_paths = [os.path.join(train_image_dir, 'robertducky' + str(i) + '.jpg') for i in range(1, 6)]
+        gt_boxes = [
+                 np.array([[0.436, 0.591, 0.629, 0.712]], dtype=np.float32),
+                 np.array([[0.539, 0.583, 0.73, 0.71]], dtype=np.float32),
+                 np.array([[0.464, 0.414, 0.626, 0.548]], dtype=np.float32),
+                 np.array([[0.313, 0.308, 0.648, 0.526]], dtype=np.float32),
+                 np.array([[0.256, 0.444, 0.484, 0.629]], dtype=np.float32)
+        ]
+        gt_classes = [np.full([gt_box_np.shape[0]], duck_class_id, dtype=np.int32) for gt_box_np in gt_boxes]
 
     # sanity check for bounding boxes
     '''
@@ -186,9 +381,9 @@ if __name__ == '__main__':
     for idx in range(5):
         plt.subplot(2, 3, idx+1)
         plot_detections(
-            train_images_np[idx],
+            load_image_into_numpy_array(train_image_paths[idx]),
             gt_boxes[idx],
-            np.ones(shape=[gt_boxes[idx].shape[0]], dtype=np.int32),
+            gt_classes[idx],
             dummy_scores, category_index)
     plt.show()
     '''
@@ -197,43 +392,28 @@ if __name__ == '__main__':
     model_display_name = 'efficientdet_d0' 
     model_name = 'efficientdet_d0_coco17_tpu-32'
 
+    # Opt-in mixed precision (bfloat16 compute with loss scaling) and XLA compilation
+    # of the training step. Run `python check.py mixed_precision` to confirm the
+    # losses stay close to the float32 baseline for your model.
+    use_mixed_precision = False
+    use_xla = False
+
+    # Data-parallel training: 'default' (single device), 'mirrored' (local GPUs, or
+    # num_cpu_devices logical CPU devices) or 'multi_worker' (hosts from TF_CONFIG).
+    distribution_strategy = 'default'
+    num_cpu_devices = 1
+    strategy = distribute_util.get_distribution_strategy(distribution_strategy, num_cpu_devices)
+
     tf.keras.backend.clear_session()
+    if use_mixed_precision:
+        enable_mixed_precision()
     print('Building model and restoring weights for fine-tuning...', flush=True)
     pipeline_config = os.path.join('./object_detection/test_data/', model_name, 'pipeline.config')
     checkpoint_path = os.path.join('./object_detection/test_data/', model_name, 'checkpoint','ckpt-0')
 
-    # Load pipeline config and build a detection model.
-    # Since we are working off of a COCO architecture which predicts 90
-    # class slots by default, we override the `num_classes` field here to be just
-    # one (for our new rubber ducky class).
-    configs = config_util.get_configs_from_pipeline_file(pipeline_config)
-    model_config = configs['model']
-    model_config.ssd.num_classes = num_classes
-    model_config.ssd.freeze_batchnorm = True
-    detection_model = model_builder.build(model_config=model_config, is_training=True)
-
-    # Set up object-based checkpoint restore --- RetinaNet has two prediction
-    # `heads` --- one for classification, the other for box regression.  We will
-    # restore the box regression head but initialize the classification head
-    # from scratch (we show the omission below by commenting out the line that
-    # we would add if we wanted to restore both heads)
-    fake_box_predictor = tf.compat.v2.train.Checkpoint(
-        _base_tower_layers_for_heads=detection_model._box_predictor._base_tower_layers_for_heads,
-        #_prediction_heads=detection_model._box_predictor._prediction_heads,
-        #    (i.e., the classification head that we *will not* restore)
-        _box_prediction_head=detection_model._box_predictor._box_prediction_head,
-    )
-    fake_model = tf.compat.v2.train.Checkpoint(
-            _feature_extractor=detection_model._feature_extractor,
-            _box_predictor=fake_box_predictor)
-    ckpt = tf.compat.v2.train.Checkpoint(model=fake_model)
-    ckpt.restore(checkpoint_path).expect_partial()
-    manager = tf.compat.v2.train.CheckpointManager(ckpt, './finetune', max_to_keep=1)
-
-    # Run model through a dummy image so that variables are created
-    image, shapes = detection_model.preprocess(tf.zeros([1, 640, 640, 3]))
-    prediction_dict = detection_model.predict(image, shapes)
-    _ = detection_model.postprocess(prediction_dict, shapes)
+    # Override `num_classes` to be just one (for our new rubber ducky class).
+    with strategy.scope():
+        detection_model, ckpt = build_fine_tune_model(pipeline_config, checkpoint_path, num_classes)
     print('Weights restored!')
 
     # eager mode custom training loop
@@ -242,43 +422,133 @@ if __name__ == '__main__':
     # These parameters can be tuned; since our training set has 5 images
     # it doesn't make sense to have a much larger batch size, though we could
     # fit more examples in memory if we wanted to.
+    # batch_size is per replica; it is split into accumulation_steps micro-batches
+    # whose gradients are summed, so the effective batch size per optimizer step is
+    # batch_size * strategy.num_replicas_in_sync.
     batch_size = 4
+    accumulation_steps = 1
     learning_rate = 0.01
     num_batches = 50
+    max_boxes = 100
+    global_batch_size = batch_size * strategy.num_replicas_in_sync
+
+    # data preparation
+    # The `label_id_offset` here shifts all classes by a certain number of indices;
+    # we do this here so that the model receives one-hot labels where non-background
+    # classes start counting at the zeroth index.  This is ordinarily just handled
+    # automatically in our training binaries, but we need to reproduce it here.
+    print("Data preparing......")
+    label_id_offset = 1
+    if feature_cache_dir:
+        start_time = time.perf_counter()
+        feature_rows = feature_cache_util.cache_feature_maps(detection_model, train_image_paths, feature_cache_dir)
+        print('Feature cache ready in %.2f s' % (time.perf_counter() - start_time), flush=True)
+        train_dataset = feature_cache_util.build_cached_feature_dataset(
+            feature_cache_dir, feature_rows, gt_boxes, gt_classes,
+            batch_size=global_batch_size,
+            num_classes=num_classes,
+            max_boxes=max_boxes,
+            label_id_offset=label_id_offset)
+    elif train_tfrecord_dir:
+        train_dataset = tfrecord_util.build_tfrecord_train_dataset(
+            train_tfrecord_dir,
+            batch_size=global_batch_size,
+            num_classes=num_classes,
+            max_boxes=max_boxes,
+            label_id_offset=label_id_offset)
+    else:
+        train_dataset = data_util.build_train_dataset(
+            train_image_paths, gt_boxes, gt_classes,
+            batch_size=global_batch_size,
+            num_classes=num_classes,
+            max_boxes=max_boxes,
+            label_id_offset=label_id_offset)
+    train_dataset = train_dataset.take(num_batches)
+    print('Done preparing data......')
 
     # Select variables in top layers to fine-tune.
-    trainable_variables = detection_model.trainable_variables
-    to_fine_tune = []
     prefixes_to_train = ['WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalBoxHead',
                          'WeightSharedConvolutionalBoxPredictor/WeightSharedConvolutionalClassHead']
+    to_fine_tune = get_fine_tune_variables(detection_model, prefixes_to_train)
+
+    with strategy.scope():
+        optimizer = tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=0.9)
+        if use_mixed_precision:
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        if feature_cache_dir:
+            train_step_fn = get_cached_features_train_step_function(
+                detection_model, optimizer, to_fine_tune,
+                batch_size=batch_size,
+                num_classes=num_classes,
+                feature_shapes=feature_cache_util.load_feature_shapes(feature_cache_dir),
+                max_boxes=max_boxes,
+                jit_compile=use_xla)
+        else:
+            train_step_fn = get_model_train_step_function(
+                detection_model, optimizer, to_fine_tune,
+                batch_size=batch_size,
+                num_classes=num_classes,
+                max_boxes=max_boxes,
+                jit_compile=use_xla,
+                accumulation_steps=accumulation_steps)
+    train_step_fn = distribute_util.get_distributed_train_step_function(strategy, train_step_fn)
+
+    # Checkpointing: with use_async_checkpoint the whole training state (model,
+    # optimizer slots, step) is saved every 10 steps, written in the background
+    # (TensorFlow >= 2.12), and a rerun resumes from the latest one; otherwise the
+    # restored part of the model is saved synchronously with a CheckpointManager.
+    use_async_checkpoint = False
+    checkpoint_dir = './finetune'
+    start_step = 0
+    if use_async_checkpoint:
+        checkpointer = checkpoint_util.AsyncCheckpointer(
+            detection_model, optimizer, checkpoint_dir, max_to_keep=1, async_save=True, strategy=strategy)
+        start_step = checkpointer.restore_latest(to_fine_tune)
+        if start_step:
+            print('Resumed from step %d' % start_step)
+    else:
+        manager = distribute_util.get_checkpoint_manager(ckpt, checkpoint_dir, strategy, max_to_keep=1)
+    # the steps already done by the resumed run are not repeated
+    train_dataset = strategy.experimental_distribute_dataset(train_dataset.skip(start_step))
 
-    for var in trainable_variables:
-        if any([var.name.startswith(prefix) for prefix in prefixes_to_train]):
-            to_fine_tune.append(var)
-    
-    optimizer = tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=0.9)
-    train_step_fn = get_model_train_step_function(detection_model, optimizer, to_fine_tune)
+    # Per-step instrumentation: input wait, training step (synced with the
+    # device), checkpoint; optionally a tf.profiler trace of a window of steps
+    # and a JSON summary with percentiles for tracking regressions.
+    profile_summary_path = None # e.g. 'train_profile.json'
+    trace_dir = None # e.g. './logs/train', view with TensorBoard's profile tab
+    profiler = profile_util.Profiler(trace_dir, trace_start_step=10, trace_num_steps=5)
 
     print('Start fine-tuning......', flush=True)
-    for idx in range(num_batches):
-        # WARNING: should handle actual data loading here batch by batch
-
-        # Grab keys for a random subset of examples
-        all_keys = list(range(len(train_images_np)))
-        random.shuffle(all_keys)
-        example_keys = all_keys[:batch_size]
-        
-        # get images/boxes/classes
-        gt_boxes_list = [gt_box_tensors[key] for key in example_keys]
-        gt_classes_list = [gt_classes_one_hot_tensors[key] for key in example_keys]
-        image_tensors = [train_image_tensors[key] for key in example_keys]
-
-        # Training step (forward pass + backwards pass)
-        total_loss = train_step_fn(image_tensors, gt_boxes_list, gt_classes_list)
-
-        if idx % 10 == 0:
-            print('batch ' + str(idx) + ' of ' + str(num_batches) + ', loss=' +  str(total_loss.numpy()), flush=True)
-            # save ckpts
-            save_path = manager.save()
-
+    start_time = time.perf_counter()
+    input_start_time = time.perf_counter()
+    # `images` are the cached feature maps with feature_cache_dir
+    for idx, (images, boxes, classes_one_hot, num_boxes) in enumerate(train_dataset, start_step):
+        profiler.add('input', time.perf_counter() - input_start_time)
+        with profiler.step():
+            # Training step (forward pass + backwards pass)
+            total_loss = profiler.time('train_step', train_step_fn, images, boxes, classes_one_hot, num_boxes)
+
+            if idx % 10 == 0:
+                print('batch ' + str(idx) + ' of ' + str(num_batches) + ', loss=' +  str(total_loss.numpy()) +
+                      ', steps/sec=' + '%.2f' % ((idx + 1 - start_step) / (time.perf_counter() - start_time)),
+                      flush=True)
+                # save ckpts
+                if not use_async_checkpoint:
+                    save_path = profiler.time('checkpoint', manager.save)
+                    distribute_util.remove_worker_checkpoints(manager, strategy)
+                else:
+                    profiler.time('checkpoint', checkpointer.save, idx + 1)
+        input_start_time = time.perf_counter()
+    profiler.stop_trace()
+
+    if use_async_checkpoint:
+        checkpointer.close()
+        print('Checkpointing blocked the training loop for %.3f s over %d saves' %
+              (checkpointer.blocked_seconds, checkpointer.num_saves))
+    for line in profiler.report():
+        print(line)
+    if profile_summary_path:
+        profiler.write_summary(profile_summary_path, model_name=model_name, batch_size=batch_size,
+                               num_replicas=strategy.num_replicas_in_sync, accumulation_steps=accumulation_steps,
+                               use_mixed_precision=use_mixed_precision, use_xla=use_xla)
     print('Done fine-tuning......')
\ No newline at end of file
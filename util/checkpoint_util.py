@@ -0,0 +1,107 @@
+'''
+This code is for saving and resuming the whole fine-tuning state without blocking the training loop.
+
+The model, the optimizer (with its slots) and the step counter are saved as an
+object-based tf.train.Checkpoint, so they are matched by their place in the
+object graph and the checkpoints can be read by tf.train.Checkpoint and
+CheckpointManager. With async_save TensorFlow copies the variables to host
+memory in save() and writes them on a background thread
+(CheckpointOptions.experimental_enable_async_checkpoint), so slow (e.g.
+network) filesystems no longer stall the steps.
+'''
+import time
+
+import tensorflow as tf
+
+from util import distribute_util
+
+
+def create_optimizer_slots(optimizer, var_list, strategy=None):
+    """Create the optimizer slot variables up front so that they can be restored into.
+
+    Keras optimizers create their slots (e.g. momentum) on the first
+    apply_gradients(); one call with zero gradients does it for any optimizer.
+    Its side effects do not matter, as restoring overwrites every saved variable.
+    """
+    strategy = strategy or tf.distribute.get_strategy()
+
+    def _apply_zero_gradients():
+        optimizer.apply_gradients(zip([tf.zeros_like(var) for var in var_list], var_list))
+
+    tf.function(lambda: strategy.run(_apply_zero_gradients))()
+
+
+class AsyncCheckpointer(object):
+    """Save the model, optimizer (with its slots) and step counter, optionally in the background.
+
+    Args:
+        model: the detection model.
+        optimizer: the Keras optimizer, whose slots and iteration count are saved.
+        directory: where the checkpoints are written.
+        max_to_keep: the number of most recent checkpoints kept.
+        async_save: write on a background thread; otherwise save() writes
+        before returning. Falls back to synchronous saves on TensorFlow
+        versions without asynchronous checkpointing.
+        strategy: the tf.distribute strategy of the model; under
+        MultiWorkerMirroredStrategy every worker calls save() and only the
+        chief's checkpoints are kept.
+    """
+
+    def __init__(self, model, optimizer, directory, max_to_keep=1, async_save=True, strategy=None):
+        self._strategy = strategy or tf.distribute.get_strategy()
+        self._step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, step=self._step)
+        self._manager = distribute_util.get_checkpoint_manager(
+            self._checkpoint, directory, self._strategy, max_to_keep=max_to_keep)
+        self.directory = directory
+        self.async_save = async_save
+        try:
+            self._options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+        except TypeError:  # TensorFlow < 2.12
+            self._options = tf.train.CheckpointOptions()
+            self.async_save = False
+        # time the training thread spent in save()/close(), including waits for the previous write
+        self.blocked_seconds = 0.0
+        self.num_saves = 0
+
+    def _sync(self):
+        """Wait until the pending asynchronous write is done."""
+        if self.async_save:
+            self._checkpoint.sync()
+
+    def save(self, step):
+        """Save the current state for `step` (written in the background if async)."""
+        start_time = time.perf_counter()
+        self._step.assign(step)
+        self._manager.save(checkpoint_number=step, options=self._options)
+        if not distribute_util.is_chief(self._strategy):
+            self._sync()
+            distribute_util.remove_worker_checkpoints(self._manager, self._strategy)
+        self.num_saves += 1
+        self.blocked_seconds += time.perf_counter() - start_time
+
+    def restore_latest(self, var_list=None):
+        """Restore the latest checkpoint in the directory, if any.
+
+        Args:
+            var_list: the variables the optimizer trains; when given, its slots
+            are created first with create_optimizer_slots() so that they are
+            restored too (instead of being restored lazily on the first step).
+
+        Returns:
+            the restored step counter, 0 if there is no checkpoint.
+        """
+        if self._manager.latest_checkpoint is None:
+            return 0
+        if var_list is not None:
+            create_optimizer_slots(self._checkpoint.optimizer, var_list, self._strategy)
+        status = self._checkpoint.restore(self._manager.latest_checkpoint)
+        # fails on a checkpoint of another model or optimizer setup instead of a silent partial restore
+        status.assert_existing_objects_matched()
+        return int(self._step.numpy())
+
+    def close(self):
+        """Wait until the pending checkpoint is written."""
+        start_time = time.perf_counter()
+        self._sync()
+        self.blocked_seconds += time.perf_counter() - start_time
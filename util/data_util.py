@@ -0,0 +1,260 @@
+'''
+This code is for streaming training data with tf.data instead of holding every image in memory.
+'''
+import glob
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+import tensorflow as tf
+
+
+def load_manifest(manifest_path):
+    """Load a JSON Lines manifest of training examples.
+
+    Each line holds one image, e.g.
+    {"image_path": "a.jpg", "boxes": [[ymin, xmin, ymax, xmax], ...], "classes": [1, ...]}
+    where boxes are normalized to [0, 1] and classes are 1-based label map ids.
+    "classes" may be omitted, in which case every box gets class 1.
+
+    Args:
+        manifest_path: the file path to the manifest
+
+    Returns:
+        image_paths: a list of image file paths.
+        boxes_list: a list of float32 numpy arrays of shape [N_i, 4].
+        classes_list: a list of int32 numpy arrays of shape [N_i].
+    """
+    image_paths, boxes_list, classes_list = [], [], []
+    with tf.io.gfile.GFile(manifest_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            boxes = np.asarray(example['boxes'], dtype=np.float32).reshape([-1, 4])
+            classes = np.asarray(example.get('classes', [1] * boxes.shape[0]), dtype=np.int32)
+            image_paths.append(example['image_path'])
+            boxes_list.append(boxes)
+            classes_list.append(classes)
+    return image_paths, boxes_list, classes_list
+
+
+def load_coco_annotations(annotations_path, image_dir):
+    """Load a COCO-style detection JSON file.
+
+    The category ids are remapped to contiguous 1-based ids in the order of
+    their original ids; crowd annotations are skipped.
+
+    Args:
+        annotations_path: the COCO instances JSON file.
+        image_dir: the directory the "file_name" of the images are relative to.
+
+    Returns:
+        image_paths, boxes_list (normalized [ymin, xmin, ymax, xmax]) and
+        classes_list as load_manifest(), and the class names of ids 1, 2, ...
+    """
+    with tf.io.gfile.GFile(annotations_path, 'r') as f:
+        coco = json.load(f)
+    categories = sorted(coco['categories'], key=lambda category: category['id'])
+    class_ids = {category['id']: i + 1 for i, category in enumerate(categories)}
+    images = {image['id']: image for image in coco['images']}
+    objects = {image_id: [] for image_id in images}
+    for annotation in coco.get('annotations', []):
+        if not annotation.get('iscrowd', 0):
+            objects[annotation['image_id']].append(annotation)
+
+    image_paths, boxes_list, classes_list = [], [], []
+    for image_id, image in images.items():
+        x, y, w, h = np.asarray([annotation['bbox'] for annotation in objects[image_id]],
+                                dtype=np.float32).reshape([-1, 4]).T
+        boxes = np.stack([y / image['height'], x / image['width'],
+                          (y + h) / image['height'], (x + w) / image['width']], axis=1)
+        image_paths.append(os.path.join(image_dir, image['file_name']))
+        boxes_list.append(np.clip(boxes, 0.0, 1.0))
+        classes_list.append(np.asarray([class_ids[annotation['category_id']] for annotation in objects[image_id]],
+                                       dtype=np.int32))
+    return image_paths, boxes_list, classes_list, [category['name'] for category in categories]
+
+
+def load_voc_annotations(voc_dir, class_names=None, image_set=None):
+    """Load Pascal VOC style annotations (Annotations/*.xml, JPEGImages/).
+
+    Args:
+        voc_dir: the directory holding Annotations/ and JPEGImages/.
+        class_names: the class names of ids 1, 2, ...; by default the sorted
+        names found in the annotations.
+        image_set: optional ImageSets/Main/<image_set>.txt list of image ids
+        (e.g. 'train'); all the annotation files by default.
+
+    Returns:
+        image_paths, boxes_list, classes_list and class_names, as load_coco_annotations().
+    """
+    if image_set:
+        with tf.io.gfile.GFile(os.path.join(voc_dir, 'ImageSets', 'Main', image_set + '.txt'), 'r') as f:
+            xml_paths = [os.path.join(voc_dir, 'Annotations', line.split()[0] + '.xml') for line in f if line.strip()]
+    else:
+        xml_paths = sorted(glob.glob(os.path.join(voc_dir, 'Annotations', '*.xml')))
+    examples = []
+    for xml_path in xml_paths:
+        root = ElementTree.parse(xml_path).getroot()
+        width = float(root.find('size/width').text)
+        height = float(root.find('size/height').text)
+        names, boxes = [], []
+        for obj in root.findall('object'):
+            box = obj.find('bndbox')
+            # VOC pixel coordinates are 1-based and inclusive
+            xmin, ymin, xmax, ymax = [float(box.find(key).text) for key in ['xmin', 'ymin', 'xmax', 'ymax']]
+            boxes.append([(ymin - 1) / height, (xmin - 1) / width, ymax / height, xmax / width])
+            names.append(obj.find('name').text.strip())
+        examples.append((os.path.join(voc_dir, 'JPEGImages', root.find('filename').text), names, boxes))
+
+    class_names = class_names or sorted({name for _, names, _ in examples for name in names})
+    class_ids = {name: i + 1 for i, name in enumerate(class_names)}
+    image_paths, boxes_list, classes_list = [], [], []
+    for image_path, names, boxes in examples:
+        known = [i for i, name in enumerate(names) if name in class_ids]
+        image_paths.append(image_path)
+        boxes_list.append(np.clip(np.asarray(boxes, dtype=np.float32).reshape([-1, 4])[known], 0.0, 1.0))
+        classes_list.append(np.asarray([class_ids[names[i]] for i in known], dtype=np.int32))
+    return image_paths, boxes_list, classes_list, list(class_names)
+
+
+def list_image_paths(input_spec, extensions=('.jpg', '.jpeg', '.png', '.bmp', '.gif')):
+    """List image paths from a directory, a glob pattern or a manifest file.
+
+    Args:
+        input_spec: a directory (searched recursively for `extensions`), a glob
+        pattern, a .txt file with one path per line or a .jsonl manifest as read
+        by load_manifest().
+        extensions: the image file extensions to keep when listing a directory.
+
+    Returns:
+        a list of image paths, sorted for directories and glob patterns.
+    """
+    if os.path.isdir(input_spec):
+        return sorted(os.path.join(root, name)
+                      for root, _, names in os.walk(input_spec)
+                      for name in names if name.lower().endswith(extensions))
+    if input_spec.endswith('.jsonl'):
+        return load_manifest(input_spec)[0]
+    if input_spec.endswith('.txt'):
+        with tf.io.gfile.GFile(input_spec, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    return sorted(glob.glob(input_spec, recursive=True))
+
+
+def pad_groundtruth(boxes_list, classes_list, max_boxes):
+    """Pad per-image groundtruth to fixed-size arrays.
+
+    Args:
+        boxes_list: a list of numpy arrays of shape [N_i, 4].
+        classes_list: a list of numpy arrays of shape [N_i] with 1-based class ids.
+        max_boxes: the number of box slots per image.
+
+    Returns:
+        boxes: float32 numpy array of shape [num_images, max_boxes, 4].
+        classes: int32 numpy array of shape [num_images, max_boxes], padded with 0.
+        num_boxes: int32 numpy array of shape [num_images].
+    """
+    num_images = len(boxes_list)
+    boxes = np.zeros([num_images, max_boxes, 4], dtype=np.float32)
+    classes = np.zeros([num_images, max_boxes], dtype=np.int32)
+    num_boxes = np.zeros([num_images], dtype=np.int32)
+    for i, (image_boxes, image_classes) in enumerate(zip(boxes_list, classes_list)):
+        if image_boxes.shape[0] > max_boxes:
+            raise ValueError('Image %d has %d boxes, more than max_boxes=%d.' %
+                             (i, image_boxes.shape[0], max_boxes))
+        num_boxes[i] = image_boxes.shape[0]
+        boxes[i, :num_boxes[i]] = image_boxes
+        classes[i, :num_boxes[i]] = image_classes
+    return boxes, classes, num_boxes
+
+
+def decode_and_resize(image_path, image_size):
+    """Read, decode and resize one image inside a tf.data map function.
+
+    Returns:
+        float32 tensor of shape [image_size, image_size, 3] with values in [0, 255].
+    """
+    image = tf.io.decode_image(tf.io.read_file(image_path), channels=3, expand_animations=False)
+    image.set_shape([None, None, 3])
+    return tf.image.resize(image, [image_size, image_size])
+
+
+def build_train_dataset(image_paths,
+                        boxes_list,
+                        classes_list,
+                        batch_size,
+                        num_classes,
+                        image_size=640,
+                        max_boxes=100,
+                        label_id_offset=1,
+                        shuffle_buffer_size=10000,
+                        seed=None):
+    """Build a repeating, shuffled, prefetched training dataset of fixed-shape batches.
+
+    Only image paths and (small) groundtruth arrays are held in memory. Paths are
+    shuffled before decoding, images are decoded and resized in parallel with an
+    autotuned number of calls, and batches are prefetched so the training step
+    does not wait on the host.
+
+    Args:
+        image_paths: a list of image file paths.
+        boxes_list: a list of numpy arrays of shape [N_i, 4] of normalized boxes.
+        classes_list: a list of numpy arrays of shape [N_i] with 1-based class ids.
+        batch_size: the number of images per batch; the last partial batch of
+        each epoch is dropped so every batch has the same shape.
+        num_classes: the number of non-background classes.
+        image_size: images are resized to [image_size, image_size].
+        max_boxes: the number of box slots per image.
+        label_id_offset: shifts class ids so that the first non-background class
+        has one-hot index 0.
+        shuffle_buffer_size: the size of the shuffle buffer (over paths, not pixels).
+        seed: optional shuffle seed.
+
+    Returns:
+        A tf.data.Dataset yielding (images, boxes, classes_one_hot, num_boxes) with
+        shapes [B, image_size, image_size, 3], [B, max_boxes, 4],
+        [B, max_boxes, num_classes] and [B]. Padded box slots have all-zero
+        one-hot classes.
+    """
+    boxes, classes, num_boxes = pad_groundtruth(boxes_list, classes_list, max_boxes)
+
+    def _load_example(image_path, example_boxes, example_classes, example_num_boxes):
+        image = decode_and_resize(image_path, image_size)
+        # padded slots get index -1, which tf.one_hot maps to an all-zero row
+        valid = tf.range(max_boxes) < example_num_boxes
+        zero_indexed_classes = tf.where(valid, example_classes - label_id_offset, -1)
+        classes_one_hot = tf.one_hot(zero_indexed_classes, num_classes)
+        return image, example_boxes, classes_one_hot, example_num_boxes
+
+    dataset = tf.data.Dataset.from_tensor_slices((image_paths, boxes, classes, num_boxes))
+    dataset = dataset.shuffle(min(shuffle_buffer_size, len(image_paths)),
+                              seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.repeat()
+    dataset = dataset.map(_load_example, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_synthetic_batch(batch_size, num_classes, image_size=640, max_boxes=100, seed=0):
+    """Make a deterministic random batch in the format of build_train_dataset.
+
+    Used by the benchmarks and checks so they run without any dataset on disk.
+    Each image gets one box of class 1.
+
+    Returns:
+        (images, boxes, classes_one_hot, num_boxes) float32/int32 numpy arrays.
+    """
+    rng = np.random.RandomState(seed)
+    images = rng.uniform(0, 255, size=(batch_size, image_size, image_size, 3)).astype(np.float32)
+    boxes = np.zeros((batch_size, max_boxes, 4), dtype=np.float32)
+    # sorting two random (y, x) points per image gives [[ymin, xmin], [ymax, xmax]]
+    corners = np.sort(rng.uniform(0.1, 0.9, size=(batch_size, 2, 2)), axis=1)
+    boxes[:, 0] = corners.reshape(batch_size, 4)
+    classes_one_hot = np.zeros((batch_size, max_boxes, num_classes), dtype=np.float32)
+    classes_one_hot[:, 0, 0] = 1.0
+    num_boxes = np.ones([batch_size], dtype=np.int32)
+    return images, boxes, classes_one_hot, num_boxes
@@ -0,0 +1,94 @@
+'''
+This code is for running the fine-tuning loop under a tf.distribute strategy.
+'''
+import os
+
+import tensorflow as tf
+
+
+def get_distribution_strategy(distribution_strategy='default', num_cpu_devices=1):
+    """Create a tf.distribute strategy.
+
+    Must be called before any other TensorFlow op runs, since splitting the CPU
+    into logical devices is only possible before the runtime is initialized.
+
+    Args:
+        distribution_strategy: one of
+            'default': no distribution, a single device.
+            'mirrored': synchronous data parallelism over the local GPUs, or over
+            `num_cpu_devices` logical CPU devices if there is no GPU.
+            'multi_worker': synchronous data parallelism across hosts, the cluster
+            is read from the TF_CONFIG environment variable.
+        num_cpu_devices: the number of logical CPU devices for 'mirrored'.
+
+    Returns:
+        a tf.distribute.Strategy.
+    """
+    if distribution_strategy == 'default':
+        return tf.distribute.get_strategy()
+    if distribution_strategy == 'mirrored':
+        if tf.config.list_physical_devices('GPU'):
+            return tf.distribute.MirroredStrategy()
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(
+            cpu, [tf.config.LogicalDeviceConfiguration()] * num_cpu_devices)
+        devices = ['/cpu:%d' % i for i in range(num_cpu_devices)]
+        # NCCL all-reduce is GPU only, reduce the CPU replicas on one device instead
+        return tf.distribute.MirroredStrategy(
+            devices=devices, cross_device_ops=tf.distribute.ReductionToOneDevice())
+    if distribution_strategy == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError('Unknown distribution strategy: %s' % distribution_strategy)
+
+
+def is_chief(strategy):
+    """Whether this process is the chief, i.e. the one whose checkpoints are kept."""
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.task_type:
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    # without an explicit chief, worker 0 plays that role
+    return (resolver.task_type == 'worker' and resolver.task_id == 0 and
+            'chief' not in resolver.cluster_spec().as_dict())
+
+
+def get_checkpoint_manager(ckpt, checkpoint_dir, strategy, max_to_keep=1):
+    """Create a CheckpointManager that only keeps the chief's checkpoints.
+
+    With MultiWorkerMirroredStrategy every worker has to take part in saving
+    (it runs collective ops), so non-chief workers write into a per-worker
+    temporary directory that should be removed after each save with
+    remove_worker_checkpoints().
+    """
+    if not is_chief(strategy):
+        checkpoint_dir = os.path.join(checkpoint_dir, 'workertemp_%d' % strategy.cluster_resolver.task_id)
+    return tf.compat.v2.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=max_to_keep)
+
+
+def remove_worker_checkpoints(manager, strategy):
+    """Delete the throwaway checkpoints written by a non-chief worker."""
+    if not is_chief(strategy):
+        tf.io.gfile.rmtree(manager.directory)
+
+
+def get_distributed_train_step_function(strategy, train_step_fn):
+    """Wrap a per-replica training step so that it runs on every replica.
+
+    Args:
+        strategy: the tf.distribute strategy the model and optimizer were built under.
+        train_step_fn: a per-replica step, e.g. from train.get_model_train_step_function,
+        whose batch size is the per-replica batch size.
+
+    Returns:
+        a tf.function taking one distributed batch (from
+        strategy.experimental_distribute_dataset) and returning the mean loss.
+    """
+
+    @tf.function
+    def distributed_train_step_fn(images, groundtruth_boxes, groundtruth_classes, num_groundtruth_boxes):
+        per_replica_losses = strategy.run(
+            train_step_fn, args=(images, groundtruth_boxes, groundtruth_classes, num_groundtruth_boxes))
+        return strategy.reduce(tf.distribute.ReduceOp.MEAN, per_replica_losses, axis=None)
+
+    return distributed_train_step_fn
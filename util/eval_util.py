@@ -0,0 +1,158 @@
+'''
+This code is for computing COCO-style mAP@[.5:.95] over detections streamed batch by batch.
+
+Each image is matched on arrival and only its true/false positive counts are
+kept, binned by score per class and IoU threshold, so memory is bounded by
+num_classes x num_iou_thresholds x num_score_bins whatever the dataset size.
+'''
+import numpy as np
+
+from util import postprocess_util
+
+# the COCO IoU thresholds .50:.05:.95 and 101-point recall grid
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+COCO_RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+
+
+def match_detections(detection_boxes, detection_classes, groundtruth_boxes, groundtruth_classes,
+                     iou_thresholds=COCO_IOU_THRESHOLDS):
+    """Match the detections of one image to its groundtruth, COCO style.
+
+    Detections are taken in the given (descending score) order, and each one is
+    matched to the unmatched groundtruth box of the same class with the highest
+    IoU, if that IoU is at least the threshold.
+
+    Args:
+        detection_boxes: [D, 4] boxes sorted by descending score.
+        detection_classes: [D] class ids.
+        groundtruth_boxes: [G, 4] boxes in the same coordinates.
+        groundtruth_classes: [G] class ids.
+        iou_thresholds: [T] IoU thresholds.
+
+    Returns:
+        a [T, D] bool array, True where the detection is a true positive.
+    """
+    num_detections = len(detection_classes)
+    is_true_positive = np.zeros((len(iou_thresholds), num_detections), dtype=bool)
+    if num_detections == 0 or len(groundtruth_classes) == 0:
+        return is_true_positive
+    iou = postprocess_util.batched_iou(detection_boxes, groundtruth_boxes)
+    # a detection can only match groundtruth of its own class
+    iou = np.where(np.asarray(detection_classes)[:, np.newaxis] == np.asarray(groundtruth_classes)[np.newaxis],
+                   iou, -1)
+    thresholds = np.asarray(iou_thresholds)[:, np.newaxis]
+    matched = np.zeros((len(iou_thresholds), len(groundtruth_classes)), dtype=bool)
+    rows = np.arange(len(iou_thresholds))
+    # greedy in score order; every step is vectorized over thresholds and groundtruth
+    for d in range(num_detections):
+        candidates = ~matched & (iou[d][np.newaxis] >= thresholds)
+        best = np.argmax(np.where(candidates, iou[d][np.newaxis], -1), axis=1)
+        found = candidates[rows, best]
+        is_true_positive[:, d] = found
+        matched[rows[found], best[found]] = True
+    return is_true_positive
+
+
+class StreamingCocoEvaluator(object):
+    """Accumulate COCO-style precision/recall over a stream of detection batches.
+
+    Args:
+        num_classes: the class ids are 1..num_classes; others are ignored.
+        iou_thresholds: the IoU thresholds averaged by mAP.
+        max_detections: the highest scoring detections kept per image (COCO maxDets).
+        num_score_bins: the score resolution of the accumulators; detections
+        whose scores fall into the same bin are ranked as ties.
+    """
+
+    def __init__(self, num_classes, iou_thresholds=COCO_IOU_THRESHOLDS, max_detections=100,
+                 num_score_bins=1000):
+        self.num_classes = num_classes
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float32)
+        self.max_detections = max_detections
+        self.num_score_bins = num_score_bins
+        shape = (num_classes, len(self.iou_thresholds), num_score_bins)
+        self._true_positives = np.zeros(shape, dtype=np.int64)
+        self._false_positives = np.zeros(shape, dtype=np.int64)
+        self._num_groundtruth = np.zeros(num_classes, dtype=np.int64)
+        self.num_images = 0
+
+    def add_image(self, detection_boxes, detection_scores, detection_classes,
+                  groundtruth_boxes, groundtruth_classes):
+        """Add the detections and groundtruth of one image; boxes in the same (normalized) coordinates."""
+        detection_scores = np.asarray(detection_scores, dtype=np.float32)
+        detection_classes = np.asarray(detection_classes, dtype=np.int64)
+        groundtruth_classes = np.asarray(groundtruth_classes, dtype=np.int64).reshape(-1)
+        order = np.argsort(-detection_scores, kind='stable')[:self.max_detections]
+        order = order[(detection_classes[order] >= 1) & (detection_classes[order] <= self.num_classes)]
+        groundtruth_valid = (groundtruth_classes >= 1) & (groundtruth_classes <= self.num_classes)
+        groundtruth_boxes = np.asarray(groundtruth_boxes, dtype=np.float32).reshape(-1, 4)[groundtruth_valid]
+        groundtruth_classes = groundtruth_classes[groundtruth_valid]
+
+        is_true_positive = match_detections(
+            np.asarray(detection_boxes, dtype=np.float32)[order], detection_classes[order],
+            groundtruth_boxes, groundtruth_classes, self.iou_thresholds)
+        score_bins = np.minimum((detection_scores[order] * self.num_score_bins).astype(np.int64),
+                                self.num_score_bins - 1)
+        index = (detection_classes[order][np.newaxis] - 1, np.arange(len(self.iou_thresholds))[:, np.newaxis],
+                 np.maximum(score_bins, 0)[np.newaxis])
+        np.add.at(self._true_positives, index, is_true_positive)
+        np.add.at(self._false_positives, index, ~is_true_positive)
+        np.add.at(self._num_groundtruth, groundtruth_classes - 1, 1)
+        self.num_images += 1
+
+    def add_batch(self, detections, groundtruth_boxes_list, groundtruth_classes_list, label_id_offset=0):
+        """Add a batch of detections, e.g. from get_model_detection_function() after .numpy().
+
+        Args:
+            detections: a dict of [B, N, 4] 'detection_boxes', [B, N] 'detection_scores'
+            and 'detection_classes', and optionally [B] 'num_detections'.
+            groundtruth_boxes_list: B arrays of [G, 4] boxes.
+            groundtruth_classes_list: B arrays of [G] class ids (1-based).
+            label_id_offset: added to the detected classes, 1 for the 0-based
+            classes of the object detection API models.
+        """
+        num_detections = detections.get('num_detections')
+        for i, (groundtruth_boxes, groundtruth_classes) in enumerate(
+                zip(groundtruth_boxes_list, groundtruth_classes_list)):
+            num = int(num_detections[i]) if num_detections is not None else None
+            self.add_image(detections['detection_boxes'][i][:num],
+                           detections['detection_scores'][i][:num],
+                           np.asarray(detections['detection_classes'][i][:num]).astype(np.int64) + label_id_offset,
+                           groundtruth_boxes, groundtruth_classes)
+
+    def evaluate(self):
+        """Compute the COCO-style metrics from the accumulators.
+
+        Returns:
+            a dict with 'mAP' (over IoU .50:.95), 'mAP@0.50', 'mAP@0.75', and
+            'per_class_AP' (NaN for classes without groundtruth, which are
+            left out of the means).
+        """
+        # cumulative counts from the highest score bin down
+        true_positives = np.cumsum(self._true_positives[..., ::-1], axis=-1)
+        false_positives = np.cumsum(self._false_positives[..., ::-1], axis=-1)
+        num_groundtruth = self._num_groundtruth[:, np.newaxis, np.newaxis]
+        recall = true_positives / np.maximum(num_groundtruth, 1)
+        num_predicted = true_positives + false_positives
+        precision = np.where(num_predicted > 0, true_positives / np.maximum(num_predicted, 1), 0)
+        # interpolated precision: the best precision at this recall or higher
+        precision = np.maximum.accumulate(precision[..., ::-1], axis=-1)[..., ::-1]
+
+        average_precision = np.zeros((self.num_classes, len(self.iou_thresholds)))
+        for c in range(self.num_classes):
+            # the first bin reaching each recall threshold; precision 0 past the last one
+            first = (recall[c][..., np.newaxis, :] < COCO_RECALL_THRESHOLDS[:, np.newaxis]).sum(axis=-1)
+            padded = np.concatenate([precision[c], np.zeros((len(self.iou_thresholds), 1))], axis=-1)
+            average_precision[c] = np.take_along_axis(padded, first, axis=-1).mean(axis=-1)
+        average_precision[self._num_groundtruth == 0] = np.nan
+
+        def _mean_at(iou_threshold):
+            index = int(np.argmin(np.abs(self.iou_thresholds - iou_threshold)))
+            if abs(self.iou_thresholds[index] - iou_threshold) > 1e-6:
+                return float('nan')
+            return float(np.nanmean(average_precision[:, index]))
+
+        return {'mAP': float(np.nanmean(average_precision)),
+                'mAP@0.50': _mean_at(0.5),
+                'mAP@0.75': _mean_at(0.75),
+                'per_class_AP': average_precision.mean(axis=1)}
@@ -0,0 +1,111 @@
+'''
+This code is for exporting a restored detection model to SavedModel/TFLite and loading it back.
+'''
+import os
+import tempfile
+
+import numpy as np
+
+import tensorflow as tf
+
+# the detection outputs kept in the exported signatures
+DETECTION_KEYS = ['detection_boxes', 'detection_scores', 'detection_classes', 'num_detections']
+
+
+def _get_serving_function(model, input_shape):
+    """Get a signature-fixed tf.function running preprocess/predict/postprocess."""
+
+    @tf.function(input_signature=[tf.TensorSpec(input_shape, tf.float32, name='images')])
+    def serve(images):
+        preprocessed_images, shapes = model.preprocess(images)
+        prediction_dict = model.predict(preprocessed_images, shapes)
+        detections = model.postprocess(prediction_dict, shapes)
+        return {key: detections[key] for key in DETECTION_KEYS}
+
+    return serve
+
+
+def export_saved_model(model, export_dir, input_shape=(None, None, None, 3)):
+    """Export a restored detection model as a serving SavedModel.
+
+    The graph is traced once here, so loading it back skips the model building
+    from pipeline.config, the checkpoint restore and the tracing.
+
+    Args:
+        model: the restored detection model.
+        export_dir: the SavedModel directory to write.
+        input_shape: the [batch, height, width, 3] float32 input shape of the
+        'serving_default' signature; None dimensions stay dynamic.
+    """
+    module = tf.Module()
+    module.model = model
+    module.serve = _get_serving_function(model, list(input_shape))
+    tf.saved_model.save(module, export_dir, signatures={'serving_default': module.serve})
+
+
+def export_tflite(model, tflite_path, image_size):
+    """Export a restored detection model as a dynamic-range quantized TFLite model.
+
+    Weights are stored as int8 and dequantized on the fly. The post-processing
+    (NMS) ops have no TFLite builtin, so they run through the TF select ops.
+
+    Args:
+        model: the restored detection model.
+        tflite_path: the .tflite file to write.
+        image_size: the static input height and width; the batch size is 1.
+
+    Returns:
+        the size of the TFLite model in bytes.
+    """
+    saved_model_dir = tempfile.mkdtemp()
+    try:
+        export_saved_model(model, saved_model_dir, input_shape=(1, image_size, image_size, 3))
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        tflite_model = converter.convert()
+    finally:
+        # the temporary SavedModel is removed even when the export or the conversion fails
+        tf.io.gfile.rmtree(saved_model_dir)
+    with tf.io.gfile.GFile(tflite_path, 'wb') as f:
+        f.write(tflite_model)
+    return len(tflite_model)
+
+
+def exported_max_batch_size(path):
+    """The largest batch an exported model accepts: 1 for .tflite (traced at batch 1), None (unbounded) otherwise."""
+    return 1 if path.endswith('.tflite') else None
+
+
+def load_exported_detection_function(path, num_threads=None):
+    """Load an exported SavedModel directory or .tflite file as a detection function.
+
+    The returned function has the same contract as
+    inference.get_model_detection_function(): it takes a float32
+    [batch, height, width, 3] batch and returns (detections, prediction_dict,
+    shapes), where only the detections dict (of DETECTION_KEYS tensors) is filled.
+
+    Args:
+        path: a SavedModel directory or a .tflite file.
+        num_threads: the number of TFLite interpreter threads.
+    """
+    if path.endswith('.tflite'):
+        interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        runner = interpreter.get_signature_runner('serving_default')
+
+        def detect_fn(images):
+            outputs = runner(images=np.asarray(images, dtype=np.float32))
+            return {key: tf.convert_to_tensor(outputs[key]) for key in DETECTION_KEYS}, {}, None
+
+        return detect_fn
+
+    if not os.path.isdir(path):
+        raise ValueError('Not a SavedModel directory or .tflite file: %s' % path)
+    loaded = tf.saved_model.load(path)
+
+    def detect_fn(images):
+        # `loaded` is referenced here so that its variables outlive this call
+        detections = loaded.signatures['serving_default'](images=tf.convert_to_tensor(images, tf.float32))
+        return detections, {}, None
+
+    return detect_fn
@@ -0,0 +1,146 @@
+'''
+This code is for head-only fine-tuning from cached backbone features.
+
+When only the box/class heads are trained, the _feature_extractor (backbone +
+FPN/BiFPN) of an SSD model is frozen: with frozen batch norm and no
+augmentation, its output for an image never changes. It is computed once per
+image, stored in a util.feature_store.FeatureStore (the levels flattened into
+one float16 row, keyed by the content hash of the image file), and the
+training steps run only the box predictor on the cached feature maps.
+'''
+import json
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+from util import data_util
+from util import feature_store
+from util import pipeline_util
+
+# the per-level [height, width, channels] of the cached feature maps
+SHAPES_FILE = 'feature_shapes.json'
+
+
+def compute_feature_maps(model, images):
+    """Run the frozen part of an SSD model: preprocess and _feature_extractor (inference mode)."""
+    preprocessed_images, _ = model.preprocess(images)
+    return model._feature_extractor(preprocessed_images, training=False)
+
+
+def predict_from_feature_maps(model, feature_maps):
+    """The rest of SSDMetaArch.predict(): the box predictor, on given feature maps.
+
+    The anchors are those of the last model.predict() call, which only depend
+    on the input size, so predict() must have run once at the training image size.
+
+    Returns:
+        a prediction dict for model.loss().
+    """
+    feature_maps = list(feature_maps)
+    prediction_dict = {'feature_maps': feature_maps, 'anchors': model.anchors.get()}
+    for key, prediction_list in model._box_predictor(feature_maps).items():
+        prediction = tf.concat(prediction_list, axis=1)
+        if key == 'box_encodings' and prediction.shape.ndims == 4 and prediction.shape[2] == 1:
+            prediction = tf.squeeze(prediction, axis=2)
+        prediction_dict[key] = prediction
+    return prediction_dict
+
+
+def load_feature_shapes(cache_dir):
+    with open(os.path.join(cache_dir, SHAPES_FILE)) as f:
+        return [tuple(shape) for shape in json.load(f)]
+
+
+def cache_feature_maps(model, image_paths, cache_dir, image_size=640, batch_size=8, dtype='float16'):
+    """Compute and store the feature maps of the images not in the cache yet.
+
+    Args:
+        model: the detection model (with the frozen backbone restored).
+        image_paths: the training images; decoded and resized like
+        data_util.build_train_dataset() does.
+        cache_dir: the FeatureStore directory; one per model, checkpoint and
+        image_size, as the key is the image content only.
+        image_size: the training image size.
+        batch_size: the number of images per feature extractor call.
+        dtype: the storage dtype of the features.
+
+    Returns:
+        the [len(image_paths)] row indices of the images in the cache.
+    """
+    store = feature_store.FeatureStore(cache_dir, dtype=dtype)
+    keys = []
+    for image_path in image_paths:
+        with tf.io.gfile.GFile(image_path, 'rb') as f:
+            keys.append(feature_store.content_hash(f.read()))
+    missing = {}
+    for image_path, key in zip(image_paths, keys):
+        if key not in store:
+            missing.setdefault(key, image_path)
+
+    extract_fn = tf.function(lambda images: compute_feature_maps(model, images),
+                             input_signature=[tf.TensorSpec([None, image_size, image_size, 3], tf.float32)])
+    for batch in pipeline_util.batched(list(missing.items()), batch_size):
+        images = tf.stack([data_util.decode_and_resize(image_path, image_size) for _, image_path in batch])
+        feature_maps = extract_fn(images)
+        if not os.path.exists(os.path.join(cache_dir, SHAPES_FILE)):
+            with open(os.path.join(cache_dir, SHAPES_FILE), 'w') as f:
+                json.dump([feature_map.shape[1:].as_list() for feature_map in feature_maps], f)
+        flat = tf.concat([tf.reshape(feature_map, [len(batch), -1]) for feature_map in feature_maps], axis=1)
+        store.add([key for key, _ in batch], flat.numpy(), [image_path for _, image_path in batch])
+    print('Cached the features of %d new images, %d already cached (%.1f MiB in %s)' %
+          (len(missing), len(set(keys)) - len(missing), store.vectors.nbytes / 2**20, cache_dir), flush=True)
+    return store.rows(keys)
+
+
+def build_cached_feature_dataset(cache_dir,
+                                 rows,
+                                 boxes_list,
+                                 classes_list,
+                                 batch_size,
+                                 num_classes,
+                                 max_boxes=100,
+                                 label_id_offset=1,
+                                 shuffle_buffer_size=10000,
+                                 seed=None):
+    """Build a repeating, shuffled dataset of cached feature map batches.
+
+    Args:
+        cache_dir: the directory written by cache_feature_maps().
+        rows: the cache rows of the images, from cache_feature_maps().
+        boxes_list, classes_list, batch_size, num_classes, max_boxes,
+        label_id_offset, shuffle_buffer_size, seed: as in data_util.build_train_dataset().
+
+    Returns:
+        A tf.data.Dataset yielding (feature_maps, boxes, classes_one_hot, num_boxes)
+        with feature_maps a tuple of float32 [B, height, width, channels] levels.
+    """
+    store = feature_store.FeatureStore(cache_dir)
+    shapes = load_feature_shapes(cache_dir)
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    boxes, classes, num_boxes = data_util.pad_groundtruth(boxes_list, classes_list, max_boxes)
+
+    def _gather(batch_rows):
+        # one read of the batch rows from the memory-mapped cache (sorted rows read the file in order)
+        order = np.argsort(batch_rows)
+        features = np.empty((len(batch_rows), store.dim), dtype=store.dtype)
+        features[order] = store.vectors[batch_rows[order]]
+        return features
+
+    def _load_batch(batch_rows, batch_boxes, batch_classes, batch_num_boxes):
+        features = tf.numpy_function(_gather, [batch_rows], tf.as_dtype(store.dtype))
+        features = tf.cast(tf.reshape(features, [batch_size, sum(sizes)]), tf.float32)
+        feature_maps = tuple(tf.reshape(level, [batch_size] + list(shape))
+                             for level, shape in zip(tf.split(features, sizes, axis=1), shapes))
+        # padded slots get index -1, which tf.one_hot maps to an all-zero row
+        valid = tf.range(max_boxes)[tf.newaxis] < batch_num_boxes[:, tf.newaxis]
+        classes_one_hot = tf.one_hot(tf.where(valid, batch_classes - label_id_offset, -1), num_classes)
+        return feature_maps, batch_boxes, classes_one_hot, batch_num_boxes
+
+    dataset = tf.data.Dataset.from_tensor_slices((np.asarray(rows, dtype=np.int64), boxes, classes, num_boxes))
+    dataset = dataset.shuffle(min(shuffle_buffer_size, len(rows)), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(_load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,154 @@
+'''
+This code is for caching feature vectors (embeddings) on disk, keyed by the content hash of the images.
+
+A store directory holds:
+    meta.json    the vector size and dtype.
+    vectors.bin  the vectors as raw rows, appended to.
+    index.tsv    the sidecar index, one "<content hash>\t<image path>" line per
+                 row, in row order.
+
+The rows are read through a read-only np.memmap, so loading a store copies
+nothing until the vectors are used. A row is appended to vectors.bin before its
+index line, and rows without an index line (an interrupted append) are dropped
+on open, so a crash never leaves an index line without its vector.
+'''
+import hashlib
+import json
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+VECTORS_FILE = 'vectors.bin'
+INDEX_FILE = 'index.tsv'
+
+
+def content_hash(image_bytes):
+    """Return the hex key of an encoded image: the same bytes give the same key whatever the path."""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+class FeatureStore(object):
+    """An append-only, memory-mapped store of feature vectors keyed by content hash.
+
+    Args:
+        directory: the store directory, created if needed; an existing store is
+        opened and appended to.
+        dim: the vector size; None takes it from the existing store or the first add().
+        dtype: 'float16' (half the disk and page cache) or 'float32'; an
+        existing store keeps its own dtype.
+    """
+
+    def __init__(self, directory, dim=None, dtype='float16'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self._keys = []
+        self._paths = []
+        self._rows = {}
+        self._vectors = None
+
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if dim is not None and dim != meta['dim']:
+                raise ValueError('Feature store %s has %d-d vectors, not %d-d' % (directory, meta['dim'], dim))
+            self.dim = meta['dim']
+            self.dtype = np.dtype(meta['dtype'])
+        index_path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                lines = f.read().split('\n')
+            # the last item is '' after a complete line, or the partial line of an interrupted append
+            for line in lines[:-1]:
+                key, _, path = line.partition('\t')
+                self._rows[key] = len(self._keys)
+                self._keys.append(key)
+                self._paths.append(path)
+            if lines[-1]:
+                with open(index_path, 'w') as f:
+                    f.writelines('%s\t%s\n' % row for row in zip(self._keys, self._paths))
+        vectors_path = os.path.join(directory, VECTORS_FILE)
+        if self.dim is not None and os.path.exists(vectors_path):
+            expected_size = len(self._keys) * self._row_bytes
+            if os.path.getsize(vectors_path) < expected_size:
+                raise ValueError('Feature store %s is missing vectors of its index' % directory)
+            if os.path.getsize(vectors_path) > expected_size:
+                with open(vectors_path, 'r+b') as f:
+                    f.truncate(expected_size)
+
+    @property
+    def _row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    @property
+    def keys(self):
+        return list(self._keys)
+
+    @property
+    def paths(self):
+        return list(self._paths)
+
+    @property
+    def vectors(self):
+        """All the vectors as a read-only [N, dim] array mapped from disk (no copy)."""
+        if self._vectors is None or len(self._vectors) != len(self._keys):
+            if not self._keys:
+                return np.zeros((0, self.dim or 0), dtype=self.dtype)
+            self._vectors = np.memmap(os.path.join(self.directory, VECTORS_FILE), dtype=self.dtype,
+                                      mode='r', shape=(len(self._keys), self.dim))
+        return self._vectors
+
+    def rows(self, keys):
+        """Return the row indices of `keys` into `vectors`; raises KeyError for a key not in the store."""
+        return np.array([self._rows[key] for key in keys], dtype=np.int64)
+
+    def get(self, keys):
+        """Return the [len(keys), dim] vectors of `keys` (a copy, gathered from the mapped rows)."""
+        return self.vectors[self.rows(keys)]
+
+    def add(self, keys, vectors, paths=None):
+        """Append vectors under their keys; keys already in the store are skipped.
+
+        Args:
+            keys: the content hashes, see content_hash().
+            vectors: a [len(keys), dim] array, cast to the store dtype.
+            paths: optional image paths recorded in the index, for reference.
+
+        Returns:
+            the number of vectors appended.
+        """
+        vectors = np.asarray(vectors).reshape(len(keys), -1)
+        paths = paths if paths is not None else [''] * len(keys)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        if not self._keys:
+            with open(os.path.join(self.directory, META_FILE), 'w') as f:
+                json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+        if vectors.shape[1] != self.dim:
+            raise ValueError('Expected %d-d vectors, got %d-d' % (self.dim, vectors.shape[1]))
+
+        new_rows = []
+        for i, key in enumerate(keys):
+            if key not in self._rows:
+                self._rows[key] = len(self._keys) + len(new_rows)
+                new_rows.append(i)
+        if not new_rows:
+            return 0
+        with open(os.path.join(self.directory, VECTORS_FILE), 'ab') as f:
+            f.write(np.ascontiguousarray(vectors[new_rows], dtype=self.dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(os.path.join(self.directory, INDEX_FILE), 'a') as f:
+            f.writelines('%s\t%s\n' % (keys[i], paths[i]) for i in new_rows)
+        self._keys.extend(keys[i] for i in new_rows)
+        self._paths.extend(paths[i] for i in new_rows)
+        return len(new_rows)
@@ -0,0 +1,212 @@
+'''
+This code is for decoding images into uint8 arrays shared by the train/inference pipelines.
+'''
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import tensorflow as tf
+
+# EXIF tag holding the camera orientation (values 1-8, 1 meaning upright).
+_EXIF_ORIENTATION_TAG = 0x0112
+
+# PIL transpose ops needed to bring each EXIF orientation upright.
+_PIL_ORIENTATION_OPS = {
+    2: [Image.FLIP_LEFT_RIGHT],
+    3: [Image.ROTATE_180],
+    4: [Image.FLIP_TOP_BOTTOM],
+    5: [Image.TRANSPOSE],
+    6: [Image.ROTATE_270],
+    7: [Image.TRANSVERSE],
+    8: [Image.ROTATE_90],
+}
+
+
+def _exif_orientation(image):
+    """Return the EXIF orientation of a PIL image, 1 if it has none."""
+    try:
+        return int(image.getexif().get(_EXIF_ORIENTATION_TAG, 1))
+    except (AttributeError, ValueError, TypeError):
+        return 1
+
+
+def _open_rgb(image_bytes, draft_size=None, apply_orientation=True):
+    """Decode encoded image bytes into an upright RGB PIL image.
+
+    Grayscale, palette and RGBA inputs are converted to 3-channel RGB (alpha is
+    dropped, as tf.io.decode_image does with channels=3). The EXIF orientation
+    is applied only when it is not already upright so that the common case does
+    not pay for an extra full-image copy.
+
+    If draft_size is given, JPEGs are decoded at the smallest DCT scale (1/2, 1/4
+    or 1/8) that still covers draft_size, which is much cheaper than decoding at
+    full resolution when the image is downscaled right after.
+
+    With apply_orientation=False the pixels are kept in their stored layout,
+    which is what box annotations (and tf.io.decode_image) refer to.
+
+    Returns:
+        image: the RGB PIL image, at the reduced draft size if any.
+        full_shape: (img_height, img_width) of the full-resolution image (read
+        before draft() shrinks the size), in the same orientation as image.
+    """
+    image = Image.open(BytesIO(image_bytes))
+    (im_width, im_height) = image.size
+    if draft_size is not None:
+        image.draft('RGB', draft_size)
+    if apply_orientation:
+        orientation = _exif_orientation(image)
+        for op in _PIL_ORIENTATION_OPS.get(orientation, []):
+            image = image.transpose(op)
+        if orientation in (5, 6, 7, 8):  # rotated by 90 degrees
+            (im_width, im_height) = (im_height, im_width)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image, (im_height, im_width)
+
+
+def load_image_into_numpy_array(path):
+    """Load an image from file into a numpy array.
+
+    Puts image into numpy array to feed into tensorflow graph.
+    Note that by convention we put it into a numpy array with shape
+    (height, width, channels), where channels=3 for RGB.
+
+    The decoded pixels go through PIL's array interface, which copies them once
+    (via tobytes()) into a uint8 array, with no per-pixel Python list nor int64
+    intermediate. The array is read-only; copy it before writing into it.
+
+    Args:
+        path: the file path to the image
+
+    Returns:
+        uint8 numpy array with shape (img_height, img_width, 3)
+    """
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        image, _ = _open_rgb(f.read())
+    return np.asarray(image)
+
+
+def _apply_orientation(image, orientation):
+    """Bring a [H, W, C] image tensor upright given its EXIF orientation."""
+    if orientation == 2:
+        return tf.image.flip_left_right(image)
+    if orientation == 3:
+        return tf.image.rot90(image, k=2)
+    if orientation == 4:
+        return tf.image.flip_up_down(image)
+    if orientation == 5:
+        return tf.transpose(image, [1, 0, 2])
+    if orientation == 6:
+        return tf.image.rot90(image, k=3)
+    if orientation == 7:
+        return tf.image.rot90(tf.transpose(image, [1, 0, 2]), k=2)
+    if orientation == 8:
+        return tf.image.rot90(image, k=1)
+    return image
+
+
+def decode_image(path):
+    """Decode an image file into a uint8 tensor with tf.io.decode_image.
+
+    The pixels are decoded by TensorFlow straight into the tensor buffer; calling
+    `.numpy()` on the result gives a view of that buffer without a copy. Only the
+    image header is parsed by PIL, to read the EXIF orientation.
+
+    Args:
+        path: the file path to the image
+
+    Returns:
+        uint8 tensor with shape (img_height, img_width, 3)
+    """
+    image_bytes = tf.io.read_file(path)
+    image = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+    orientation = _exif_orientation(Image.open(BytesIO(image_bytes.numpy())))
+    return _apply_orientation(image, orientation)
+
+
+def load_resized_image(path, image_size):
+    """Load an image resized to fit image_size x image_size, padded at the bottom/right.
+
+    The aspect ratio is kept (the longer side becomes image_size), like the
+    keep_aspect_ratio_resizer of the detection models, so fixed-size batches can
+    be formed from images of any resolution.
+
+    Args:
+        path: the file path to the image
+        image_size: the height and width of the output
+
+    Returns:
+        image: uint8 numpy array with shape (image_size, image_size, 3)
+        valid_fraction: (height, width) fraction of the output covered by the image,
+        to map normalized boxes back with unpad_boxes().
+        original_shape: (img_height, img_width) of the full-resolution image,
+        also when a JPEG is decoded at a reduced scale.
+    """
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        return resize_image_bytes(f.read(), image_size)
+
+
+def resize_image_bytes(image_bytes, image_size):
+    """Same as load_resized_image(), for encoded image bytes already in memory."""
+    image, original_shape = _open_rgb(image_bytes, draft_size=(image_size, image_size))
+    padded, valid_fraction = _resize_and_pad(image, image_size, image_size)
+    return padded, valid_fraction, original_shape
+
+
+def stretch_image_bytes(image_bytes, image_size):
+    """Decode and resize encoded image bytes to image_size x image_size, not keeping the aspect ratio.
+
+    The same geometry as data_util.decode_and_resize(), so normalized boxes stay
+    valid, with JPEGs decoded at a reduced DCT scale when that still covers image_size.
+    Like tf.io.decode_image, the EXIF orientation is not applied: the COCO/VOC
+    image sizes and boxes describe the stored pixel layout.
+
+    Returns:
+        image: uint8 numpy array with shape (image_size, image_size, 3)
+        original_shape: (img_height, img_width) of the stored image.
+    """
+    image, original_shape = _open_rgb(image_bytes, draft_size=(image_size, image_size), apply_orientation=False)
+    if image.size != (image_size, image_size):
+        image = image.resize((image_size, image_size), Image.BILINEAR)
+    return np.asarray(image), original_shape
+
+
+def _resize_and_pad(image, height, width):
+    """Resize a PIL image to fit height x width keeping its aspect ratio, pad bottom/right."""
+    (im_width, im_height) = image.size
+    scale = min(float(height) / im_height, float(width) / im_width)
+    new_width = min(width, max(1, int(round(im_width * scale))))
+    new_height = min(height, max(1, int(round(im_height * scale))))
+    padded = np.zeros((height, width, 3), dtype=np.uint8)
+    if (new_width, new_height) != image.size:
+        image = image.resize((new_width, new_height), Image.BILINEAR)
+    padded[:new_height, :new_width] = np.asarray(image)
+    return padded, (new_height / float(height), new_width / float(width))
+
+
+def resize_and_pad(image_np, height, width):
+    """Resize a uint8 [H, W, 3] array to fit height x width keeping its aspect ratio.
+
+    Returns:
+        image: uint8 numpy array with shape (height, width, 3), padded at the bottom/right.
+        valid_fraction: (height, width) fraction of the output covered by the image,
+        to map normalized boxes back with unpad_boxes().
+    """
+    return _resize_and_pad(Image.fromarray(image_np), height, width)
+
+
+def unpad_boxes(boxes, valid_fraction):
+    """Map normalized [..., 4] boxes on a padded image back to the unpadded image.
+
+    Args:
+        boxes: numpy array of shape [..., 4] with [ymin, xmin, ymax, xmax] normalized
+        to the padded image.
+        valid_fraction: the (height, width) fraction returned by load_resized_image().
+
+    Returns:
+        float32 numpy array of the same shape, normalized to the original image.
+    """
+    scale = np.array([valid_fraction[0], valid_fraction[1]] * 2, dtype=np.float32)
+    return np.clip(boxes / scale, 0.0, 1.0)
@@ -0,0 +1,100 @@
+'''
+This code is for loading label maps once and mapping detected class ids to names in bulk.
+
+Two formats are supported:
+    .txt: one name per line, the line number (1-based) being the class id,
+    e.g. util/coco-labels-paper.txt.
+    .pbtxt: a StringIntLabelMap text proto of `item { id: .. name: .. display_name: .. }`,
+    e.g. object_detection/data/mscoco_label_map.pbtxt.
+'''
+import functools
+import os
+
+import numpy as np
+
+# returned for ids that are out of range or missing from the label map
+UNKNOWN_LABEL = 'N/A'
+
+
+def _parse_pbtxt(text, use_display_name):
+    # imported here so that .txt label maps need neither protobuf nor the object detection API
+    from google.protobuf import text_format
+    from object_detection.protos import string_int_label_map_pb2
+
+    label_map = text_format.Parse(text, string_int_label_map_pb2.StringIntLabelMap())
+    labels = {}
+    for item in label_map.item:
+        if not item.HasField('id'):
+            raise ValueError('Label map item without id: %s' % text_format.MessageToString(item, as_one_line=True))
+        name = item.display_name if use_display_name else None
+        labels[item.id] = name or item.name
+    return labels
+
+
+@functools.lru_cache(maxsize=None)
+def _load_labels(path, mtime, use_display_name):
+    # `mtime` is part of the cache key so that an edited file is parsed again
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.pbtxt'):
+        return _parse_pbtxt(text, use_display_name)
+    return {i + 1: name.strip() for i, name in enumerate(text.splitlines())}
+
+
+def load_labels(path, use_display_name=True):
+    """Parse a .txt or .pbtxt label map, once per file.
+
+    Args:
+        path: the label map file.
+        use_display_name: for .pbtxt, use `display_name` when an item has one
+        instead of `name`.
+
+    Returns:
+        a dict of name keyed by class id; shared between callers, do not modify.
+    """
+    return _load_labels(path, os.path.getmtime(path), use_display_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_label_array(path, mtime, use_display_name, unknown_label):
+    labels = _load_labels(path, mtime, use_display_name)
+    label_array = np.full(max(labels, default=0) + 1, unknown_label, dtype=object)
+    label_array[list(labels)] = list(labels.values())
+    label_array.flags.writeable = False
+    return label_array
+
+
+def load_label_array(path, use_display_name=True, unknown_label=UNKNOWN_LABEL):
+    """Get a read-only lookup array of names indexed by class id, built once per file.
+
+    Ids missing from the label map (including the background id 0) hold
+    `unknown_label`.
+    """
+    return _build_label_array(path, os.path.getmtime(path), use_display_name, unknown_label)
+
+
+def load_category_index(path, use_display_name=True):
+    """Get a label map as a category index {id: {'id': id, 'name': name}} for viz_utils."""
+    return {class_id: {'id': class_id, 'name': name}
+            for class_id, name in load_labels(path, use_display_name).items()}
+
+
+def lookup_labels(class_ids, label_array, label_id_offset=0, unknown_label=UNKNOWN_LABEL):
+    """Map class ids of any shape to names with one vectorized index operation.
+
+    Args:
+        class_ids: an int or float array of class ids, e.g. a whole
+        [batch, max_detections] detection_classes output.
+        label_array: from load_label_array().
+        label_id_offset: added to class_ids first, e.g. 1 for the 0-based classes
+        of the object detection API models; 0 for the 1-based TF-Hub detectors.
+        unknown_label: the name of ids outside of the label map.
+
+    Returns:
+        an object array of names with the shape of class_ids.
+    """
+    ids = np.asarray(class_ids).astype(np.int64) + label_id_offset
+    valid = (ids >= 0) & (ids < len(label_array))
+    names = label_array[np.where(valid, ids, 0)]
+    names[~valid] = unknown_label
+    return names
@@ -0,0 +1,250 @@
+'''
+This code is for running inference as bounded producer/consumer stages.
+'''
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# queue sentinel marking the end of a stream
+_END = object()
+
+
+def bounded_map(fn, items, num_workers, max_pending, on_error=None):
+    """Map fn over items with a thread pool, yielding results in input order.
+
+    At most `max_pending` items are submitted but not yet consumed, so the memory
+    held by results waiting for a slow consumer stays bounded however long
+    `items` is.
+
+    By default the first error of fn is re-raised in the consumer (fail-fast)
+    and the items not started yet are cancelled. With on_error, the failed
+    items are reported to it and skipped instead, e.g. to log and skip corrupt
+    images in a long batch run.
+
+    Args:
+        fn: the function to apply, e.g. decode + resize of one image.
+        items: an iterable of inputs, consumed lazily.
+        num_workers: the number of worker threads.
+        max_pending: the maximum number of in-flight/ready results.
+        on_error: optional, called with (item, exception) for each failed item,
+        which then yields nothing.
+
+    Yields:
+        fn(item) for each item (that did not fail), in order.
+    """
+    pending = collections.deque()
+
+    def _results(future_item):
+        future, item = future_item
+        try:
+            return [future.result()]
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(item, e)
+            return []
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        try:
+            for item in items:
+                if len(pending) >= max_pending:
+                    yield from _results(pending.popleft())
+                pending.append((executor.submit(fn, item), item))
+            while pending:
+                yield from _results(pending.popleft())
+        finally:
+            # on an error (or a consumer that stops early) do not run the queued items
+            for future, _ in pending:
+                future.cancel()
+
+
+def batched(items, batch_size):
+    """Group an iterable into lists of batch_size items (the last one may be shorter)."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BackgroundWriter(object):
+    """Consume records on a background thread through a bounded queue.
+
+    `put` blocks once `max_queue_size` records are waiting, which applies back
+    pressure to the producer instead of letting the queue grow.
+
+    Args:
+        write_fn: called with each record on the writer thread.
+        max_queue_size: the bound of the record queue.
+        close_fn: optional, called on the writer thread after the last record.
+    """
+
+    def __init__(self, write_fn, max_queue_size=64, close_fn=None):
+        self._write_fn = write_fn
+        self._close_fn = close_fn
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                record = self._queue.get()
+                if record is _END:
+                    break
+                self._write_fn(record)
+        except Exception as e:  # surfaced to the producer in put()/close()
+            self._error = e
+            # keep draining so that a blocked producer is released
+            while self._queue.get() is not _END:
+                pass
+        # after the last record, whether or not writing failed, so files are closed
+        if self._close_fn is not None:
+            try:
+                self._close_fn()
+            except Exception as e:
+                self._error = self._error or e
+
+    def put(self, record):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(record)
+
+    def close(self):
+        """Flush the queue, wait for the writer thread and re-raise its error if any."""
+        self._queue.put(_END)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class LatestQueue(object):
+    """A bounded queue that drops its oldest item instead of blocking the producer.
+
+    For live sources: a consumer that falls behind gets the most recent items,
+    and the stale ones are counted in `num_dropped`.
+
+    Args:
+        max_size: the number of items kept.
+        drop_oldest: False makes put() block on a full queue instead, for
+        sources that can wait (e.g. files processed offline).
+    """
+
+    def __init__(self, max_size=1, drop_oldest=True):
+        self._items = collections.deque()
+        self._max_size = max_size
+        self.drop_oldest = drop_oldest
+        self._condition = threading.Condition()
+        self.num_dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if item is not _END:
+                # a blocked producer is released by set_drop_oldest() too
+                self._condition.wait_for(lambda: len(self._items) < self._max_size or self.drop_oldest)
+                if len(self._items) >= self._max_size:
+                    self._items.popleft()
+                    self.num_dropped += 1
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def set_drop_oldest(self):
+        """Switch to dropping the oldest items, releasing a producer blocked in put(), e.g. on shutdown."""
+        with self._condition:
+            self.drop_oldest = True
+            self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._items)
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def __iter__(self):
+        """Yield the items until close() is reached."""
+        while True:
+            item = self.get()
+            if item is _END:
+                return
+            yield item
+
+    def close(self):
+        self.put(_END)
+
+
+class DynamicBatcher(object):
+    """Coalesce concurrent requests into batches bounded by size and wait time.
+
+    Callers submit single items from any thread and get a Future. A worker
+    thread takes the first waiting item, then keeps collecting until the batch
+    has `max_batch_size` items or `max_wait_seconds` have passed since that
+    first item, and runs `batch_fn` once on the whole batch.
+
+    Args:
+        batch_fn: called with a list of items, returns a list of results in order.
+        max_batch_size: the largest batch passed to batch_fn.
+        max_wait_seconds: the longest time the first item of a batch waits for more.
+        max_queue_size: the bound of the request queue; submit() blocks when full.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_seconds=0.005, max_queue_size=1024):
+        self._batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_sizes = collections.Counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        if batch[0] is _END:
+            return None
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is _END:
+                self._queue.put(_END)  # stop after this batch
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = self._batch_fn([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError('batch_fn returned %d results for %d items' % (len(results), len(batch)))
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                # the futures resolved before the error keep their result
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def close(self):
+        self._queue.put(_END)
+        self._thread.join()
@@ -0,0 +1,156 @@
+'''
+This code is for post-processing batched detection outputs in NumPy: score threshold, NMS/soft-NMS and top-k.
+
+All the operations work on whole [batch, num_boxes] arrays; the only Python
+loops are over the candidate rank (NMS) or the output slot (soft-NMS), each
+step being vectorized across the batch.
+'''
+import numpy as np
+
+NMS_METHODS = ['none', 'nms', 'soft_nms']
+
+
+def batched_iou(boxes, other_boxes):
+    """Compute the pairwise IoU of two sets of (ymin, xmin, ymax, xmax) boxes.
+
+    Args:
+        boxes: a [..., N, 4] array.
+        other_boxes: a [..., M, 4] array with the same leading dimensions.
+
+    Returns:
+        a [..., N, M] float32 array; 0 where a union is empty.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    other_boxes = np.asarray(other_boxes, dtype=np.float32)
+    a = boxes[..., :, np.newaxis, :]
+    b = other_boxes[..., np.newaxis, :, :]
+    intersection = (np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None) *
+                    np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None))
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0).astype(np.float32)
+
+
+def _offset_boxes_by_class(boxes, classes):
+    """Shift the boxes of each class to a disjoint region so one NMS pass is per-class."""
+    span = float(boxes.max() - boxes.min()) + 1 if boxes.size else 1.0
+    return boxes + (classes.astype(np.float32) * span)[..., np.newaxis]
+
+
+def _greedy_nms(boxes, valid, iou_threshold, max_detections):
+    """Greedy NMS over score-sorted boxes; returns the [B, K] mask of kept boxes."""
+    batch_size, num_boxes = valid.shape
+    keep = valid.copy()
+    num_kept = np.zeros(batch_size, dtype=np.int64)
+    for i in range(num_boxes):
+        active = keep[:, i] & (num_kept < max_detections)
+        keep[:, i] = active
+        if (num_kept >= max_detections).all() or not keep[:, i:].any():
+            keep[:, i + 1:] = False
+            break
+        if not active.any():
+            continue
+        num_kept += active
+        iou = batched_iou(boxes[:, i:i + 1], boxes[:, i + 1:])[:, 0]
+        keep[:, i + 1:] &= ~(active[:, np.newaxis] & (iou > iou_threshold))
+    return keep
+
+
+def _soft_nms(boxes, scores, valid, sigma, min_score, max_detections):
+    """Gaussian soft-NMS; returns ([B, D] candidate indices, [B, D] decayed scores, [B] counts)."""
+    batch_size, num_boxes = scores.shape
+    rows = np.arange(batch_size)
+    scores = np.where(valid, scores, -np.inf)
+    num_outputs = min(max_detections, num_boxes)
+    indices = np.zeros((batch_size, num_outputs), dtype=np.int64)
+    selected_scores = np.zeros((batch_size, num_outputs), dtype=np.float32)
+    num_detections = np.zeros(batch_size, dtype=np.int64)
+    for k in range(num_outputs):
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[rows, best]
+        # scores only decrease, so a row that stops here has nothing left
+        selected = np.isfinite(best_scores) & (best_scores >= min_score)
+        if not selected.any():
+            break
+        indices[:, k] = best
+        selected_scores[:, k] = np.where(selected, best_scores, 0)
+        num_detections += selected
+        iou = batched_iou(boxes[rows, best][:, np.newaxis], boxes)[:, 0]
+        scores = scores * np.exp(-np.square(iou) / sigma)
+        scores[rows, best] = -np.inf
+    return indices, selected_scores, num_detections
+
+
+def postprocess_detections(detections,
+                           min_score=0.0,
+                           method='nms',
+                           iou_threshold=0.5,
+                           class_agnostic=False,
+                           max_detections=100,
+                           pre_nms_top_k=1000,
+                           soft_nms_sigma=0.5):
+    """Filter a batch of detections by score, suppress overlaps and keep the top k.
+
+    Args:
+        detections: a dict with 'detection_boxes' [B, N, 4] (ymin, xmin, ymax, xmax),
+        'detection_scores' [B, N] and 'detection_classes' [B, N] arrays.
+        min_score: boxes with a lower score are dropped (for soft-NMS, also
+        after their score decays).
+        method: 'none' (threshold and top-k only), 'nms' (greedy, hard
+        suppression above iou_threshold) or 'soft_nms' (Gaussian score decay).
+        iou_threshold: the IoU above which 'nms' suppresses a box.
+        class_agnostic: suppress across classes instead of within each class.
+        max_detections: the number of output slots per image (top-k).
+        pre_nms_top_k: only the highest scoring candidates per image enter NMS;
+        None keeps all of them.
+        soft_nms_sigma: the Gaussian decay width of 'soft_nms'.
+
+    Returns:
+        a dict with the same keys padded to [B, max_detections] (zeros past the
+        valid detections, which come first in descending score order) and
+        'num_detections' [B].
+    """
+    if method not in NMS_METHODS:
+        raise ValueError('Unknown NMS method %s, expected one of %s' % (method, NMS_METHODS))
+    boxes = np.asarray(detections['detection_boxes'], dtype=np.float32)
+    scores = np.asarray(detections['detection_scores'], dtype=np.float32)
+    classes = np.asarray(detections['detection_classes'])
+
+    # threshold, then sort the candidates by score and keep the top pre_nms_top_k
+    scores = np.where(scores >= min_score, scores, -np.inf)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    if pre_nms_top_k is not None:
+        order = order[:, :pre_nms_top_k]
+    boxes = np.take_along_axis(boxes, order[..., np.newaxis], axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    classes = np.take_along_axis(classes, order, axis=1)
+    valid = np.isfinite(scores)
+    nms_boxes = boxes if class_agnostic else _offset_boxes_by_class(boxes, classes)
+
+    if method == 'soft_nms':
+        indices, scores, num_detections = _soft_nms(
+            nms_boxes, scores, valid, soft_nms_sigma, min_score, max_detections)
+    else:
+        keep = _greedy_nms(nms_boxes, valid, iou_threshold, max_detections) if method == 'nms' else valid
+        # the kept candidates first, in their (score) order
+        indices = np.argsort(~keep, axis=1, kind='stable')[:, :max_detections]
+        num_detections = np.minimum(keep.sum(axis=1), max_detections)
+        scores = np.take_along_axis(scores, indices, axis=1)
+
+    slots = np.arange(indices.shape[1]) < num_detections[:, np.newaxis]
+    outputs = {
+        'detection_boxes': np.where(slots[..., np.newaxis],
+                                    np.take_along_axis(boxes, indices[..., np.newaxis], axis=1), 0),
+        'detection_scores': np.where(slots, scores, 0),
+        'detection_classes': np.where(slots, np.take_along_axis(classes, indices, axis=1), 0),
+    }
+    # pad to a fixed number of slots even when there are fewer candidates
+    num_padding = max_detections - indices.shape[1]
+    if num_padding > 0:
+        outputs = {key: np.pad(value, [(0, 0), (0, num_padding)] + [(0, 0)] * (value.ndim - 2))
+                   for key, value in outputs.items()}
+    outputs['detection_boxes'] = outputs['detection_boxes'].astype(np.float32)
+    outputs['detection_scores'] = outputs['detection_scores'].astype(np.float32)
+    outputs['num_detections'] = num_detections.astype(np.int32)
+    return outputs
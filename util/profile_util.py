@@ -0,0 +1,158 @@
+'''
+This code is for timing the stages of the train/inference hot paths and capturing tf.profiler traces.
+
+TensorFlow dispatches ops asynchronously on accelerators, so a timer around a
+call that returns tensors may stop before the device is done. Profiler.time()
+waits for the result (sync()) before stopping the clock.
+'''
+import collections
+import contextlib
+import json
+import random
+import threading
+import time
+
+import numpy as np
+
+import tensorflow as tf
+
+
+def sync(result):
+    """Wait until the tensors of a (nested) result are computed, and return the result.
+
+    Fetching the smallest output tensor to the host waits for the device work
+    that produced it without copying the large outputs.
+    """
+    tensors = [value for value in tf.nest.flatten(result)
+               if isinstance(value, tf.Tensor) and hasattr(value, 'numpy')]
+    if tensors:
+        min(tensors, key=lambda tensor: tensor.shape.num_elements() or 0).numpy()
+    return result
+
+
+class _StageStats(object):
+    """Running count, sum, min and max of a stage, plus a uniform reservoir sample for the percentiles."""
+
+    def __init__(self, reservoir_size, rng):
+        self.calls = 0
+        self.min = float('inf')
+        self.max = 0.0
+        self.reservoir = []
+        self._reservoir_size = reservoir_size
+        self._rng = rng
+
+    def add(self, seconds):
+        self.calls += 1
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        # Algorithm R: every call ends up in the reservoir with the same probability
+        if len(self.reservoir) < self._reservoir_size:
+            self.reservoir.append(seconds)
+        else:
+            index = self._rng.randrange(self.calls)
+            if index < self._reservoir_size:
+                self.reservoir[index] = seconds
+
+
+class Profiler(object):
+    """Thread-safe recorder of per-stage wall times with a tf.profiler step window.
+
+    The memory per stage is bounded: the count, total, min and max are exact,
+    and the percentiles come from a fixed-size uniform sample of the calls
+    (exact as long as a stage has at most `reservoir_size` calls).
+
+    Args:
+        trace_dir: the log directory of a tf.profiler trace (open it with
+        TensorBoard's profile tab); None disables tracing.
+        trace_start_step: the first step() traced.
+        trace_num_steps: the number of steps traced.
+        reservoir_size: the number of call times kept per stage for the
+        percentiles.
+    """
+
+    def __init__(self, trace_dir=None, trace_start_step=10, trace_num_steps=5, reservoir_size=4096):
+        self._lock = threading.Lock()
+        self._stats = collections.OrderedDict()
+        self._reservoir_size = reservoir_size
+        self._rng = random.Random(0)
+        self.seconds = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.trace_dir = trace_dir
+        self.trace_start_step = trace_start_step
+        self.trace_num_steps = trace_num_steps
+        self._tracing = False
+        self.step_num = 0
+        self._start_time = time.perf_counter()
+
+    def add(self, stage, seconds, count=1):
+        """Record one call of `stage` that took `seconds` for `count` items."""
+        with self._lock:
+            if stage not in self._stats:
+                self._stats[stage] = _StageStats(self._reservoir_size, self._rng)
+            self._stats[stage].add(seconds)
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    def time(self, stage, fn, *args, count=1):
+        """Call fn(*args), wait for its tensors, add the wall time to `stage` and return the result."""
+        start_time = time.perf_counter()
+        result = sync(fn(*args))
+        self.add(stage, time.perf_counter() - start_time, count)
+        return result
+
+    @contextlib.contextmanager
+    def stage(self, stage, count=1):
+        """Time a block as `stage`; tensors made in the block should be sync()ed inside it."""
+        start_time = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - start_time, count)
+
+    @contextlib.contextmanager
+    def step(self):
+        """Mark one training/inference step, starting and stopping the trace on its window."""
+        if self.trace_dir and self.step_num == self.trace_start_step:
+            tf.profiler.experimental.start(self.trace_dir)
+            self._tracing = True
+        with tf.profiler.experimental.Trace('step', step_num=self.step_num, _r=1):
+            yield
+        self.step_num += 1
+        if self._tracing and self.step_num >= self.trace_start_step + self.trace_num_steps:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+            print('Profiler trace written to ' + self.trace_dir, flush=True)
+
+    def summary(self):
+        """Return a JSON-serializable dict of wall time and per-stage statistics."""
+        stages = collections.OrderedDict()
+        with self._lock:
+            for stage, stats in self._stats.items():
+                p50, p90, p99 = np.percentile(1000 * np.asarray(stats.reservoir), [50, 90, 99])
+                stages[stage] = {'calls': stats.calls,
+                                 'items': self.counts[stage],
+                                 'total_seconds': self.seconds[stage],
+                                 'mean_ms': 1000 * self.seconds[stage] / stats.calls,
+                                 'p50_ms': float(p50),
+                                 'p90_ms': float(p90),
+                                 'p99_ms': float(p99),
+                                 'min_ms': 1000 * stats.min,
+                                 'max_ms': 1000 * stats.max,
+                                 'ms_per_item': 1000 * self.seconds[stage] / max(self.counts[stage], 1)}
+        return {'wall_seconds': time.perf_counter() - self._start_time, 'steps': self.step_num, 'stages': stages}
+
+    def report(self):
+        """Return printable lines, one per stage."""
+        return ['%-12s %10.3f s  %8d items  %8.2f ms/item  p50 %8.2f ms  p99 %8.2f ms' %
+                (stage, stats['total_seconds'], stats['items'], stats['ms_per_item'], stats['p50_ms'],
+                 stats['p99_ms'])
+                for stage, stats in self.summary()['stages'].items()]
+
+    def write_summary(self, path, **metadata):
+        """Write summary() plus `metadata` (e.g. model name, batch size) as JSON."""
+        summary = self.summary()
+        summary.update(metadata)
+        with tf.io.gfile.GFile(path, 'w') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,109 @@
+'''
+This code is for drawing labeled detection boxes onto images.
+'''
+import functools
+
+import numpy as np
+from PIL import Image
+from PIL import ImageColor
+from PIL import ImageDraw
+from PIL import ImageFont
+
+DEFAULT_FONT_PATH = '/usr/share/fonts/truetype/liberation/LiberationSansNarrow-Regular.ttf'
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(path=DEFAULT_FONT_PATH, size=25):
+    """Load a TrueType font once per (path, size), falling back to PIL's default font."""
+    try:
+        return ImageFont.truetype(path, size)
+    except IOError:
+        print('Font not found, using default font.')
+        return ImageFont.load_default()
+
+
+def text_size(font, text):
+    """Return the (width, height) of a text, font.getsize() being gone in Pillow >= 10."""
+    if hasattr(font, 'getbbox'):
+        _, _, right, bottom = font.getbbox(text)
+        return right, bottom
+    return font.getsize(text)
+
+
+class BoxRenderer(object):
+    """Draw labeled boxes with one image conversion per call.
+
+    The image is wrapped into a PIL image once and all boxes and labels are
+    drawn on it before copying the pixels back, so the cost grows with the
+    number of boxes times the box perimeter instead of times the image size.
+    The font is resolved once and the text sizes of the labels are memoized.
+
+    Args:
+        font: a PIL font, defaults to get_font().
+        thickness: the box line width in pixels.
+        max_cached_labels: the bound of the text size cache.
+    """
+
+    def __init__(self, font=None, thickness=4, max_cached_labels=4096):
+        self.font = font if font is not None else get_font()
+        self.thickness = thickness
+        self._max_cached_labels = max_cached_labels
+        self._text_sizes = {}
+        self._colors = list(ImageColor.colormap.values())
+
+    def _text_size(self, text):
+        size = self._text_sizes.get(text)
+        if size is None:
+            if len(self._text_sizes) >= self._max_cached_labels:
+                self._text_sizes.clear()
+            size = self._text_sizes[text] = text_size(self.font, text)
+        return size
+
+    def _draw_label(self, draw, left, top, display_str, color):
+        text_width, text_height = self._text_size(display_str)
+        margin = np.ceil(0.05 * text_height)
+        # stack the label below the top of the box if it does not fit above
+        total_height = (1 + 2 * 0.05) * text_height
+        text_bottom = top if top > total_height else top + total_height
+        draw.rectangle([(left, text_bottom - text_height - 2 * margin), (left + text_width, text_bottom)],
+                       fill=color)
+        draw.text((left + margin, text_bottom - text_height - margin), display_str, fill='black', font=self.font)
+
+    def draw(self, image, boxes, class_names, scores, max_boxes=10, min_score=0.1):
+        """Overlay labeled boxes on an image with formatted scores and label names.
+
+        Args:
+            image: a uint8 [height, width, 3] array, drawn on in place when writable.
+            boxes: [N, 4] normalized (ymin, xmin, ymax, xmax) boxes.
+            class_names: the N label names.
+            scores: the N scores.
+            max_boxes: only the first max_boxes boxes are considered.
+            min_score: boxes with a lower score are skipped.
+
+        Returns:
+            the image with the boxes drawn.
+        """
+        scores = np.asarray(scores)
+        num_boxes = min(len(scores), max_boxes)
+        indices = np.flatnonzero(scores[:num_boxes] >= min_score)
+        if indices.size == 0:
+            return image
+
+        height, width = image.shape[:2]
+        # (top, left, bottom, right) in pixels, for all kept boxes at once
+        pixel_boxes = np.asarray(boxes)[indices] * np.array([height, width, height, width], dtype=np.float32)
+        percents = (100 * scores[indices]).astype(np.int32)
+
+        image_pil = Image.fromarray(np.asarray(image, dtype=np.uint8)).convert('RGB')
+        draw = ImageDraw.Draw(image_pil)
+        for (top, left, bottom, right), index, percent in zip(pixel_boxes.tolist(), indices, percents):
+            class_name = class_names[index]
+            color = self._colors[hash(class_name) % len(self._colors)]
+            draw.line([(left, top), (left, bottom), (right, bottom), (right, top), (left, top)],
+                      width=self.thickness, fill=color)
+            self._draw_label(draw, left, top, '{}: {}%'.format(class_name, percent), color)
+
+        if isinstance(image, np.ndarray) and image.flags.writeable:
+            np.copyto(image, np.asarray(image_pil))
+            return image
+        return np.asarray(image_pil)
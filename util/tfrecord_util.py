@@ -0,0 +1,217 @@
+'''
+This code is for writing training data once as sharded TFRecords of pre-resized images, and reading them back.
+
+Decoding the source JPEGs at full resolution and resizing them dominates the
+input pipeline; the builder does it once, on a process pool, and stores either
+re-encoded JPEGs (small, cheap to decode at 640x640) or raw uint8 pixels
+(larger, no decode at all). The reader yields the same batches as
+data_util.build_train_dataset(), so the training loop does not change.
+
+A dataset directory holds the shards <split>-00000-of-0000N.tfrecord and a
+dataset_info.json with the image size, payload, class names and counts.
+'''
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+import tensorflow as tf
+
+from util import image_util
+
+INFO_FILE = 'dataset_info.json'
+PAYLOADS = ['jpeg', 'raw']
+
+
+def _shard_path(output_dir, split, shard, num_shards):
+    return os.path.join(output_dir, '%s-%05d-of-%05d.tfrecord' % (split, shard, num_shards))
+
+
+def _encode_example(image_path, boxes, classes, image_size, payload, jpeg_quality):
+    """Return a serialized tf.train.Example of one resized image and its groundtruth."""
+    with tf.io.gfile.GFile(image_path, 'rb') as f:
+        image, original_shape = image_util.stretch_image_bytes(f.read(), image_size)
+    if payload == 'jpeg':
+        output = io.BytesIO()
+        Image.fromarray(image).save(output, format='JPEG', quality=jpeg_quality)
+        encoded = output.getvalue()
+    else:
+        encoded = image.tobytes()
+    boxes = np.asarray(boxes, dtype=np.float32).reshape([-1, 4])
+
+    def _floats(values):
+        return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+    def _ints(values):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+    def _bytes(values):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+    # the feature names of the object detection API TFRecords
+    features = {
+        'image/encoded': _bytes([encoded]),
+        'image/format': _bytes([payload.encode('utf-8')]),
+        'image/source_id': _bytes([image_path.encode('utf-8')]),
+        'image/height': _ints([image_size]),
+        'image/width': _ints([image_size]),
+        'image/original_height': _ints([original_shape[0]]),
+        'image/original_width': _ints([original_shape[1]]),
+        'image/object/bbox/ymin': _floats(boxes[:, 0]),
+        'image/object/bbox/xmin': _floats(boxes[:, 1]),
+        'image/object/bbox/ymax': _floats(boxes[:, 2]),
+        'image/object/bbox/xmax': _floats(boxes[:, 3]),
+        'image/object/class/label': _ints(np.asarray(classes, dtype=np.int64)),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString()
+
+
+def _write_shard(path, examples, image_size, payload, jpeg_quality):
+    """Write one shard in a worker process; returns (number of examples, number of bytes)."""
+    with tf.io.TFRecordWriter(path + '.tmp') as writer:
+        for image_path, boxes, classes in examples:
+            writer.write(_encode_example(image_path, boxes, classes, image_size, payload, jpeg_quality))
+    tf.io.gfile.rename(path + '.tmp', path, overwrite=True)
+    return len(examples), tf.io.gfile.stat(path).length
+
+
+def write_tfrecord_shards(image_paths,
+                          boxes_list,
+                          classes_list,
+                          output_dir,
+                          num_shards=8,
+                          split='train',
+                          image_size=640,
+                          payload='jpeg',
+                          jpeg_quality=95,
+                          num_workers=None,
+                          class_names=None):
+    """Resize the images and write them with their groundtruth as sharded TFRecords.
+
+    Every shard is written by one process of a pool (spawned, so the workers
+    start a clean TensorFlow), the examples being dealt round-robin over the shards.
+
+    Args:
+        image_paths: a list of image file paths.
+        boxes_list: a list of [N_i, 4] normalized (ymin, xmin, ymax, xmax) boxes.
+        classes_list: a list of [N_i] 1-based class ids.
+        output_dir: the dataset directory.
+        num_shards: the number of TFRecord files; a few times num_workers
+        keeps the pool busy and lets the reader interleave them.
+        split: the name prefix of the shards, e.g. 'train' or 'val'.
+        image_size: the images are resized to image_size x image_size.
+        payload: 'jpeg' (re-encoded at jpeg_quality) or 'raw' (uint8 pixels).
+        jpeg_quality: the JPEG quality of the 'jpeg' payload.
+        num_workers: the number of processes, os.cpu_count() by default.
+        class_names: optional names of the class ids 1, 2, ..., stored in dataset_info.json.
+
+    Returns:
+        the dataset info dict, also written to dataset_info.json.
+    """
+    if payload not in PAYLOADS:
+        raise ValueError('Unknown payload %s, expected one of %s' % (payload, PAYLOADS))
+    tf.io.gfile.makedirs(output_dir)
+    examples = [(path, np.asarray(boxes, dtype=np.float32).tolist(), np.asarray(classes).tolist())
+                for path, boxes, classes in zip(image_paths, boxes_list, classes_list)]
+    num_shards = max(1, min(num_shards, len(examples)))
+
+    start_time = time.perf_counter()
+    num_bytes = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers or os.cpu_count(),
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_write_shard, _shard_path(output_dir, split, shard, num_shards),
+                                   examples[shard::num_shards], image_size, payload, jpeg_quality)
+                   for shard in range(num_shards)]
+        for future in concurrent.futures.as_completed(futures):
+            num_bytes += future.result()[1]
+    elapsed = time.perf_counter() - start_time
+
+    info = {'split': split,
+            'num_examples': len(examples),
+            'num_shards': num_shards,
+            'image_size': image_size,
+            'payload': payload,
+            'class_names': list(class_names) if class_names else None,
+            'max_boxes_per_image': max([len(classes) for _, _, classes in examples] or [0]),
+            'num_bytes': num_bytes,
+            'build_seconds': elapsed}
+    with tf.io.gfile.GFile(os.path.join(output_dir, INFO_FILE), 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+def load_dataset_info(dataset_dir):
+    with tf.io.gfile.GFile(os.path.join(dataset_dir, INFO_FILE), 'r') as f:
+        return json.load(f)
+
+
+def build_tfrecord_train_dataset(dataset_dir,
+                                 batch_size,
+                                 num_classes,
+                                 max_boxes=100,
+                                 label_id_offset=1,
+                                 shuffle_buffer_size=1000,
+                                 seed=None):
+    """Build a repeating, shuffled training dataset from write_tfrecord_shards() output.
+
+    The shards are read in parallel and interleaved, and the examples are
+    shuffled as (small) serialized records before they are decoded.
+
+    Args:
+        dataset_dir: the directory written by write_tfrecord_shards().
+        batch_size, num_classes, max_boxes, label_id_offset, seed: as in
+        data_util.build_train_dataset().
+        shuffle_buffer_size: the number of serialized examples shuffled.
+
+    Returns:
+        A tf.data.Dataset yielding the same (images, boxes, classes_one_hot,
+        num_boxes) batches as data_util.build_train_dataset(), images being
+        float32 [B, image_size, image_size, 3] in [0, 255].
+    """
+    info = load_dataset_info(dataset_dir)
+    image_size = info['image_size']
+    if info['max_boxes_per_image'] > max_boxes:
+        raise ValueError('The dataset has images with %d boxes, more than max_boxes=%d.' %
+                         (info['max_boxes_per_image'], max_boxes))
+    features = {
+        'image/encoded': tf.io.FixedLenFeature([], tf.string),
+        'image/object/bbox/ymin': tf.io.VarLenFeature(tf.float32),
+        'image/object/bbox/xmin': tf.io.VarLenFeature(tf.float32),
+        'image/object/bbox/ymax': tf.io.VarLenFeature(tf.float32),
+        'image/object/bbox/xmax': tf.io.VarLenFeature(tf.float32),
+        'image/object/class/label': tf.io.VarLenFeature(tf.int64),
+    }
+
+    def _parse(serialized):
+        example = tf.io.parse_single_example(serialized, features)
+        if info['payload'] == 'jpeg':
+            image = tf.io.decode_jpeg(example['image/encoded'], channels=3)
+        else:
+            image = tf.io.decode_raw(example['image/encoded'], tf.uint8)
+        image = tf.cast(tf.reshape(image, [image_size, image_size, 3]), tf.float32)
+        boxes = tf.stack([tf.sparse.to_dense(example['image/object/bbox/' + key])
+                          for key in ['ymin', 'xmin', 'ymax', 'xmax']], axis=1)
+        classes = tf.cast(tf.sparse.to_dense(example['image/object/class/label']), tf.int32)
+        num_boxes = tf.shape(classes)[0]
+        boxes = tf.pad(boxes, [[0, max_boxes - num_boxes], [0, 0]])
+        # padded slots get index -1, which tf.one_hot maps to an all-zero row
+        classes = tf.pad(classes - label_id_offset, [[0, max_boxes - num_boxes]], constant_values=-1)
+        boxes.set_shape([max_boxes, 4])
+        classes_one_hot = tf.one_hot(classes, num_classes)
+        classes_one_hot.set_shape([max_boxes, num_classes])
+        return image, boxes, classes_one_hot, num_boxes
+
+    pattern = os.path.join(dataset_dir, '%s-*-of-*.tfrecord' % info['split'])
+    dataset = tf.data.Dataset.list_files(pattern, shuffle=True, seed=seed)
+    dataset = dataset.repeat()
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=min(info['num_shards'], 8),
+                                 num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(_parse, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
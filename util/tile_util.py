@@ -0,0 +1,119 @@
+'''
+This code is for sliced inference: tiling very large images with overlap and merging the tile detections.
+
+The tiles are sliced views of the decoded image (no copies); they are copied
+once, straight into the model input batch. Each model input is described by a
+window (y0, x0, height, width) in image pixels that its normalized boxes span,
+which maps the boxes of tiles and of a downscaled full frame alike back to the
+normalized coordinates of the whole image.
+'''
+import numpy as np
+
+from util import postprocess_util
+
+
+def tile_origins(length, tile_size, overlap=0.2):
+    """Return the start offsets of tiles covering `length` pixels; the last tile ends flush with the edge.
+
+    Args:
+        length: the image height or width.
+        tile_size: the tile height or width.
+        overlap: the fraction of tile_size shared by neighbouring tiles (at least).
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def slice_image(image_np, tile_size, overlap=0.2):
+    """Slice an [H, W, C] image into overlapping tiles.
+
+    Args:
+        image_np: the decoded image.
+        tile_size: the tile height and width; images smaller than this give
+        smaller tiles, to be zero-padded by the caller.
+        overlap: see tile_origins().
+
+    Returns:
+        tiles: a list of [<=tile_size, <=tile_size, C] views into image_np.
+        windows: a float32 [num_tiles, 4] array of (y0, x0, tile_size, tile_size),
+        the pixels spanned by the normalized boxes of each zero-padded tile.
+    """
+    height, width = image_np.shape[:2]
+    tiles, windows = [], []
+    for y0 in tile_origins(height, tile_size, overlap):
+        for x0 in tile_origins(width, tile_size, overlap):
+            tiles.append(image_np[y0:y0 + tile_size, x0:x0 + tile_size])
+            windows.append((y0, x0, tile_size, tile_size))
+    return tiles, np.array(windows, dtype=np.float32)
+
+
+def full_frame_window(image_shape, valid_fraction):
+    """The window of a whole image resized and padded by image_util.resize_and_pad()."""
+    return np.array([0, 0, image_shape[0] / valid_fraction[0], image_shape[1] / valid_fraction[1]],
+                    dtype=np.float32)
+
+
+def boxes_to_image(boxes, windows, image_shape):
+    """Map [N, D, 4] boxes normalized to N model inputs onto the whole image (normalized).
+
+    Args:
+        boxes: (ymin, xmin, ymax, xmax) boxes per input.
+        windows: [N, 4] (y0, x0, height, width) pixel windows of the inputs.
+        image_shape: (height, width) of the whole image.
+    """
+    offset = np.tile(windows[:, np.newaxis, :2], 2)
+    extent = np.tile(windows[:, np.newaxis, 2:], 2)
+    size = np.array(list(image_shape[:2]) * 2, dtype=np.float32)
+    return np.clip((offset + boxes * extent) / size, 0.0, 1.0)
+
+
+def _touches_seam(boxes, windows, image_shape, margin):
+    """[N, D] mask of the boxes lying within `margin` pixels of a tile edge inside the image."""
+    height, width = image_shape[:2]
+    y0, x0 = windows[:, np.newaxis, 0], windows[:, np.newaxis, 1]
+    y1, x1 = y0 + windows[:, np.newaxis, 2], x0 + windows[:, np.newaxis, 3]
+    ymin, xmin, ymax, xmax = [boxes[..., i] * size for i, size in enumerate([height, width] * 2)]
+    return (((ymin - y0 < margin) & (y0 > 0)) | ((xmin - x0 < margin) & (x0 > 0)) |
+            ((y1 - ymax < margin) & (y1 < height)) | ((x1 - xmax < margin) & (x1 < width)))
+
+
+def merge_tile_detections(detections, windows, image_shape, num_tiles=None, min_score=0.3,
+                          iou_threshold=0.5, max_detections=100, drop_seam_boxes=True, seam_margin=2):
+    """Merge the detections of the inputs of one image into its detections.
+
+    Args:
+        detections: a dict of [N, D, 4] 'detection_boxes', [N, D] 'detection_scores'
+        and 'detection_classes' arrays of the N inputs of the image.
+        windows: the [N, 4] windows of the inputs, from slice_image() and
+        full_frame_window().
+        image_shape: (height, width) of the image.
+        num_tiles: the first num_tiles inputs are tiles, the others whole-frame
+        views; None if all of them are tiles.
+        min_score: detections below this score are dropped.
+        iou_threshold: duplicates across overlapping tiles are suppressed by
+        per-class NMS at this IoU.
+        max_detections: the number of output slots.
+        drop_seam_boxes: drop the tile boxes that touch a tile edge inside the
+        image: objects cut by a seam are seen whole by an overlapping tile (if
+        they are smaller than the overlap) or by the full frame.
+        seam_margin: the distance in pixels counted as touching.
+
+    Returns:
+        the postprocess_util.postprocess_detections() dict for one image
+        ([1, max_detections] arrays), boxes normalized to the whole image.
+    """
+    boxes = boxes_to_image(np.asarray(detections['detection_boxes'], dtype=np.float32), windows, image_shape)
+    scores = np.asarray(detections['detection_scores'], dtype=np.float32)
+    if drop_seam_boxes:
+        num_tiles = len(windows) if num_tiles is None else num_tiles
+        is_tile = (np.arange(len(windows)) < num_tiles)[:, np.newaxis]
+        scores = np.where(is_tile & _touches_seam(boxes, windows, image_shape, seam_margin), -np.inf, scores)
+    # all the inputs as a single image, so NMS runs across the tile seams
+    merged = {'detection_boxes': boxes.reshape(1, -1, 4),
+              'detection_scores': scores.reshape(1, -1),
+              'detection_classes': np.asarray(detections['detection_classes']).reshape(1, -1)}
+    return postprocess_util.postprocess_detections(
+        merged, min_score=min_score, method='nms', iou_threshold=iou_threshold,
+        max_detections=max_detections, pre_nms_top_k=None)
@@ -0,0 +1,112 @@
+'''
+This code is for carrying detections across video frames with a cheap IoU tracker.
+
+Detections are matched to the existing tracks greedily by IoU (vectorized with
+postprocess_util.batched_iou), and each track keeps a constant velocity, so
+boxes can be extrapolated over the frames that were skipped to keep up with
+real time.
+'''
+import numpy as np
+
+from util import postprocess_util
+
+
+class IoUTracker(object):
+    """Track boxes of the same class across frames by IoU overlap.
+
+    Args:
+        iou_threshold: the minimum IoU between a track and a detection to match.
+        max_missed_frames: a track not matched for more frames than this is dropped.
+        min_hits: a track is reported once it was matched this many times.
+        velocity_smoothing: the weight of the previous velocity in the
+        exponential average of the per-frame box motion.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed_frames=10, min_hits=1, velocity_smoothing=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_missed_frames = max_missed_frames
+        self.min_hits = min_hits
+        self.velocity_smoothing = velocity_smoothing
+        self._boxes = np.zeros((0, 4), dtype=np.float32)
+        self._velocities = np.zeros((0, 4), dtype=np.float32)
+        self._classes = np.zeros(0, dtype=np.int64)
+        self._scores = np.zeros(0, dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._hits = np.zeros(0, dtype=np.int64)
+        self._missed = np.zeros(0, dtype=np.int64)
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _tracks(self, boxes, visible):
+        return {'track_ids': self._ids[visible],
+                'detection_boxes': np.clip(boxes[visible], 0.0, 1.0),
+                'detection_scores': self._scores[visible],
+                'detection_classes': self._classes[visible]}
+
+    def predict(self, num_frames=1):
+        """Return the tracks extrapolated num_frames ahead, without changing the tracker."""
+        visible = self._hits >= self.min_hits
+        return self._tracks(self._boxes + num_frames * self._velocities, visible)
+
+    def update(self, boxes, scores, classes, num_frames=1):
+        """Match the detections of a frame num_frames after the last update and return the tracks.
+
+        Args:
+            boxes: [N, 4] normalized (ymin, xmin, ymax, xmax) boxes.
+            scores: [N] scores.
+            classes: [N] class ids.
+            num_frames: the frames elapsed since the previous update (1 + the skipped ones).
+
+        Returns:
+            a dict of the confirmed tracks: 'track_ids' [T], 'detection_boxes'
+            [T, 4], 'detection_scores' [T] and 'detection_classes' [T].
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32)
+        classes = np.asarray(classes, dtype=np.int64)
+        predicted = self._boxes + num_frames * self._velocities
+
+        # greedy matching, highest IoU first, within the same class
+        iou = postprocess_util.batched_iou(predicted, boxes)
+        iou = np.where(self._classes[:, np.newaxis] == classes[np.newaxis], iou, 0)
+        track_of_detection = np.full(len(boxes), -1, dtype=np.int64)
+        if iou.size:
+            track_indices, detection_indices = np.unravel_index(np.argsort(-iou, axis=None), iou.shape)
+            matched_tracks = np.zeros(len(predicted), dtype=bool)
+            for t, d in zip(track_indices, detection_indices):
+                if iou[t, d] < self.iou_threshold:
+                    break
+                if not matched_tracks[t] and track_of_detection[d] < 0:
+                    matched_tracks[t] = True
+                    track_of_detection[d] = t
+
+        matched = track_of_detection >= 0
+        tracks = track_of_detection[matched]
+        motion = (boxes[matched] - self._boxes[tracks]) / num_frames
+        self._velocities[tracks] = (self.velocity_smoothing * self._velocities[tracks] +
+                                    (1 - self.velocity_smoothing) * motion)
+        self._boxes = predicted
+        self._boxes[tracks] = boxes[matched]
+        self._scores[tracks] = scores[matched]
+        self._hits[tracks] += 1
+        self._missed += num_frames
+        self._missed[tracks] = 0
+
+        # new tracks for the unmatched detections, then drop the lost tracks
+        new = ~matched
+        num_new = int(new.sum())
+        self._boxes = np.concatenate([self._boxes, boxes[new]])
+        self._velocities = np.concatenate([self._velocities, np.zeros((num_new, 4), dtype=np.float32)])
+        self._classes = np.concatenate([self._classes, classes[new]])
+        self._scores = np.concatenate([self._scores, scores[new]])
+        self._ids = np.concatenate([self._ids, np.arange(self._next_id, self._next_id + num_new)])
+        self._hits = np.concatenate([self._hits, np.ones(num_new, dtype=np.int64)])
+        self._missed = np.concatenate([self._missed, np.zeros(num_new, dtype=np.int64)])
+        self._next_id += num_new
+        alive = self._missed <= self.max_missed_frames
+        for name in ['_boxes', '_velocities', '_classes', '_scores', '_ids', '_hits', '_missed']:
+            setattr(self, name, getattr(self, name)[alive])
+
+        return self._tracks(self._boxes, (self._hits >= self.min_hits) & (self._missed == 0))